@@ -0,0 +1,72 @@
+"""
+Local store of built binaries that rarely change, such as the uninstaller executables.
+
+Artifacts live under <cache_root>/artifacts/<key[:2]>/<key>/ next to the compression
+cache and are keyed by a hash of everything that affects the binary (source hash,
+tool versions). Each entry records how long the original build took, so hits can
+report the time they saved.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import time
+
+from compression_cache import get_cache_root
+
+
+class ArtifactCache:
+	"""Stores built files under <cache_dir>/artifacts, keyed by their inputs."""
+
+	def __init__(self, cache_dir: str | None = None):
+		self.cache_dir = os.path.join(cache_dir or get_cache_root(), "artifacts")
+		os.makedirs(self.cache_dir, exist_ok=True)
+
+	@staticmethod
+	def make_key(**inputs) -> str:
+		"""Builds a key from named inputs (e.g. source hash and tool versions)."""
+		return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode("utf-8")).hexdigest()
+
+	def _entry_dir(self, key: str) -> str:
+		return os.path.join(self.cache_dir, key[:2], key)
+
+	def fetch(self, key: str, name: str, dest_path: str) -> float | None:
+		"""Copies the cached artifact `name` to dest_path.
+
+		Returns the build time it replaces in seconds, or None on a miss.
+		"""
+		entry_dir = self._entry_dir(key)
+		try:
+			with open(os.path.join(entry_dir, "meta.json"), "r") as f:
+				meta = json.load(f)
+			shutil.copy2(os.path.join(entry_dir, name), dest_path)
+		except (OSError, ValueError):
+			return None
+		return meta.get("build_seconds", 0.0)
+
+	def store(self, key: str, src_path: str, name: str, build_seconds: float):
+		"""Stores src_path as artifact `name` under key."""
+		entry_dir = self._entry_dir(key)
+		temp_dir = f"{entry_dir}.{os.getpid()}.tmp"
+		shutil.rmtree(temp_dir, ignore_errors=True)
+		os.makedirs(temp_dir)
+		shutil.copy2(src_path, os.path.join(temp_dir, name))
+		with open(os.path.join(temp_dir, "meta.json"), "w") as f:
+			json.dump({"name": name, "build_seconds": build_seconds, "created": time.time()}, f)
+
+		shutil.rmtree(entry_dir, ignore_errors=True)
+		os.replace(temp_dir, entry_dir)
+
+	def clear(self):
+		"""Removes every cached artifact."""
+		shutil.rmtree(self.cache_dir, ignore_errors=True)
+		os.makedirs(self.cache_dir, exist_ok=True)
+
+
+def artifact_cache_from_args(args: argparse.Namespace) -> ArtifactCache | None:
+	"""Creates the artifact cache selected by the shared --cache-dir/--no-cache switches (see compression_cache)."""
+	if args.no_cache:
+		return None
+	return ArtifactCache(args.cache_dir)
@@ -0,0 +1,175 @@
+"""
+Benchmark: combined installer size, startup time and peak RSS, base64 script vs offset-indexed payloads.
+
+Builds combined installers around the same synthetic platform installers and runs them as:
+
+  legacy        both installers embedded as base64 string literals of a Python script (the previous format)
+  temp file     build_combined_installer.create_combined_installer(memfd=False): a launcher zip application
+                with the installers in a payload container, of which only the running platform's is
+                copied into a temporary directory
+  memfd         the same, with the installer copied into a memory file and executed from it
+  cache cold    --launcher-cache with an empty cache: the installer is copied into the cache
+  cache warm    --launcher-cache with the installer already cached: nothing is copied or hashed
+
+The Ubuntu "installer" is a shell script that exits right away, padded to --ubuntu-mb with
+random bytes, so the measured time is the launcher's: parsing, extracting and starting the
+installer. All are run in fresh interpreters (no .pyc cache) and the median wall time and peak
+RSS of the child processes are reported.
+
+Linux only (runs the Ubuntu installer; uses os.wait4 for per-child resource usage).
+
+Usage:
+  python benchmarks/bench_combined_installer.py [--windows-mb 150] [--ubuntu-mb 100] [--runs 5]
+"""
+
+import argparse
+import base64
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from build_combined_installer import create_combined_installer
+
+MB = 1024 * 1024
+
+
+def write_random(f, size: int):
+	while size > 0:
+		piece = min(size, 8 * MB)
+		f.write(os.urandom(piece))
+		size -= piece
+
+
+def make_installers(work_dir: str, windows_mb: int, ubuntu_mb: int) -> tuple[str, str]:
+	windows_installer = os.path.join(work_dir, "metaffi-installer-windows.exe")
+	ubuntu_installer = os.path.join(work_dir, "metaffi-installer-ubuntu")
+	with open(windows_installer, "wb") as f:
+		write_random(f, windows_mb * MB)
+	with open(ubuntu_installer, "wb") as f:
+		header = b"#!/bin/sh\nexit 0\n"
+		f.write(header)
+		write_random(f, ubuntu_mb * MB - len(header))
+	os.chmod(ubuntu_installer, 0o755)
+	return windows_installer, ubuntu_installer
+
+
+def write_base64(out, path: str):
+	with open(path, "rb") as f:
+		while True:
+			chunk = f.read(3 * 256 * 1024)
+			if not chunk:
+				break
+			out.write(base64.b64encode(chunk).decode("ascii"))
+
+
+def write_legacy_installer(windows_installer: str, ubuntu_installer: str, output_path: str):
+	"""Writes a combined installer in the previous format: a script with both installers as base64 literals.
+
+	The installers are streamed into the script: forked children inherit the parent's peak RSS.
+	"""
+	with open(output_path, "w", newline="\n") as f:
+		f.write(f"""#!/usr/bin/env python3
+import base64
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+
+WINDOWS_INSTALLER = "{os.path.basename(windows_installer)}"
+UBUNTU_INSTALLER = "{os.path.basename(ubuntu_installer)}"
+""")
+		f.write('WINDOWS_PAYLOAD_B64 = "')
+		write_base64(f, windows_installer)
+		f.write('"\nUBUNTU_PAYLOAD_B64 = "')
+		write_base64(f, ubuntu_installer)
+		f.write(""""
+
+
+def write_payload(path: str, payload_b64: str):
+    with open(path, "wb") as f:
+        f.write(base64.b64decode(payload_b64.encode("ascii")))
+
+
+def main():
+    with tempfile.TemporaryDirectory(prefix="metaffi_installer_") as temp_dir:
+        if platform.system() == "Windows":
+            installer_path = os.path.join(temp_dir, WINDOWS_INSTALLER)
+            write_payload(installer_path, WINDOWS_PAYLOAD_B64)
+        else:
+            installer_path = os.path.join(temp_dir, UBUNTU_INSTALLER)
+            write_payload(installer_path, UBUNTU_PAYLOAD_B64)
+            os.chmod(installer_path, 0o755)
+        sys.exit(subprocess.run([installer_path] + sys.argv[1:], check=False).returncode)
+
+
+if __name__ == "__main__":
+    main()
+""")
+
+
+def run_once(installer: str, args: list[str], env: dict) -> tuple[float, int]:
+	start = time.perf_counter()
+	proc = subprocess.Popen([sys.executable, "-B", installer] + args, stdout=subprocess.DEVNULL, env=env)
+	_, status, usage = os.wait4(proc.pid, 0)
+	elapsed = time.perf_counter() - start
+	if os.waitstatus_to_exitcode(status) != 0:
+		raise RuntimeError(f"{installer} exited with {os.waitstatus_to_exitcode(status)}")
+	# the launcher only: the installer it starts is its own child and not included
+	peak_rss = usage.ru_maxrss * 1024
+	return elapsed, peak_rss
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Benchmark combined installer formats")
+	parser.add_argument("--windows-mb", type=int, default=150, help="Windows installer size in MB (default: 150)")
+	parser.add_argument("--ubuntu-mb", type=int, default=100, help="Ubuntu installer size in MB (default: 100)")
+	parser.add_argument("--runs", type=int, default=5, help="Runs per format (default: 5)")
+	args = parser.parse_args()
+
+	work_dir = tempfile.mkdtemp(prefix="metaffi_combined_bench_")
+	try:
+		windows_installer, ubuntu_installer = make_installers(work_dir, args.windows_mb, args.ubuntu_mb)
+		legacy = os.path.join(work_dir, "combined-legacy.py")
+		temp_file = os.path.join(work_dir, "combined-temp-file")
+		memfd = os.path.join(work_dir, "combined-memfd")
+		write_legacy_installer(windows_installer, ubuntu_installer, legacy)
+		create_combined_installer(windows_installer, ubuntu_installer, "0.0.0", temp_file, memfd=False)
+		create_combined_installer(windows_installer, ubuntu_installer, "0.0.0", memfd, memfd=True)
+
+		cache_home = os.path.join(work_dir, "cache")
+		env = dict(os.environ, XDG_CACHE_HOME=cache_home)
+		clear_cache = lambda: shutil.rmtree(cache_home, ignore_errors=True)
+		# name, installer, arguments, run before every run
+		cases = [
+			("legacy", legacy, [], None),
+			("temp file", temp_file, [], None),
+			("memfd", memfd, [], None),
+			("cache cold", memfd, ["--launcher-cache"], clear_cache),
+			("cache warm", memfd, ["--launcher-cache"], None),
+		]
+
+		print(f"Platform installers: windows {args.windows_mb} MB, ubuntu {args.ubuntu_mb} MB, {args.runs} runs per format")
+		print(f"{'format':<12}{'artifact bytes':>16}{'median s':>10}{'peak RSS MB':>13}")
+		for name, installer, installer_args, before in cases:
+			results = []
+			for _ in range(args.runs):
+				if before is not None:
+					before()
+				results.append(run_once(installer, installer_args, env))
+			seconds = statistics.median(r[0] for r in results)
+			rss = max(r[1] for r in results)
+			print(f"{name:<12}{os.path.getsize(installer):>16,}{seconds:>10.3f}{rss / MB:>13.1f}")
+	finally:
+		shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,264 @@
+"""
+Benchmark suite for the packaging hot paths on synthetic MetaFFI output trees.
+
+Each size tier generates an output tree shaped like a MetaFFI build: a few large shared
+libraries (xllr, the metaffi CLI, the uninstaller), thousands of small headers under
+include/, and a plugin output directory holding jars and a libclang-sized blob. The suite
+then times, with the median of --repeat runs:
+
+  resolve          build_installer.resolve_manifest_files over the ubuntu core manifest
+  zip              build_installer.zip_installer_files of the resolved files (no cache)
+  unpack           unpack_into_directory of templates/metaffi_installer_template.py on that zip
+  installer file   build_installer.create_installer_file
+  plugin build     build_plugin_installer.PluginInstallerBuilder.build (no cache)
+
+Results are written as JSON. The compare command flags the cases that got slower than a
+baseline results file by more than --threshold, and exits with 1 if there are any.
+
+Usage:
+  python benchmarks/bench_packaging.py run [--tier small medium large] [--repeat 3] [--jobs <n>] [--output <results.json>]
+  python benchmarks/bench_packaging.py compare <baseline.json> <results.json> [--threshold 0.10] [--min-seconds 0.01]
+"""
+
+import argparse
+import ast
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import typing
+import zipfile
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from bench_parallel_compression import make_binary_like, make_header
+from build_installer import create_installer_file, load_manifest, resolve_manifest_files, zip_installer_files
+from build_plugin_installer import PluginInstallerBuilder
+from packaging_engine import default_workers
+
+TEMPLATE_PATH = os.path.join(REPO_DIR, "templates", "metaffi_installer_template.py")
+
+RESULTS_FORMAT = 1
+
+MB = 1024 * 1024
+
+# tier: (shared library MB, headers, jar MB, jar count, libclang MB)
+TIERS = {
+	"small": (4, 500, 1, 4, 16),
+	"medium": (16, 2000, 2, 8, 64),
+	"large": (64, 5000, 4, 16, 256),
+}
+
+PLUGIN_NAME = "bench"
+
+
+def write_binary_like(path: str, size: int, rng: random.Random):
+	"""Writes size bytes of shared-library-like data, generated in 8 MB pieces."""
+	with open(path, "wb") as f:
+		while size > 0:
+			piece = min(size, 8 * MB)
+			f.write(make_binary_like(piece, rng))
+			size -= piece
+
+
+def generate_tier(root: str, tier: str, seed: int = 1234) -> dict:
+	"""Generates the core output tree and the plugin source and output directories of a tier under root.
+
+	Returns the layout: {"output_dir", "plugin_dir", "files", "bytes"}.
+	"""
+	library_mb, headers, jar_mb, jar_count, libclang_mb = TIERS[tier]
+	rng = random.Random(seed)
+	output_dir = os.path.join(root, "output")
+	include_dir = os.path.join(output_dir, "include")
+	plugin_output = os.path.join(output_dir, PLUGIN_NAME)
+	plugin_dir = os.path.join(root, f"lang-plugin-{PLUGIN_NAME}")
+	for directory in (include_dir, os.path.join(plugin_output, "lib"), os.path.join(plugin_dir, "install")):
+		os.makedirs(directory)
+
+	# the large files of the ubuntu core manifest
+	for name in ("xllr.so", "metaffi", "uninstall"):
+		write_binary_like(os.path.join(output_dir, name), library_mb * MB, rng)
+	for i in range(headers):
+		with open(os.path.join(include_dir, f"metaffi_header_{i}.h"), "wb") as f:
+			f.write(make_header(rng))
+
+	write_binary_like(os.path.join(plugin_output, f"metaffi_{PLUGIN_NAME}.so"), library_mb * MB, rng)
+	for i in range(jar_count):
+		# jars are zip archives already, so their content does not compress further
+		with open(os.path.join(plugin_output, f"{PLUGIN_NAME}_{i}.jar"), "wb") as f:
+			f.write(rng.randbytes(jar_mb * MB))
+	write_binary_like(os.path.join(plugin_output, "lib", "libclang.so"), libclang_mb * MB, rng)
+
+	manifest = {
+		"name": PLUGIN_NAME,
+		"version": "0.0.0",
+		"compression": [{"pattern": "*.jar", "method": "store"}],
+		"files": {"ubuntu": ["*.so", "*.jar", "lib/**"]},
+	}
+	with open(os.path.join(plugin_dir, "install", "plugin_manifest.json"), "w") as f:
+		json.dump(manifest, f, indent=2)
+
+	paths = [os.path.join(directory, name) for directory, _, names in os.walk(output_dir) for name in names]
+	return {"output_dir": output_dir, "plugin_dir": plugin_dir, "files": len(paths), "bytes": sum(os.path.getsize(p) for p in paths)}
+
+
+def load_template_unpacker() -> typing.Callable[[typing.BinaryIO, str], None]:
+	"""Returns unpack_into_directory, taken verbatim from the installer template."""
+	with open(TEMPLATE_PATH, "r") as f:
+		source = f.read()
+	node = next(node for node in ast.parse(source).body if isinstance(node, ast.FunctionDef) and node.name == "unpack_into_directory")
+	namespace = {"os": os, "typing": typing, "zipfile": zipfile}
+	exec(ast.get_source_segment(source, node), namespace)
+	return namespace["unpack_into_directory"]
+
+
+def measure(fn: typing.Callable[[], typing.Any], repeat: int, setup: typing.Callable[[], None] | None = None) -> dict:
+	"""Runs fn repeat times (after setup, untimed, each time) with its output suppressed and returns the timings."""
+	runs = []
+	for _ in range(repeat):
+		if setup is not None:
+			setup()
+		with contextlib.redirect_stdout(io.StringIO()):
+			start = time.perf_counter()
+			fn()
+			runs.append(time.perf_counter() - start)
+	return {"seconds": statistics.median(runs), "min_seconds": min(runs), "runs": runs}
+
+
+def run_tier(tier: str, work_dir: str, repeat: int, workers: int) -> dict:
+	"""Generates a tier under work_dir and returns {case: timings} for it."""
+	print(f"\n[{tier}] generating tree...")
+	layout = generate_tier(os.path.join(work_dir, "tree"), tier)
+	output_dir = layout["output_dir"].replace("\\", "/") + "/"
+	print(f"[{tier}] {layout['files']:,} files, {layout['bytes']:,} bytes")
+
+	core_files = load_manifest()["ubuntu"]["files"]
+	files = resolve_manifest_files(core_files, output_dir)
+	zip_path = os.path.join(work_dir, "core.zip")
+	unpack_dir = os.path.join(work_dir, "unpacked")
+	unpack_into_directory = load_template_unpacker()
+
+	def zip_files():
+		with zip_installer_files(files, output_dir, workers=workers) as payload, open(zip_path, "wb") as f:
+			shutil.copyfileobj(payload, f)
+
+	def unpack():
+		with open(zip_path, "rb") as f:
+			unpack_into_directory(f, unpack_dir)
+
+	def installer_file():
+		with contextlib.chdir(REPO_DIR):
+			create_installer_file(os.path.join(work_dir, "installer.py"), "0.0.0")
+
+	def plugin_build():
+		with contextlib.chdir(work_dir):
+			PluginInstallerBuilder(layout["plugin_dir"], "ubuntu", "Release", None, layout["output_dir"], workers=workers).build()
+
+	cases = {
+		"resolve": measure(lambda: resolve_manifest_files(core_files, output_dir), repeat),
+		"zip": measure(zip_files, repeat),
+		"unpack": measure(unpack, repeat, setup=lambda: shutil.rmtree(unpack_dir, ignore_errors=True)),
+		"installer file": measure(installer_file, repeat),
+		"plugin build": measure(plugin_build, repeat),
+	}
+	cases["zip"]["bytes"] = os.path.getsize(zip_path)
+	cases["plugin build"]["bytes"] = sum(os.path.getsize(os.path.join(work_dir, "installers_output", name))
+										 for name in os.listdir(os.path.join(work_dir, "installers_output")))
+	for name, result in cases.items():
+		print(f"[{tier}] {name:<16}{result['seconds']:>10.3f}s (min {result['min_seconds']:.3f}s)")
+	return {"files": layout["files"], "bytes": layout["bytes"], "cases": cases}
+
+
+def run(args: argparse.Namespace):
+	workers = args.jobs or default_workers()
+	results = {
+		"format": RESULTS_FORMAT,
+		"created_at": time.time(),
+		"python": platform.python_version(),
+		"platform": platform.platform(),
+		"cpu_count": os.cpu_count(),
+		"workers": workers,
+		"repeat": args.repeat,
+		"tiers": {},
+	}
+	for tier in args.tier:
+		work_dir = tempfile.mkdtemp(prefix=f"metaffi_bench_{tier}_")
+		try:
+			results["tiers"][tier] = run_tier(tier, work_dir, args.repeat, workers)
+		finally:
+			shutil.rmtree(work_dir, ignore_errors=True)
+
+	os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+	with open(args.output, "w") as f:
+		json.dump(results, f, indent=2)
+		f.write("\n")
+	print(f"\nResults: {os.path.abspath(args.output)}")
+
+
+def load_results(path: str) -> dict:
+	with open(path, "r") as f:
+		results = json.load(f)
+	if results.get("format") != RESULTS_FORMAT:
+		raise ValueError(f"{path}: unsupported benchmark results format {results.get('format')}")
+	return results
+
+
+def compare(args: argparse.Namespace) -> int:
+	"""Prints every case of both results files and returns the number of regressions."""
+	baseline = load_results(args.baseline)
+	current = load_results(args.results)
+	if (baseline["cpu_count"], baseline["workers"]) != (current["cpu_count"], current["workers"]):
+		print(f"Warning: results come from different machines or worker counts "
+			  f"({baseline['cpu_count']} CPUs/{baseline['workers']} workers vs {current['cpu_count']} CPUs/{current['workers']} workers)")
+
+	regressions = 0
+	print(f"{'tier':<8}{'case':<16}{'baseline s':>12}{'current s':>12}{'change':>10}")
+	for tier, tier_results in current["tiers"].items():
+		baseline_cases = baseline["tiers"].get(tier, {}).get("cases", {})
+		for case, result in tier_results["cases"].items():
+			if case not in baseline_cases:
+				print(f"{tier:<8}{case:<16}{'-':>12}{result['seconds']:>12.3f}{'new':>10}")
+				continue
+			before, after = baseline_cases[case]["seconds"], result["seconds"]
+			change = (after - before) / before if before > 0 else 0.0
+			regressed = change > args.threshold and after - before > args.min_seconds
+			regressions += regressed
+			print(f"{tier:<8}{case:<16}{before:>12.3f}{after:>12.3f}{change:>+9.1%}" + ("  REGRESSION" if regressed else ""))
+
+	print(f"\n{regressions} regression(s) above {args.threshold:.0%}" if regressions else f"\nNo regressions above {args.threshold:.0%}")
+	return regressions
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Benchmark the MetaFFI packaging hot paths on synthetic output trees")
+	commands = parser.add_subparsers(dest="command", required=True)
+
+	run_parser = commands.add_parser("run", help="Run the benchmarks and write the results as JSON")
+	run_parser.add_argument("--tier", nargs="+", choices=list(TIERS), default=["small", "medium"], help="Size tiers to run (default: small medium)")
+	run_parser.add_argument("--repeat", type=int, default=3, help="Runs per case; the median is reported (default: 3)")
+	run_parser.add_argument("--jobs", type=int, default=None, help=f"Compression worker threads (default: {default_workers()})")
+	run_parser.add_argument("--output", default="bench_packaging.json", help="Results file (default: bench_packaging.json)")
+
+	compare_parser = commands.add_parser("compare", help="Flag cases that got slower than a baseline")
+	compare_parser.add_argument("baseline", help="Baseline results file")
+	compare_parser.add_argument("results", help="Results file to check")
+	compare_parser.add_argument("--threshold", type=float, default=0.10, help="Relative slowdown flagged as a regression (default: 0.10)")
+	compare_parser.add_argument("--min-seconds", type=float, default=0.01, help="Ignore slowdowns smaller than this, in seconds (default: 0.01)")
+	args = parser.parse_args()
+
+	if args.command == "run":
+		run(args)
+	elif compare(args):
+		sys.exit(1)
+
+
+if __name__ == "__main__":
+	main()
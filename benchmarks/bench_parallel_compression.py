@@ -0,0 +1,131 @@
+"""
+Benchmark: serial zipfile compression vs the parallel packaging engine.
+
+Generates a synthetic tree (a few large shared-library-like blobs plus many
+small headers), then times the previous serial path (zipfile, ZIP_DEFLATED,
+compresslevel=9) against packaging_engine.write_zip() at several worker counts.
+
+Usage:
+  python benchmarks/bench_parallel_compression.py [--large-mb 64] [--large-count 3] [--headers 2000] [--jobs 1,2,4,8]
+"""
+
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import zipfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from packaging_engine import PackageEntry, default_workers, write_zip
+
+
+def make_binary_like(size: int, rng: random.Random) -> bytes:
+	"""Produces data with roughly the redundancy of a compiled shared library."""
+	vocabulary = [rng.randbytes(rng.randint(4, 64)) for _ in range(4096)]
+	parts = []
+	total = 0
+	while total < size:
+		if rng.random() < 0.15:
+			chunk = rng.randbytes(rng.randint(16, 256))
+		else:
+			chunk = rng.choice(vocabulary)
+		parts.append(chunk)
+		total += len(chunk)
+	return b"".join(parts)[:size]
+
+
+def make_header(rng: random.Random) -> bytes:
+	lines = ["#pragma once", "#include <stdint.h>", ""]
+	for i in range(rng.randint(20, 200)):
+		lines.append(f"extern int metaffi_symbol_{rng.randint(0, 10**6)}_{i}(void* p, uint64_t n); // generated")
+	return ("\n".join(lines) + "\n").encode()
+
+
+def generate_tree(root: str, large_mb: int, large_count: int, headers: int, seed: int = 1234) -> list[PackageEntry]:
+	rng = random.Random(seed)
+	entries = []
+	for i in range(large_count):
+		path = os.path.join(root, f"lib{i}.so")
+		with open(path, "wb") as f:
+			f.write(make_binary_like(large_mb * 1024 * 1024, rng))
+		entries.append(PackageEntry(src=path, arcname=f"lib{i}.so"))
+
+	include_dir = os.path.join(root, "include")
+	os.makedirs(include_dir)
+	for i in range(headers):
+		path = os.path.join(include_dir, f"header_{i}.h")
+		with open(path, "wb") as f:
+			f.write(make_header(rng))
+		entries.append(PackageEntry(src=path, arcname=f"include/header_{i}.h"))
+	return entries
+
+
+def serial_zipfile(entries: list[PackageEntry], out_path: str):
+	with zipfile.ZipFile(out_path, "w", zipfile.ZIP_DEFLATED, compresslevel=9) as zf:
+		for entry in entries:
+			zf.write(entry.src, arcname=entry.arcname)
+
+
+def engine(entries: list[PackageEntry], out_path: str, workers: int):
+	with open(out_path, "wb") as f:
+		write_zip(f, entries, workers=workers)
+
+
+def timed(fn, *args) -> float:
+	start = time.perf_counter()
+	fn(*args)
+	return time.perf_counter() - start
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Benchmark parallel vs serial zip compression")
+	parser.add_argument("--large-mb", type=int, default=64, help="Size of each large blob in MB (default: 64)")
+	parser.add_argument("--large-count", type=int, default=3, help="Number of large blobs (default: 3)")
+	parser.add_argument("--headers", type=int, default=2000, help="Number of small headers (default: 2000)")
+	parser.add_argument("--jobs", default=None, help="Comma-separated worker counts (default: 1,2,4,...,cpu count)")
+	args = parser.parse_args()
+
+	if args.jobs:
+		job_counts = [int(j) for j in args.jobs.split(",")]
+	else:
+		job_counts = [1]
+		while job_counts[-1] * 2 <= default_workers():
+			job_counts.append(job_counts[-1] * 2)
+		if job_counts[-1] != default_workers():
+			job_counts.append(default_workers())
+
+	work_dir = tempfile.mkdtemp(prefix="metaffi_bench_")
+	try:
+		tree = os.path.join(work_dir, "tree")
+		os.makedirs(tree)
+		print(f"Generating tree: {args.large_count} x {args.large_mb} MB + {args.headers} headers...")
+		entries = generate_tree(tree, args.large_mb, args.large_count, args.headers)
+		input_size = sum(os.path.getsize(e.src) for e in entries)
+
+		out_path = os.path.join(work_dir, "serial.zip")
+		serial_seconds = timed(serial_zipfile, entries, out_path)
+		serial_size = os.path.getsize(out_path)
+
+		print(f"\nInput: {input_size:,} bytes in {len(entries)} files")
+		print(f"{'mode':<22}{'seconds':>10}{'speedup':>10}{'size':>16}")
+		print(f"{'zipfile (serial)':<22}{serial_seconds:>10.2f}{1.0:>9.2f}x{serial_size:>16,}")
+
+		for workers in job_counts:
+			out_path = os.path.join(work_dir, f"engine_{workers}.zip")
+			seconds = timed(engine, entries, out_path, workers)
+			with zipfile.ZipFile(out_path) as zf:
+				bad = zf.testzip()
+			if bad is not None:
+				raise RuntimeError(f"Corrupt member in engine output: {bad}")
+			label = f"engine --jobs {workers}"
+			print(f"{label:<22}{seconds:>10.2f}{serial_seconds / seconds:>9.2f}x{os.path.getsize(out_path):>16,}")
+	finally:
+		shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+	main()
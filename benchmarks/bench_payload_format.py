@@ -0,0 +1,134 @@
+"""
+Benchmark: installer startup time and peak RSS, base64-literal payload vs payload container.
+
+Builds two stand-alone scripts around the same synthetic payload zip:
+
+  legacy     the payload embedded as a `windows_x64_zip = b'<base64>'` literal (the previous format)
+  container  the payload in a metaffi_payload.bin container next to the script, read with the
+             reader functions taken verbatim from templates/metaffi_installer_template.py
+
+Each script opens the payload zip and lists its members, which is what the installer does
+before extracting. Both are run in fresh interpreters (no .pyc cache) and the median wall
+time and peak RSS of the child process are reported.
+
+Linux/macOS only (uses os.wait4 for per-child resource usage).
+
+Usage:
+  python benchmarks/bench_payload_format.py [--payload-mb 200] [--runs 5]
+"""
+
+import argparse
+import ast
+import base64
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from payload_format import PAYLOAD_FILE_NAME, write_payload_container
+
+TEMPLATE_PATH = os.path.join(REPO_DIR, "templates", "metaffi_installer_template.py")
+
+READER_NAMES = ["PAYLOAD_FILE", "PAYLOAD_MAGIC", "PAYLOAD_HEADER_STRUCT", "PAYLOAD_SECTION_STRUCT", "PayloadRegion", "find_payload_file", "open_payload_section"]
+
+
+def extract_template_reader() -> str:
+	"""Returns the source of the payload reader definitions in the installer template."""
+	with open(TEMPLATE_PATH, "r") as f:
+		source = f.read()
+
+	parts = []
+	for node in ast.parse(source).body:
+		names = []
+		if isinstance(node, (ast.FunctionDef, ast.ClassDef)):
+			names = [node.name]
+		elif isinstance(node, ast.Assign):
+			names = [t.id for t in node.targets if isinstance(t, ast.Name)]
+		if any(name in READER_NAMES for name in names):
+			parts.append(ast.get_source_segment(source, node))
+	return "\n\n".join(parts)
+
+
+def make_payload_zip(path: str, size_mb: int):
+	with zipfile.ZipFile(path, "w", zipfile.ZIP_STORED) as zf:
+		chunk = os.urandom(1024 * 1024)
+		for i in range(size_mb):
+			zf.writestr(f"lib/blob_{i}.bin", chunk)
+
+
+def write_legacy_script(path: str, payload_path: str):
+	with open(path, "w") as f, open(payload_path, "rb") as payload:
+		f.write("import base64, io, zipfile\n")
+		f.write("windows_x64_zip = b'")
+		while True:
+			chunk = payload.read(3 * 256 * 1024)
+			if not chunk:
+				break
+			f.write(base64.b64encode(chunk).decode("ascii"))
+		f.write("'\n")
+		f.write("zf = zipfile.ZipFile(io.BytesIO(base64.b64decode(windows_x64_zip)), 'r')\n")
+		f.write("print(len(zf.namelist()))\n")
+
+
+def write_container_script(path: str, payload_path: str):
+	with open(os.path.join(os.path.dirname(path), PAYLOAD_FILE_NAME), "wb") as f, open(payload_path, "rb") as payload:
+		write_payload_container(f, [("windows_x64", payload)])
+
+	with open(path, "w") as f:
+		f.write("import hashlib, io, mmap, os, struct, sys, typing, zipfile\n\n")
+		f.write(extract_template_reader())
+		f.write("\n\nzf = zipfile.ZipFile(open_payload_section('windows_x64'), 'r')\n")
+		f.write("print(len(zf.namelist()))\n")
+
+
+def run_once(script: str) -> tuple[float, int]:
+	start = time.perf_counter()
+	proc = subprocess.Popen([sys.executable, "-B", script], stdout=subprocess.DEVNULL)
+	_, status, usage = os.wait4(proc.pid, 0)
+	elapsed = time.perf_counter() - start
+	proc.returncode = os.waitstatus_to_exitcode(status)
+	if proc.returncode != 0:
+		raise RuntimeError(f"{script} exited with {proc.returncode}")
+	peak_rss = usage.ru_maxrss if sys.platform == "darwin" else usage.ru_maxrss * 1024
+	return elapsed, peak_rss
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Benchmark installer payload formats")
+	parser.add_argument("--payload-mb", type=int, default=200, help="Payload zip size in MB (default: 200)")
+	parser.add_argument("--runs", type=int, default=5, help="Runs per format (default: 5)")
+	args = parser.parse_args()
+
+	work_dir = tempfile.mkdtemp(prefix="metaffi_payload_bench_")
+	try:
+		# the payload is streamed through files only: forked children inherit the parent's peak RSS
+		payload_path = os.path.join(work_dir, "payload.zip")
+		make_payload_zip(payload_path, args.payload_mb)
+		scripts = {}
+		for name, writer in (("legacy", write_legacy_script), ("container", write_container_script)):
+			script_dir = os.path.join(work_dir, name)
+			os.makedirs(script_dir)
+			scripts[name] = os.path.join(script_dir, "installer.py")
+			writer(scripts[name], payload_path)
+
+		print(f"Payload zip: {os.path.getsize(payload_path):,} bytes, {args.runs} runs per format")
+		print(f"{'format':<12}{'artifact bytes':>16}{'median s':>10}{'peak RSS MB':>13}")
+		for name, script in scripts.items():
+			artifact = sum(os.path.getsize(os.path.join(os.path.dirname(script), f)) for f in os.listdir(os.path.dirname(script)))
+			results = [run_once(script) for _ in range(args.runs)]
+			seconds = statistics.median(r[0] for r in results)
+			rss = max(r[1] for r in results)
+			print(f"{name:<12}{artifact:>16,}{seconds:>10.3f}{rss / (1024 * 1024):>13.1f}")
+	finally:
+		shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+	main()
@@ -1,70 +1,236 @@
+"""
+Combined MetaFFI installer: a single file that installs MetaFFI on Windows and on Ubuntu.
+
+The combined installer is an executable Python zip application:
+
+  #!/usr/bin/env python3    shebang line
+  payload container         the platform installers as the sections "windows" and "ubuntu" (see payload_format)
+  zip                       __main__.py, the launcher
+
+Python runs the zip at the end of the file whatever precedes it. The launcher reads the
+section table right after the shebang line and copies only the running platform's installer,
+in chunks and checking its SHA-256, then runs it with the launcher's arguments. The other
+platform's installer is never read.
+
+On Linux the installer is copied into an anonymous in-memory file (memfd_create) and executed
+from it, without a temporary file, unless it is a PyInstaller onefile executable: their
+bootloader reopens its own file by path, which a memory file does not have. Those, and the
+Windows installer, are copied into a temporary directory instead.
+
+With --launcher-cache (removed from the arguments passed on), the installer is kept in
+~/.cache/metaffi/installers/<sha256>/ ($XDG_CACHE_HOME, or %LOCALAPPDATA% on Windows) and
+later runs of the same installer start it from there without copying or hashing anything, as
+long as it has the size and modification time recorded when it was copied and verified.
+
+Usage:
+  python build_combined_installer.py --windows-installer <installer.exe> --ubuntu-installer <installer> [--version <version>] [--output <path>] [--no-memfd] [--no-profile]
+"""
+
 import argparse
-import base64
 import os
+import zipfile
+
+from build_metrics import add_profile_arguments, configure_profile, finish_profile, phase
+from payload_format import (COPY_CHUNK_SIZE, HEADER_SIZE, HEADER_STRUCT, PAYLOAD_FORMAT_VERSION, PAYLOAD_MAGIC, SECTION_SIZE, SECTION_STRUCT,
+							write_payload_container)
 from version import METAFFI_VERSION
 
 
-def read_bytes(path: str) -> bytes:
-	with open(path, "rb") as f:
-		return f.read()
+SHEBANG = b"#!/usr/bin/env python3\n"
+
+# platform.system() -> payload section of its installer
+PLATFORM_SECTIONS = {"Windows": "windows", "Linux": "ubuntu"}
+
+# the launcher is always stored with this timestamp, so identical inputs give identical installers
+LAUNCHER_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+LAUNCHER_CACHE_FLAG = "--launcher-cache"
+
+# Written next to a cached installer once it is verified: "<sha256> <size> <mtime_ns>"
+CACHE_MARKER_SUFFIX = ".verified"
 
+# Cookie magic of the archive PyInstaller appends to onefile executables
+PYINSTALLER_COOKIE_MAGIC = b"MEI\014\013\012\013\016"
 
-def create_combined_installer_script(windows_installer: str, ubuntu_installer: str, version: str, output_path: str):
-	windows_payload = base64.b64encode(read_bytes(windows_installer)).decode("ascii")
-	ubuntu_payload = base64.b64encode(read_bytes(ubuntu_installer)).decode("ascii")
 
-	content = f"""#!/usr/bin/env python3
-import base64
+def is_pyinstaller_onefile(path: str) -> bool:
+	"""Returns True if the file carries a PyInstaller archive cookie."""
+	overlap = len(PYINSTALLER_COOKIE_MAGIC) - 1
+	tail = b""
+	with open(path, "rb") as f:
+		while True:
+			chunk = f.read(COPY_CHUNK_SIZE)
+			if not chunk:
+				return False
+			if PYINSTALLER_COOKIE_MAGIC in tail + chunk:
+				return True
+			tail = chunk[-overlap:]
+
+
+def launcher_source(version: str, windows_installer: str, ubuntu_installer: str, memfd_sections: list[str]) -> str:
+	"""Returns the __main__.py of a combined installer. memfd_sections are the installers that can run from a memory file."""
+	return f"""import hashlib
 import os
 import platform
+import struct
 import subprocess
 import sys
 import tempfile
 
 METAFFI_VERSION = "{version}"
-WINDOWS_INSTALLER = "{os.path.basename(windows_installer)}"
-UBUNTU_INSTALLER = "{os.path.basename(ubuntu_installer)}"
-WINDOWS_PAYLOAD_B64 = "{windows_payload}"
-UBUNTU_PAYLOAD_B64 = "{ubuntu_payload}"
+INSTALLERS = {{"Windows": ("{PLATFORM_SECTIONS['Windows']}", "{windows_installer}"), "Linux": ("{PLATFORM_SECTIONS['Linux']}", "{ubuntu_installer}")}}
+MEMFD_SECTIONS = {memfd_sections!r}
+LAUNCHER_CACHE_FLAG = "{LAUNCHER_CACHE_FLAG}"
+CACHE_MARKER_SUFFIX = "{CACHE_MARKER_SUFFIX}"
+
+# payload container (see payload_format.py in metaffi-installer)
+PAYLOAD_MAGIC = {PAYLOAD_MAGIC!r}
+PAYLOAD_FORMAT_VERSION = {PAYLOAD_FORMAT_VERSION}
+HEADER_STRUCT = "{HEADER_STRUCT}"
+SECTION_STRUCT = "{SECTION_STRUCT}"
+HEADER_SIZE = {HEADER_SIZE}
+SECTION_SIZE = {SECTION_SIZE}
+COPY_CHUNK_SIZE = {COPY_CHUNK_SIZE}
 
 
-def write_payload(path: str, payload_b64: str):
-    with open(path, "wb") as f:
-        f.write(base64.b64decode(payload_b64.encode("ascii")))
+def find_section(fp, name: str):
+    \"\"\"Returns (absolute offset, length, sha256) of a section of the container following the shebang line.\"\"\"
+    fp.seek(0)
+    fp.readline()
+    start = fp.tell()
+    magic, version, count, _ = struct.unpack(HEADER_STRUCT, fp.read(HEADER_SIZE))
+    if magic != PAYLOAD_MAGIC or version != PAYLOAD_FORMAT_VERSION:
+        raise Exception("The installer is corrupted (bad payload header)")
+    table = fp.read(SECTION_SIZE * count)
+    for i in range(count):
+        section_name, offset, length, digest = struct.unpack_from(SECTION_STRUCT, table, i * SECTION_SIZE)
+        if section_name.rstrip(b"\\0").decode("utf-8") == name:
+            return start + offset, length, digest
+    raise Exception(f"The installer has no {{name}} payload")
 
 
-def run_installer(installer_path: str):
-    args = [installer_path] + sys.argv[1:]
-    result = subprocess.run(args, check=False)
+def copy_section(fp, offset: int, length: int, expected: bytes, out):
+    \"\"\"Copies a section into out in chunks and verifies it against its hash.\"\"\"
+    fp.seek(offset)
+    digest = hashlib.sha256()
+    remaining = length
+    while remaining > 0:
+        chunk = fp.read(min(COPY_CHUNK_SIZE, remaining))
+        if not chunk:
+            raise Exception("The installer is truncated")
+        digest.update(chunk)
+        out.write(chunk)
+        remaining -= len(chunk)
+    if digest.digest() != expected:
+        raise Exception("The installer is corrupted (payload hash mismatch)")
+
+
+def cache_dir() -> str:
+    if platform.system() == "Windows" and os.environ.get("LOCALAPPDATA"):
+        return os.path.join(os.environ["LOCALAPPDATA"], "metaffi", "installers")
+    return os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "metaffi", "installers")
+
+
+def cache_marker(path: str, digest: bytes) -> str:
+    \"\"\"Returns the contents of the marker of a verified cached installer: its sha256, size and modification time.\"\"\"
+    st = os.stat(path)
+    return f"{{digest.hex()}} {{st.st_size}} {{st.st_mtime_ns}}\\n"
+
+
+def cached_installer(fp, offset: int, length: int, digest: bytes, installer_name: str) -> str:
+    \"\"\"Returns the installer in the launcher cache, copying it there first if it is not.
+
+    A cached installer is used only if the marker written after it was copied and verified
+    still matches its size and modification time; otherwise it is copied and verified again.
+    \"\"\"
+    path = os.path.join(cache_dir(), digest.hex(), installer_name)
+    marker_path = path + CACHE_MARKER_SUFFIX
+    try:
+        with open(marker_path, "r") as f:
+            if f.read() == cache_marker(path, digest) and os.path.getsize(path) == length:
+                return path
+    except OSError:
+        pass
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, "wb") as out:
+            copy_section(fp, offset, length, digest, out)
+        os.chmod(temp_path, 0o755)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    with open(marker_path, "w") as f:
+        f.write(cache_marker(path, digest))
+    return path
+
+
+def run_installer(installer_path: str, args: list):
+    if os.name == "posix":
+        os.execv(installer_path, [installer_path] + args)
+    result = subprocess.run([installer_path] + args, check=False)
     sys.exit(result.returncode)
 
 
 def main():
     system_name = platform.system()
-    with tempfile.TemporaryDirectory(prefix="metaffi_installer_") as temp_dir:
-        if system_name == "Windows":
-            installer_path = os.path.join(temp_dir, WINDOWS_INSTALLER)
-            write_payload(installer_path, WINDOWS_PAYLOAD_B64)
-            run_installer(installer_path)
-            return
-
-        if system_name == "Linux":
-            installer_path = os.path.join(temp_dir, UBUNTU_INSTALLER)
-            write_payload(installer_path, UBUNTU_PAYLOAD_B64)
-            os.chmod(installer_path, 0o755)
-            run_installer(installer_path)
-            return
-
+    if system_name not in INSTALLERS:
         print(f"Unsupported OS for MetaFFI installer: {{system_name}}", file=sys.stderr)
         sys.exit(2)
 
+    section, installer_name = INSTALLERS[system_name]
+    args = [arg for arg in sys.argv[1:] if arg != LAUNCHER_CACHE_FLAG]
+    with open(os.path.abspath(sys.argv[0]), "rb") as fp:
+        offset, length, digest = find_section(fp, section)
+
+        if LAUNCHER_CACHE_FLAG in sys.argv[1:]:
+            run_installer(cached_installer(fp, offset, length, digest, installer_name), args)
+
+        if section in MEMFD_SECTIONS and hasattr(os, "memfd_create"):
+            fd = os.memfd_create(installer_name, 0)
+            with os.fdopen(fd, "wb", closefd=False) as out:
+                copy_section(fp, offset, length, digest, out)
+            os.execve(fd, [installer_name] + args, os.environ)
+
+        with tempfile.TemporaryDirectory(prefix="metaffi_installer_") as temp_dir:
+            installer_path = os.path.join(temp_dir, installer_name)
+            with open(installer_path, "wb") as out:
+                copy_section(fp, offset, length, digest, out)
+            if system_name != "Windows":
+                os.chmod(installer_path, 0o755)
+            result = subprocess.run([installer_path] + args, check=False)
+    sys.exit(result.returncode)
+
 
 if __name__ == "__main__":
     main()
 """
 
-	with open(output_path, "w", newline="\n") as f:
-		f.write(content)
+
+def create_combined_installer(windows_installer: str, ubuntu_installer: str, version: str, output_path: str, memfd: bool = True):
+	"""Writes the combined installer of a Windows and an Ubuntu installer to output_path.
+
+	Unless memfd is False, the launcher runs the Ubuntu installer from a memory file if it is not a PyInstaller onefile executable.
+	"""
+	with open(output_path, "wb") as out:
+		out.write(SHEBANG)
+		with phase("write payload") as record, open(windows_installer, "rb") as windows, open(ubuntu_installer, "rb") as ubuntu:
+			sections = write_payload_container(out, [(PLATFORM_SECTIONS["Windows"], windows), (PLATFORM_SECTIONS["Linux"], ubuntu)])
+			record.bytes_in = sum(section.length for section in sections)
+			record.bytes_out = out.tell() - len(SHEBANG)
+
+		with phase("write launcher") as record:
+			memfd_sections = [PLATFORM_SECTIONS["Linux"]] if memfd and not is_pyinstaller_onefile(ubuntu_installer) else []
+			source = launcher_source(version, os.path.basename(windows_installer), os.path.basename(ubuntu_installer), memfd_sections)
+			launcher = zipfile.ZipInfo("__main__.py", date_time=LAUNCHER_DATE_TIME)
+			launcher.compress_type = zipfile.ZIP_DEFLATED
+			launcher.external_attr = 0o644 << 16
+			start = out.tell()
+			with zipfile.ZipFile(out, "w") as zf:
+				zf.writestr(launcher, source)
+			record.bytes_in = len(source)
+			record.bytes_out = out.tell() - start
 
 	# make executable on non-Windows hosts
 	if os.name != "nt":
@@ -77,6 +243,8 @@ def main():
 	parser.add_argument("--ubuntu-installer", required=True, help="Path to ubuntu installer")
 	parser.add_argument("--version", default=METAFFI_VERSION)
 	parser.add_argument("--output", default=None, help="Output combined installer path")
+	parser.add_argument("--no-memfd", action="store_true", help="Always run the Ubuntu installer from a temporary file instead of a memory file")
+	add_profile_arguments(parser)
 	args = parser.parse_args()
 
 	if not os.path.isfile(args.windows_installer):
@@ -91,7 +259,9 @@ def main():
 		output = os.path.abspath(args.output)
 		os.makedirs(os.path.dirname(output), exist_ok=True)
 
-	create_combined_installer_script(args.windows_installer, args.ubuntu_installer, args.version, output)
+	configure_profile(args, "combined installer")
+	create_combined_installer(args.windows_installer, args.ubuntu_installer, args.version, output, memfd=not args.no_memfd)
+	finish_profile(output)
 	print(f"Done. Built combined installer: {output}")
 
 
@@ -6,18 +6,28 @@ headers, etc.) that can be extracted directly into METAFFI_HOME without
 needing the PyInstaller-wrapped installer.
 
 Usage:
-  python build_core_zip.py --target <windows|ubuntu> --version <version> --build-type <Debug|Release>
+  python build_core_zip.py --target <windows|ubuntu> --version <version> --build-type <Debug|Release> [--jobs <n>] [--deterministic] [--check-reproducible] [--auto-tune] [--no-profile] [--size-budget <file>] [--accept-size-growth] [--strip] [--relock]
 
 Output:
   installers_output/metaffi-core-<version>-<build_type>-<target>.zip
+  installers_output/metaffi-core-<version>-<build_type>-<target>.zip.profile.json and .trace.json (phase timings)
+  installers_output/metaffi-core-<version>-<build_type>-<target>.zip.sizes.json (size report, see size_report.py)
+  installers_output/metaffi-core-<version>-<build_type>-<target>.zip.lock.json (resolved files and digests, see manifest_lock.py)
+  installers_output/metaffi-debug-core-<version>-<build_type>-<target>.zip (with --strip, see debug_split.py)
 """
 
 import argparse
-import glob
-import json
 import os
 import sys
-import zipfile
+
+from build_metrics import add_profile_arguments, configure_profile, finish_profile
+from compression_cache import add_cache_arguments, cache_from_args
+from compression_policy import CompressionPolicy, auto_tune, write_manifest_policy
+from debug_split import add_strip_arguments, configure_strip, strip_package_entries
+from manifest_lock import add_installed_lock, add_lock_arguments, configure_lock, resolve_locked
+from manifest_resolver import ManifestResolver, ResolvedFile, load_manifest_file
+from packaging_engine import PackageEntry, add_determinism_arguments, check_reproducible, configure_determinism, default_workers, write_zip
+from size_report import add_size_report_arguments, configure_size_report, report_archive_sizes
 
 
 def resolve_output_dir(target: str, build_type: str) -> str:
@@ -38,49 +48,15 @@ def resolve_output_dir(target: str, build_type: str) -> str:
 	return output_dir
 
 
-def collect_files(manifest_entries: list, output_dir: str) -> list[tuple[str, str]]:
-	"""Resolve manifest entries into (absolute_path, arcname) pairs."""
-	result = []
-
-	for entry in manifest_entries:
-		if isinstance(entry, str):
-			matches = glob.glob(os.path.join(output_dir, entry))
-			if not matches:
-				raise FileNotFoundError(f"No files found matching: {entry} in {output_dir}")
-			for match in matches:
-				arcname = os.path.relpath(match, output_dir).replace("\\", "/")
-				result.append((match, arcname))
-
-		elif isinstance(entry, dict):
-			src_pattern = entry["src"]
-			dest = entry["dest"]
-			optional = entry.get("optional", False)
-
-			# Expand environment variables
-			src_pattern = os.path.expandvars(src_pattern)
-
-			# Resolve relative paths against output_dir
-			if not os.path.isabs(src_pattern):
-				src_pattern = os.path.join(output_dir, src_pattern)
+def collect_files(manifest_entries: list, output_dir: str, excludes: list | None = None, zip_path: str | None = None) -> list[ResolvedFile]:
+	"""Resolve manifest entries against output_dir through a single scan of the tree (see manifest_resolver).
 
-			src_pattern = src_pattern.replace("\\", "/")
-			matches = glob.glob(src_pattern)
-
-			if not matches:
-				if optional:
-					print(f"  [skip] optional file not found: {src_pattern}")
-					continue
-				else:
-					raise FileNotFoundError(f"Required file not found: {src_pattern}")
-
-			for match in matches:
-				if dest.endswith("/"):
-					arcname = dest + os.path.basename(match)
-				else:
-					arcname = dest
-				result.append((match, arcname))
-
-	return result
+	If zip_path is given, the files are resolved through, and recorded in, its lock file (see manifest_lock).
+	"""
+	if zip_path is None:
+		return ManifestResolver(output_dir).resolve(manifest_entries, excludes or [])
+	inputs = {"root": output_dir, "files": manifest_entries, "exclude": excludes or []}
+	return resolve_locked(zip_path, inputs, lambda: {"output": ManifestResolver(output_dir).resolve(manifest_entries, excludes or [])})["output"]
 
 
 def main():
@@ -88,12 +64,24 @@ def main():
 	parser.add_argument("--target", required=True, choices=["windows", "ubuntu"])
 	parser.add_argument("--version", required=True)
 	parser.add_argument("--build-type", required=True)
+	parser.add_argument("--jobs", type=int, default=None, help=f"Number of compression worker threads (default: {default_workers()})")
+	add_cache_arguments(parser)
+	add_determinism_arguments(parser)
+	add_profile_arguments(parser)
+	add_size_report_arguments(parser)
+	add_strip_arguments(parser)
+	add_lock_arguments(parser)
+	parser.add_argument("--auto-tune", action="store_true",
+						help="Measure codecs on samples of each file type, write the recommended 'compression' rules into installer_manifest.json and exit")
 	args = parser.parse_args()
+	configure_determinism(args)
+	configure_size_report(args)
+	configure_strip(args)
+	configure_lock(args)
 
 	# Load manifest
 	manifest_path = os.path.join(os.path.dirname(__file__), "installer_manifest.json")
-	with open(manifest_path, "r") as f:
-		manifest = json.load(f)
+	manifest = load_manifest_file(manifest_path)
 
 	target_manifest = manifest.get(args.target)
 	if not target_manifest:
@@ -104,21 +92,45 @@ def main():
 	print(f"Core zip: target={args.target}, version={args.version}, build_type={args.build_type}")
 	print(f"Output dir: {output_dir}")
 
-	# Collect files from manifest
-	files = collect_files(target_manifest["files"], output_dir)
+	if args.auto_tune:
+		files = collect_files(target_manifest["files"], output_dir, target_manifest.get("exclude"), None)
+		print("Auto-tuning compression policy...")
+		policy = auto_tune((f.src, f.arcname) for f in files).merged_with(CompressionPolicy.from_manifest(manifest))
+		write_manifest_policy(manifest_path, policy)
+		print(f"Wrote {len(policy.rules)} compression rule(s) to {manifest_path}")
+		return
 
-	# Create zip
-	os.makedirs("installers_output", exist_ok=True)
 	zip_name = f"metaffi-core-{args.version}-{args.build_type}-{args.target}.zip"
 	zip_path = os.path.join("installers_output", zip_name)
 
-	with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED, compresslevel=9) as zf:
-		for abs_path, arcname in files:
-			print(f"  + {arcname}")
-			zf.write(abs_path, arcname)
-
-	file_size = os.path.getsize(zip_path)
-	print(f"\nCreated: {os.path.abspath(zip_path)} ({file_size:,} bytes)")
+	configure_profile(args, f"core zip {args.target}")
+	try:
+		# Collect files from manifest
+		files = collect_files(target_manifest["files"], output_dir, target_manifest.get("exclude"), zip_path)
+		policy = CompressionPolicy.from_manifest(manifest)
+
+		# Create zip
+		os.makedirs("installers_output", exist_ok=True)
+
+		for file in files:
+			print(f"  + {file.arcname}")
+
+		cache = cache_from_args(args)
+		entries = [PackageEntry(src=file.src, arcname=file.arcname, compression=policy.method_for(file.arcname)) for file in files]
+		entries = strip_package_entries(zip_path, entries, manifest.get("strip", []), args.jobs)
+		entries = add_installed_lock(entries, args.jobs)
+		with open(zip_path, "wb") as f:
+			members = write_zip(f, entries, workers=args.jobs, cache=cache)
+
+		file_size = os.path.getsize(zip_path)
+		print(f"\nCreated: {os.path.abspath(zip_path)} ({file_size:,} bytes)")
+		report_archive_sizes(zip_path, members)
+		if cache is not None:
+			cache.finish()
+	finally:
+		finish_profile(zip_path)
+	if args.check_reproducible and not check_reproducible(zip_path, entries, args.jobs):
+		sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,263 @@
+"""
+Build a delta package that upgrades an installation from one release of a core or plugin zip to the next.
+
+The package lists added and removed files, carries binary patches for changed files and
+the full content of added files (see delta_format). Changed files whose patch would not be
+smaller than the file compressed in the target zip are shipped whole. Installers apply it with --apply-delta.
+
+Deltas are computed between the installed files. For a deduplicated zip (see build_release --dedup)
+these are the files listed in its shared_files.json, taken from the blobs of its companion
+archive, which must be next to the zip.
+
+Unless --no-verify is given, the package is applied to an extracted copy of the base zip,
+checked against the target zip and timed against a full extraction of the target zip.
+
+Usage:
+  python build_delta.py --base <old.zip> --target <new.zip> [--output <package.zip>] [--jobs <n>] [--no-verify]
+
+Output (default):
+  installers_output/delta-<base zip name>-to-<target zip name>.zip
+"""
+
+import argparse
+import contextlib
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import time
+import zipfile
+from dataclasses import dataclass
+
+from compression_cache import sha256_file
+from compression_policy import CompressionMethod
+from delta_format import DELTA_FORMAT_VERSION, DELTA_MANIFEST_NAME, apply_delta_package, create_patch
+from packaging_engine import COPY_CHUNK_SIZE, PackageEntry, add_determinism_arguments, configure_determinism, default_workers, resolve_workers, write_zip
+from shared_files import SHARED_BLOB_PREFIX, SHARED_FILES_NAME, companion_archive, extract_shared_blobs, materialize_shared_files
+
+
+def member_mode(info: zipfile.ZipInfo) -> int | None:
+	"""Returns the unix permission bits recorded for a member, if any."""
+	mode = (info.external_attr >> 16) & 0o777
+	return mode if info.create_system == 3 and mode else None
+
+
+@dataclass(frozen=True)
+class ReleaseFile:
+	"""An installed file of a core or plugin zip: the zip and member holding its content."""
+	zip_path: str
+	member: str
+	size: int
+	compress_size: int
+	mode: int | None
+	# known without reading the content for shared files, whose blobs are named by it
+	sha256: str | None = None
+
+
+def release_files(zip_path: str) -> dict[str, ReleaseFile]:
+	"""Returns {installed name: file} of the files (not directories) of a core or plugin zip.
+
+	The files listed in the zip's shared_files.json are taken from the blobs of its companion archive.
+	"""
+	with zipfile.ZipFile(zip_path) as zf:
+		files = {info.filename: ReleaseFile(zip_path, info.filename, info.file_size, info.compress_size, member_mode(info))
+				 for info in zf.infolist() if not info.is_dir()}
+		if SHARED_FILES_NAME not in files:
+			return files
+		listing = json.loads(zf.read(SHARED_FILES_NAME))
+
+	shared_path = companion_archive(zip_path, listing)
+	with zipfile.ZipFile(shared_path) as zf:
+		blobs = {info.filename: info for info in zf.infolist()}
+	for name, entry in listing["files"].items():
+		blob = blobs.get(SHARED_BLOB_PREFIX + entry["sha256"])
+		if blob is None:
+			raise ValueError(f"{shared_path} has no blob for {name} of {zip_path}")
+		files[name] = ReleaseFile(shared_path, blob.filename, entry["size"], blob.compress_size, entry.get("mode"), entry["sha256"])
+	return files
+
+
+def extract_member(zf: zipfile.ZipFile, name: str, path: str) -> str:
+	"""Extracts a member to path in chunks and returns its SHA-256."""
+	digest = hashlib.sha256()
+	with zf.open(name) as src, open(path, "wb") as dst:
+		while chunk := src.read(COPY_CHUNK_SIZE):
+			digest.update(chunk)
+			dst.write(chunk)
+	return digest.hexdigest()
+
+
+def member_sha256(zf: zipfile.ZipFile, name: str) -> str:
+	with zf.open(name) as f:
+		return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+def open_zips(stack: contextlib.ExitStack, *releases: dict[str, ReleaseFile]) -> dict[str, zipfile.ZipFile]:
+	"""Opens every zip holding files of releases, closed with stack."""
+	paths = {file.zip_path for files in releases for file in files.values()}
+	return {path: stack.enter_context(zipfile.ZipFile(path)) for path in paths}
+
+
+def file_sha256(zips: dict[str, zipfile.ZipFile], file: ReleaseFile) -> str:
+	return file.sha256 or member_sha256(zips[file.zip_path], file.member)
+
+
+def build_delta(base_zip: str, target_zip: str, output_path: str, workers: int | None = None) -> dict:
+	"""Writes the delta package from base_zip to target_zip into output_path and returns its manifest.
+
+	Members are streamed through files in a temporary directory, never read into memory whole.
+	"""
+	base_members = release_files(base_zip)
+	target_members = release_files(target_zip)
+
+	with contextlib.ExitStack() as stack:
+		zips = open_zips(stack, base_members, target_members)
+		work_dir = stack.enter_context(tempfile.TemporaryDirectory(prefix="metaffi-delta-"))
+		base_hashes = {name: file_sha256(zips, base_members[name]) for name in sorted(base_members)}
+		manifest = {
+			"format": DELTA_FORMAT_VERSION,
+			"base_name": os.path.basename(base_zip),
+			"target_name": os.path.basename(target_zip),
+			"base": base_hashes,
+			"files": {},
+			"removed": sorted(set(base_members) - set(target_members)),
+			"unchanged": 0,
+		}
+
+		manifest_path = os.path.join(work_dir, DELTA_MANIFEST_NAME)
+		entries = [PackageEntry(src=manifest_path, arcname=DELTA_MANIFEST_NAME)]
+		for i, name in enumerate(sorted(target_members)):
+			target_path = os.path.join(work_dir, f"member_{i}")
+			target_file = target_members[name]
+			digest = extract_member(zips[target_file.zip_path], target_file.member, target_path)
+			entry = {"sha256": digest, "size": target_file.size, "mode": target_file.mode}
+			src, compression = target_path, None
+			if name not in base_members:
+				entry.update(action="add", member=f"add/{name}")
+			elif base_hashes[name] == digest:
+				manifest["unchanged"] += 1
+				os.remove(target_path)
+				continue
+			else:
+				base_path = os.path.join(work_dir, f"base_{i}")
+				patch_path = os.path.join(work_dir, f"patch_{i}")
+				extract_member(zips[base_members[name].zip_path], base_members[name].member, base_path)
+				create_patch(base_path, target_path, patch_path)
+				os.remove(base_path)
+				if os.path.getsize(patch_path) < target_file.compress_size:
+					# the patch is xz-compressed already
+					entry.update(action="patch", member=f"patch/{name}")
+					src, compression = patch_path, CompressionMethod("store")
+					os.remove(target_path)
+				else:
+					entry.update(action="replace", member=f"add/{name}")
+					os.remove(patch_path)
+			manifest["files"][name] = entry
+			entries.append(PackageEntry(src=src, arcname=entry["member"], compression=compression))
+
+		with open(manifest_path, "w") as f:
+			json.dump(manifest, f, indent=2, sort_keys=True)
+
+		os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+		with open(output_path, "wb") as f:
+			write_zip(f, entries, workers=workers)
+	return manifest
+
+
+def extract_seconds(zip_path: str, directory: str) -> float:
+	"""Extracts a core or plugin zip as its installer does and returns the seconds taken.
+
+	The shared files of a deduplicated zip are materialized from a shared store next to directory.
+	"""
+	start = time.perf_counter()
+	with zipfile.ZipFile(zip_path) as zf:
+		zf.extractall(directory)
+	listing_path = os.path.join(directory, SHARED_FILES_NAME)
+	if os.path.isfile(listing_path):
+		with open(listing_path, "r") as f:
+			listing = json.load(f)
+		store_dir = directory + "-shared"
+		with zipfile.ZipFile(companion_archive(zip_path, listing)) as zf:
+			extract_shared_blobs(zf, store_dir)
+		materialize_shared_files(directory, store_dir)
+	return time.perf_counter() - start
+
+
+def verify_delta(base_zip: str, target_zip: str, package_path: str):
+	"""Applies the package to an extracted base zip, checks the result against the target zip
+	and reports the apply time against a full extraction of the target zip."""
+	with tempfile.TemporaryDirectory(prefix="metaffi-delta-verify-") as temp_dir:
+		installed = os.path.join(temp_dir, "installed")
+		full = os.path.join(temp_dir, "full")
+		extract_seconds(base_zip, installed)
+
+		start = time.perf_counter()
+		apply_delta_package(package_path, installed)
+		apply_seconds = time.perf_counter() - start
+		full_seconds = extract_seconds(target_zip, full)
+
+		target_files = release_files(target_zip)
+		expected = set(target_files)
+		with contextlib.ExitStack() as stack:
+			zips = open_zips(stack, target_files)
+			for name, file in target_files.items():
+				if sha256_file(os.path.join(installed, name)) != file_sha256(zips, file):
+					raise RuntimeError(f"Verification failed: {name} differs from {target_zip} after applying the delta")
+		actual = {os.path.relpath(os.path.join(root, name), installed).replace("\\", "/")
+				  for root, _, names in os.walk(installed) for name in names}
+		if actual != expected:
+			raise RuntimeError(f"Verification failed: file sets differ ({sorted(actual ^ expected)[:5]})")
+
+	print(f"Verified: applying the delta reproduces {os.path.basename(target_zip)}")
+	print(f"Apply time: {apply_seconds:.2f}s (full extraction of the target zip: {full_seconds:.2f}s)")
+
+
+def print_delta_summary(manifest: dict, package_path: str, target_zip: str):
+	actions = [entry["action"] for entry in manifest["files"].values()]
+	package_size = os.path.getsize(package_path)
+	# a deduplicated release is installed from its companion archive too
+	full_size = sum(map(os.path.getsize, {file.zip_path for file in release_files(target_zip).values()} | {target_zip}))
+	print(f"\nDelta {manifest['base_name']} -> {manifest['target_name']}:")
+	print(f"  {actions.count('patch')} patched, {actions.count('replace')} replaced, {actions.count('add')} added, "
+		  f"{len(manifest['removed'])} removed, {manifest['unchanged']} unchanged")
+	for name, entry in sorted(manifest["files"].items()):
+		print(f"  {entry['action']:<8} {name} ({entry['size']:,} bytes)")
+	for name in manifest["removed"]:
+		print(f"  removed  {name}")
+	print(f"Patch size: {package_size:,} bytes vs {full_size:,} bytes full ({100.0 * package_size / full_size:.2f}%)")
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Build a MetaFFI delta package between two core or plugin zips")
+	parser.add_argument("--base", required=True, help="Zip of the release being upgraded from")
+	parser.add_argument("--target", required=True, help="Zip of the release being upgraded to")
+	parser.add_argument("--output", default=None, help="Delta package path (default: installers_output/delta-<base>-to-<target>.zip)")
+	parser.add_argument("--jobs", type=int, default=None, help=f"Number of compression worker threads (default: {default_workers()})")
+	parser.add_argument("--no-verify", action="store_true", help="Do not apply the package to a copy of the base zip to check and time it")
+	add_determinism_arguments(parser, check=False)
+	args = parser.parse_args()
+	configure_determinism(args)
+
+	for path in (args.base, args.target):
+		if not os.path.isfile(path):
+			print(f"Error: zip not found: {path}", file=sys.stderr)
+			sys.exit(1)
+
+	output_path = args.output
+	if output_path is None:
+		base_name = os.path.splitext(os.path.basename(args.base))[0]
+		target_name = os.path.splitext(os.path.basename(args.target))[0]
+		output_path = os.path.join("installers_output", f"delta-{base_name}-to-{target_name}.zip")
+
+	start = time.perf_counter()
+	manifest = build_delta(args.base, args.target, output_path, resolve_workers(args.jobs))
+	print(f"Created: {os.path.abspath(output_path)} in {time.perf_counter() - start:.1f}s")
+	print_delta_summary(manifest, output_path, args.target)
+
+	if not args.no_verify:
+		verify_delta(args.base, args.target, output_path)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,116 @@
+"""
+Build input fingerprints, used to skip rebuilding installers whose inputs did not change.
+
+A fingerprint records the SHA-256 of every packaged file and template, the build
+settings (version, config, ...) and the versions of the tools that produce the
+artifact. It is stored next to the artifact as <artifact>.fingerprint.json; a
+later build with an identical fingerprint and an existing artifact is skipped.
+"""
+
+import hashlib
+import json
+import os
+import platform
+import sys
+from typing import Iterable, List
+
+from build_metrics import phase
+from build_toolchain import locked_versions
+from compression_cache import sha256_file
+
+
+FINGERPRINT_FORMAT = 1
+
+FINGERPRINT_SUFFIX = ".fingerprint.json"
+
+
+def tool_versions() -> dict:
+	"""Returns the versions of the tools that affect the built artifacts."""
+	return {
+		"python": platform.python_version(),
+		"toolchain": locked_versions(),
+		"platform": sys.platform,
+	}
+
+
+def compute_fingerprint(files: Iterable[tuple[str, str]], templates: Iterable[str], settings: dict) -> dict:
+	"""Fingerprints a build.
+
+	files is an iterable of (absolute_path, arcname) packaged into the artifact, templates
+	the other input files (templates, manifests) and settings a JSON-serializable dict of
+	everything else that affects the output.
+	"""
+	files = list(files)
+	templates = list(templates)
+	with phase("fingerprint", bytes_in=sum(os.path.getsize(path) for path, _ in files + [(t, t) for t in templates] if os.path.isfile(path))):
+		inputs = {
+			"format": FINGERPRINT_FORMAT,
+			"settings": settings,
+			"tools": tool_versions(),
+			"templates": {path.replace("\\", "/"): sha256_file(path) for path in templates},
+			"files": {arcname: sha256_file(src) if os.path.isfile(src) else "<dir>" for src, arcname in files},
+		}
+		digest = hashlib.sha256(json.dumps(inputs, sort_keys=True).encode("utf-8")).hexdigest()
+	return {"digest": digest, "inputs": inputs}
+
+
+def fingerprint_path(artifact_path: str) -> str:
+	return artifact_path + FINGERPRINT_SUFFIX
+
+
+def load_fingerprint(artifact_path: str) -> dict | None:
+	"""Returns the fingerprint stored for an artifact, or None if there is none."""
+	try:
+		with open(fingerprint_path(artifact_path), "r") as f:
+			return json.load(f)
+	except (OSError, ValueError):
+		return None
+
+
+def save_fingerprint(artifact_path: str, fingerprint: dict):
+	with open(fingerprint_path(artifact_path), "w") as f:
+		json.dump(fingerprint, f, indent=2, sort_keys=True)
+		f.write("\n")
+
+
+def changed_inputs(artifact_path: str, fingerprint: dict) -> List[str]:
+	"""Returns a description of why artifact_path must be rebuilt, or an empty list if it is up to date."""
+	if not os.path.exists(artifact_path):
+		return ["artifact does not exist"]
+
+	stored = load_fingerprint(artifact_path)
+	if stored is None:
+		return ["no stored fingerprint"]
+	if stored.get("digest") == fingerprint["digest"]:
+		return []
+
+	old = stored.get("inputs", {})
+	new = fingerprint["inputs"]
+	changes = []
+	for section in ("format", "settings", "tools"):
+		if old.get(section) != new[section]:
+			changes.append(f"{section} changed")
+	for section in ("templates", "files"):
+		old_items = old.get(section, {})
+		new_items = new[section]
+		for name in sorted(set(old_items) | set(new_items)):
+			if old_items.get(name) != new_items.get(name):
+				state = "added" if name not in old_items else "removed" if name not in new_items else "modified"
+				changes.append(f"{name} {state}")
+	return changes or ["fingerprint changed"]
+
+
+def report_up_to_date(artifact_path: str, fingerprint: dict, force: bool = False) -> bool:
+	"""Prints whether artifact_path is up to date with fingerprint and returns True if the build can be skipped."""
+	if force:
+		print(f"Rebuilding {artifact_path} (--force)")
+		return False
+
+	changes = changed_inputs(artifact_path, fingerprint)
+	if not changes:
+		print(f"{artifact_path} is up to date (fingerprint {fingerprint['digest'][:16]}...), skipping build")
+		return True
+
+	shown = ", ".join(changes[:5]) + (f" and {len(changes) - 5} more" if len(changes) > 5 else "")
+	print(f"Building {artifact_path}: {shown}")
+	return False
@@ -1,20 +1,34 @@
 import argparse
-import base64
-import glob
-import io
 import json
 import os
 import platform
-import re
 import shutil
 import subprocess
+import tempfile
+import time
 import zipfile
-from typing import List, Tuple, Union
-
+from typing import BinaryIO, Dict, List, Tuple, Union
+
+from artifact_cache import ArtifactCache, artifact_cache_from_args
+from build_fingerprint import compute_fingerprint, report_up_to_date, save_fingerprint
+from build_metrics import add_profile_arguments, configure_profile, finish_profile, phase, print_peak_rss
+from build_scheduler import StageScheduler, StopChain
+from build_toolchain import add_toolchain_arguments, configure_toolchain, get_toolchain, to_wsl_path
+from compression_cache import CompressionCache, add_cache_arguments, cache_from_args, sha256_file
+from compression_policy import CompressionPolicy
+from debug_split import add_strip_arguments, configure_strip, strip_package_entries, strip_settings
+from manifest_lock import INSTALLED_LOCK_NAME, add_installed_lock, add_lock_arguments, configure_lock, resolve_locked
+from manifest_resolver import ManifestResolver, ResolvedFile, load_manifest_file
+from packaging_engine import (ENGINE_FORMAT, PackageEntry, add_determinism_arguments, configure_determinism, default_workers, member_date_time,
+							  transplant_zip, write_zip)
+from payload_format import PAYLOAD_FILE_NAME, write_payload_container
+from shared_files import SHARED_FILES_NAME, SHARED_PAYLOAD_SECTION, companion_archive
+from size_report import add_size_report_arguments, configure_size_report, report_archive_sizes
+from template_renderer import render_template
 from version import METAFFI_VERSION
 
 
-FileEntry = Union[str, Tuple[str, str]]
+FileEntry = Union[str, Tuple[str, str], ResolvedFile]
 
 
 def get_ubuntu_version_tag() -> str:
@@ -68,255 +82,362 @@ def get_output_dir(target: str, config: str) -> str:
 
 
 def load_manifest() -> dict:
-	"""Reads installer_manifest.json from the script directory."""
+	"""Reads installer_manifest.json from the script directory (parsed once per modification)."""
 	manifest_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "installer_manifest.json")
-	with open(manifest_path, "r") as f:
-		return json.load(f)
+	return load_manifest_file(manifest_path)
 
 
-def resolve_manifest_files(entries: list, output_dir: str) -> List[FileEntry]:
-	"""Resolves manifest entries into a list of file entries for zip_installer_files().
+def resolve_manifest_files(entries: list, output_dir: str, excludes: List[str] | None = None, artifact_path: str | None = None) -> List[FileEntry]:
+	"""Resolves manifest entries into files for zip_installer_files().
 
+	The output tree is indexed once and every entry is matched against the index (see manifest_resolver).
+	If artifact_path is given, the files are resolved through, and recorded in, its lock file (see manifest_lock).
 	Each entry can be:
 	- A string: relative glob/path resolved against output_dir
 	- A dict with 'src' and 'dest': src supports env var expansion and globs.
 	  If relative, resolved against output_dir. If dest ends with '/', basename is appended.
 	  If 'optional' is true, missing files produce a warning instead of an error.
+	  'exclude' lists patterns to leave out.
+	"""
+	if artifact_path is None:
+		return ManifestResolver(output_dir).resolve(entries, excludes or [])
+	inputs = {"root": output_dir, "files": entries, "exclude": excludes or []}
+	return resolve_locked(artifact_path, inputs, lambda: {"output": ManifestResolver(output_dir).resolve(entries, excludes or [])})["output"]
+
 
-	Returns a list of strings (relative paths) and (abs_src, arcname) tuples.
+# Payloads larger than this spill from memory to a temporary file on disk
+PAYLOAD_SPOOL_MAX_SIZE = 16 * 1024 * 1024
+
+def to_package_entries(files: List[FileEntry], root: str, policy: CompressionPolicy | None = None) -> List[PackageEntry]:
+	"""Converts resolved manifest file entries into packaging engine entries.
+
+	If a compression policy is given, each entry gets the method of its first matching rule.
+	"""
+	entries: List[PackageEntry] = []
+	for file in files:
+		if isinstance(file, ResolvedFile):
+			entry = PackageEntry(src=file.src, arcname=file.arcname)
+		elif isinstance(file, tuple):
+			entry = PackageEntry(src=file[0], arcname=file[1])
+		elif os.path.isabs(file):
+			entry = PackageEntry(src=file, arcname=file)
+		else:
+			entry = PackageEntry(src=root + file, arcname=file)
+
+		if policy is not None:
+			entry.compression = policy.method_for(entry.arcname)
+		entries.append(entry)
+	return entries
+
+
+def zip_installer_files(files: List[FileEntry], root: str, workers: int | None = None, cache: CompressionCache | None = None,
+						policy: CompressionPolicy | None = None, artifact_path: str | None = None) -> BinaryIO:
+	"""Zips the given files into a spooled temporary file and returns it, rewound to the start.
+
+	Entries are compressed concurrently by the packaging engine using `workers` threads
+	(default: one per CPU), with per-file codecs taken from `policy` (default: the manifest's
+	"compression" rules); unchanged files are taken from `cache` when given. The archive
+	spills to disk once it grows beyond PAYLOAD_SPOOL_MAX_SIZE, so memory use does not grow
+	with the payload. If artifact_path is given, the binaries selected by the manifest's "strip"
+	patterns are stripped with --strip (see debug_split), the lock of the installed files is
+	added (see manifest_lock), and the member sizes are reported and checked against the size
+	budget as those of that installer (see size_report).
+	The caller owns the returned file and should close it when done.
+	"""
+	if policy is None:
+		policy = CompressionPolicy.from_manifest(load_manifest())
+
+	payload = tempfile.SpooledTemporaryFile(max_size=PAYLOAD_SPOOL_MAX_SIZE, mode="w+b")
+	entries = to_package_entries(files, root, policy)
+	if artifact_path is not None:
+		entries = strip_package_entries(artifact_path, entries, load_manifest().get("strip", []), workers)
+		entries = add_installed_lock(entries, workers)
+	members = write_zip(payload, entries, workers=workers, cache=cache)
+	if artifact_path is not None:
+		report_archive_sizes(artifact_path, members)
+	payload.seek(0)
+	return payload
+
+
+def transplant_core_zip(core_zip: str, target: str, artifact_path: str) -> BinaryIO:
+	"""Copies the members of a core zip (see build_core_zip) raw into a spooled temporary file and returns it, rewound to the start.
+
+	Nothing is recompressed: the core zip already holds the stripped binaries, the uninstaller and
+	the lock of the installed files, so the payload is assembled in the time it takes to copy it.
+	The member sizes are reported and checked against the size budget as those of artifact_path.
+	The caller owns the returned file and should close it when done.
 	"""
-	result: List[FileEntry] = []
+	with zipfile.ZipFile(core_zip) as zf:
+		names = set(zf.namelist())
+	for required in (UNINSTALLER_ENTRIES[target], INSTALLED_LOCK_NAME):
+		if required not in names:
+			raise ValueError(f"{core_zip} has no {required}; build it with build_core_zip.py --target {target}")
 
-	for entry in entries:
-		if isinstance(entry, str):
-			# Simple string entry — relative glob against output_dir
-			matches = glob.glob(os.path.join(output_dir, entry))
-			if not matches:
-				raise FileNotFoundError(f"No files found matching pattern: {entry} in {output_dir}")
+	payload = tempfile.SpooledTemporaryFile(max_size=PAYLOAD_SPOOL_MAX_SIZE, mode="w+b")
+	members = transplant_zip(payload, core_zip)
+	report_archive_sizes(artifact_path, members)
+	payload.seek(0)
+	return payload
 
-			for match in matches:
-				rel = os.path.relpath(match, output_dir).replace("\\", "/")
-				result.append(rel)
 
-		elif isinstance(entry, dict):
-			src_pattern = entry["src"]
-			dest = entry["dest"]
-			optional = entry.get("optional", False)
+def core_zip_shared_archive(core_zip: str) -> str | None:
+	"""Returns the companion archive of a deduplicated core zip (see build_release --dedup), or None if it is not deduplicated.
 
-			# Expand environment variables in src
-			src_pattern = os.path.expandvars(src_pattern)
+	The installer needs the archive as the "shared" section of its payload to create the shared files,
+	so it must be next to the core zip.
+	"""
+	with zipfile.ZipFile(core_zip) as zf:
+		if SHARED_FILES_NAME not in zf.namelist():
+			return None
+		listing = json.loads(zf.read(SHARED_FILES_NAME))
+	return companion_archive(core_zip, listing)
 
-			# If relative, resolve against output_dir
-			if not os.path.isabs(src_pattern):
-				src_pattern = os.path.join(output_dir, src_pattern)
 
-			# Normalize path separators
-			src_pattern = src_pattern.replace("\\", "/")
+def core_zip_payload_sections(core_zip: str, target: str, artifact_path: str) -> List[Tuple[str, BinaryIO]]:
+	"""Returns the payload sections of an installer built from a core zip: the transplanted core zip
+	and, for a deduplicated core zip, its companion archive. The caller closes the streams."""
+	shared_archive = core_zip_shared_archive(core_zip)
+	sections = [(PLATFORM_PIPELINES[target][2], transplant_core_zip(core_zip, target, artifact_path))]
+	if shared_archive is not None:
+		sections.append((SHARED_PAYLOAD_SECTION, open(shared_archive, "rb")))
+	return sections
 
-			# Expand globs
-			matches = glob.glob(src_pattern)
 
-			if not matches:
-				if optional:
-					print(f"Warning: optional file not found, skipping: {src_pattern}")
-					continue
-				else:
-					raise FileNotFoundError(f"Required file not found: {src_pattern}")
+def write_installer_payload(payload_dir: str, sections: List[Tuple[str, BinaryIO]]) -> str:
+	"""Writes the payload container bundled with an installer executable and returns its path.
 
-			for match in matches:
-				abs_src = match.replace("\\", "/")
+	sections is a list of (section name, zip stream), e.g. ("ubuntu_x64", ubuntu_zip).
+	"""
+	os.makedirs(payload_dir, exist_ok=True)
+	payload_path = os.path.join(payload_dir, PAYLOAD_FILE_NAME)
+	with phase("payload container") as record, open(payload_path, "wb") as f:
+		for section in write_payload_container(f, sections):
+			print(f"Payload section {section.name}: {section.length:,} bytes (sha256 {section.sha256[:16]}...)")
+			record.bytes_in += section.length
+		record.bytes_out = f.tell()
+	return payload_path
 
-				# If dest ends with '/', put file into that directory keeping its basename
-				if dest.endswith("/"):
-					arcname = dest + os.path.basename(match)
-				else:
-					arcname = dest
 
-				result.append((abs_src, arcname))
+def create_installer_file(python_source_filename: str, version: str):
+	"""Writes the installer source from the template.
 
-		else:
-			raise ValueError(f"Unexpected manifest entry type: {type(entry)}")
+	The payload is not embedded in the source; it is bundled next to the executable
+	as a data file (see write_installer_payload).
+	"""
+	render_template("templates/metaffi_installer_template.py", python_source_filename, {"METAFFI_VERSION": version})
 
-	return result
 
+UNINSTALLER_TEMPLATE = "templates/uninstall_template.py"
 
-def zip_installer_files(files: List[FileEntry], root: str):
-	buffer = io.BytesIO()
-	with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED, compresslevel=9) as zf:
-		for file in files:
-			arcname = file
-			is_specifies_arcname = False
-			if isinstance(file, tuple):
-				is_specifies_arcname = True
-				arcname = file[1]
-				file = file[0]
 
-			if is_specifies_arcname:
-				zf.write(file, arcname=arcname)
-			else:
-				if os.path.isabs(file):
-					zf.write(file, arcname=arcname)
-				else:
-					zf.write(root + file, arcname=arcname)
+def get_uninstaller_cache_key(target: str, versions: dict) -> str:
+	"""Returns the artifact cache key of an uninstaller built by a toolchain with the given versions."""
+	return ArtifactCache.make_key(artifact="uninstaller", target=target, template_sha256=sha256_file(UNINSTALLER_TEMPLATE), **versions)
 
-	return buffer.getvalue()
 
+def fetch_cached_uninstaller(artifacts: ArtifactCache, key: str, name: str, output_path: str) -> bool:
+	"""Copies a cached uninstaller to output_path. Returns False on a miss."""
+	saved_seconds = artifacts.fetch(key, name, output_path)
+	if saved_seconds is None:
+		print(f"Uninstaller cache miss for {name}, building with PyInstaller")
+		return False
 
-def create_installer_file(python_source_filename: str, windows_zip: bytes, ubuntu_zip: bytes, version: str):
-	windows_zip_str = base64.b64encode(windows_zip)
-	ubuntu_zip_str = base64.b64encode(ubuntu_zip)
+	print(f"Uninstaller cache hit: reused {name}, skipped PyInstaller (saved ~{saved_seconds:.1f}s)")
+	return True
 
-	with open("templates/metaffi_installer_template.py", "r") as f:
-		source_code = f.read()
 
-	source_code = re.sub(r"windows_x64_zip\s*=\s*.+", f"windows_x64_zip = {windows_zip_str}", source_code, count=1)
-	source_code = re.sub(r"ubuntu_x64_zip\s*=\s*.+", f"ubuntu_x64_zip = {ubuntu_zip_str}", source_code, count=1)
-	source_code = re.sub(r"METAFFI_VERSION\s*=\s*.+", f"METAFFI_VERSION = '{version}'", source_code, count=1)
+def pyinstaller_work_args(work_dir: str) -> List[str]:
+	"""Returns PyInstaller switches that keep its build directory and .spec file inside work_dir.
 
-	with open(python_source_filename, "w") as f:
-		f.write(source_code)
+	Every PyInstaller run gets its own work_dir so that concurrent builds do not share ./build.
+	"""
+	return ["--workpath", f"{work_dir}/build", "--specpath", work_dir]
+
+
+def remove_work_dir(work_dir: str):
+	"""Deletes a temp_build/<name> work directory, and temp_build itself once no other build uses it."""
+	shutil.rmtree(work_dir, ignore_errors=True)
+	try:
+		os.rmdir(os.path.dirname(work_dir))
+	except OSError:
+		pass
 
 
-def create_uninstaller_exe():
+def create_uninstaller_exe(artifacts: ArtifactCache | None = None):
 	print("Creating Windows uninstaller executable...")
-	subprocess.run(["pip", "install", "pyinstaller"], check=True)
+	toolchain = get_toolchain()
+
+	output_path = "./installers_output/uninstall.exe"
+	key = get_uninstaller_cache_key("windows", toolchain.versions) if artifacts is not None else None
+	if key is not None and fetch_cached_uninstaller(artifacts, key, "uninstall.exe", output_path):
+		return
 
-	temp_dir = os.path.join(os.getcwd(), "temp_build")
+	start = time.perf_counter()
+	temp_dir = os.path.join(os.getcwd(), "temp_build", "windows")
 	os.makedirs(temp_dir, exist_ok=True)
 
 	try:
-		shutil.copy("templates/uninstall_template.py", os.path.join(temp_dir, "uninstaller.py"))
-		subprocess.run(
+		shutil.copy(UNINSTALLER_TEMPLATE, os.path.join(temp_dir, "uninstaller.py"))
+		toolchain.pyinstaller(
 			[
-				"pyinstaller",
 				"--onefile",
 				"--console",
 				"--name",
 				"uninstall",
 				"--distpath",
 				temp_dir,
+				*pyinstaller_work_args(temp_dir),
 				os.path.join(temp_dir, "uninstaller.py"),
-			],
-			check=True,
+			]
 		)
-		shutil.copy2(os.path.join(temp_dir, "uninstall.exe"), "./installers_output/uninstall.exe")
+		shutil.copy2(os.path.join(temp_dir, "uninstall.exe"), output_path)
 	finally:
-		if os.path.exists("build"):
-			shutil.rmtree("build", ignore_errors=True)
-		for spec_file in glob.glob("uninstall.spec"):
-			os.remove(spec_file)
-		shutil.rmtree(temp_dir, ignore_errors=True)
+		remove_work_dir(temp_dir)
 
+	if key is not None:
+		artifacts.store(key, output_path, "uninstall.exe", time.perf_counter() - start)
 
-def create_uninstaller_elf():
+
+def create_uninstaller_elf(artifacts: ArtifactCache | None = None):
 	print("Creating Linux uninstaller executable...")
-	temp_dir = os.path.join(os.getcwd(), "temp_build")
+	use_wsl = platform.system() == "Windows"
+	toolchain = get_toolchain(wsl=use_wsl)
+
+	output_path = "./installers_output/uninstall"
+	key = get_uninstaller_cache_key("ubuntu", toolchain.versions) if artifacts is not None else None
+	if key is not None and fetch_cached_uninstaller(artifacts, key, "uninstall", output_path):
+		return
+
+	start = time.perf_counter()
+	temp_dir = os.path.join(os.getcwd(), "temp_build", "ubuntu")
 	os.makedirs(temp_dir, exist_ok=True)
 
 	try:
-		shutil.copy("templates/uninstall_template.py", os.path.join(temp_dir, "uninstaller.py"))
-
-		if platform.system() == "Windows":
-			def to_wsl_path(path: str):
-				path = path.replace("\\", "/")
-				if path.startswith("C:") or path.startswith("c:"):
-					path = "/mnt/c" + path[2:]
-				return path
-
-			wsl_temp_dir = to_wsl_path(temp_dir)
-			wsl_output_dir = to_wsl_path(os.path.join(os.getcwd(), "installers_output"))
-			wsl_command = f"""
-			cd "{wsl_temp_dir}"
-			python3 -m venv .venv
-			source .venv/bin/activate
-			pip install pyinstaller
-			pyinstaller --onefile --console --name uninstall --distpath "{wsl_temp_dir}" uninstaller.py
-			cp "{wsl_temp_dir}/uninstall" "{wsl_output_dir}/"
-			"""
-			subprocess.run(["wsl", "-e", "bash", "-c", wsl_command], check=True)
-		else:
-			subprocess.run(["python3", "-m", "pip", "install", "pyinstaller"], check=True)
-			subprocess.run(
-				[
-					"pyinstaller",
-					"--onefile",
-					"--console",
-					"--name",
-					"uninstall",
-					"--distpath",
-					"./installers_output",
-					os.path.join(temp_dir, "uninstaller.py"),
-				],
-				check=True,
-			)
+		shutil.copy(UNINSTALLER_TEMPLATE, os.path.join(temp_dir, "uninstaller.py"))
+
+		# paths as seen by the toolchain, which runs inside WSL on Windows hosts
+		tool_path = to_wsl_path if use_wsl else os.path.abspath
+		toolchain.pyinstaller(
+			[
+				"--onefile",
+				"--console",
+				"--name",
+				"uninstall",
+				"--distpath",
+				tool_path("./installers_output"),
+				*pyinstaller_work_args(tool_path(temp_dir)),
+				tool_path(os.path.join(temp_dir, "uninstaller.py")),
+			]
+		)
 	finally:
-		shutil.rmtree(temp_dir, ignore_errors=True)
-		if os.path.exists("build"):
-			shutil.rmtree("build", ignore_errors=True)
-		for spec_file in glob.glob("uninstall.spec"):
-			os.remove(spec_file)
+		remove_work_dir(temp_dir)
 
+	if key is not None:
+		artifacts.store(key, output_path, "uninstall", time.perf_counter() - start)
+
+
+# Inputs besides the packaged files that are covered by the build fingerprint
+FINGERPRINT_TEMPLATES = ["templates/metaffi_installer_template.py", UNINSTALLER_TEMPLATE, "installer_manifest.json", "toolchain.lock"]
+
+# The uninstaller binaries are rebuilt by every build (PyInstaller output is not byte-identical),
+# so they are fingerprinted through templates/uninstall_template.py instead of by content
+UNINSTALLER_ENTRIES = {"windows": "uninstall.exe", "ubuntu": "uninstall"}
 
-def get_windows_metaffi_files(output_dir: str) -> List[FileEntry]:
-	"""Loads Windows file list from the manifest and resolves against output_dir."""
-	manifest = load_manifest()
-	return resolve_manifest_files(manifest["windows"]["files"], output_dir)
 
+def resolve_installer_files(target: str, output_dir: str, artifact_path: str | None = None) -> Dict[str, List[FileEntry]]:
+	"""Resolves the manifest files of a platform installer listed before ("output") and after ("after_uninstaller") its uninstaller.
 
-def get_ubuntu_metaffi_files(output_dir: str) -> List[FileEntry]:
-	"""Loads Ubuntu file list from the manifest and resolves against output_dir."""
+	The uninstaller is only built once the fingerprint shows that the installer is out of date,
+	so it is added afterwards by installer_files(). If artifact_path is given, the files are
+	resolved through, and recorded in, its lock file (see manifest_lock).
+	"""
+	manifest = load_manifest()[target]
+	entries = manifest["files"]
+	excludes = manifest.get("exclude") or []
+	uninstaller = UNINSTALLER_ENTRIES[target]
+	split = entries.index(uninstaller) if uninstaller in entries else len(entries)
+
+	def resolve() -> Dict[str, List[FileEntry]]:
+		resolver = ManifestResolver(output_dir)
+		return {"output": resolver.resolve(entries[:split], excludes), "after_uninstaller": resolver.resolve(entries[split + 1:], excludes)}
+
+	if artifact_path is None:
+		return resolve()
+	return resolve_locked(artifact_path, {"root": output_dir, "files": entries, "exclude": excludes, "uninstaller": uninstaller}, resolve)
+
+
+def installer_files(resolved: Dict[str, List[FileEntry]], target: str, output_dir: str) -> List[FileEntry]:
+	"""Returns the files of a platform installer in manifest order, with its uninstaller (copied into output_dir by now) in place."""
+	manifest = load_manifest()[target]
+	uninstaller = UNINSTALLER_ENTRIES[target]
+	files = list(resolved["output"])
+	if uninstaller in manifest["files"]:
+		files += ManifestResolver(output_dir).resolve([uninstaller], manifest.get("exclude") or [])
+	return files + resolved["after_uninstaller"]
+
+
+def installer_fingerprint(target: str, version: str, config: str, files: Dict[str, List[FileEntry]], shared_files: str | None = None) -> dict:
+	"""Fingerprints everything that goes into a platform installer (see build_fingerprint).
+
+	files are the resolved files by group (see resolve_installer_files); the uninstaller is left out.
+	shared_files is the SHA-256 of the shared files archive of a deduplicated payload (see build_release --dedup).
+	"""
 	manifest = load_manifest()
-	return resolve_manifest_files(manifest["ubuntu"]["files"], output_dir)
+	files = [f for group in files.values() for f in group if f.arcname != UNINSTALLER_ENTRIES[target]]
+	settings = {"target": target, "version": version, "config": config, "engine_format": ENGINE_FORMAT, "member_date_time": member_date_time(),
+				"strip": strip_settings(manifest.get("strip", [])), "shared_files": shared_files}
+	return compute_fingerprint([(f.src, f.arcname) for f in files], FINGERPRINT_TEMPLATES, settings)
+
+
+def core_zip_fingerprint(target: str, version: str, core_zip: str) -> dict:
+	"""Fingerprints a platform installer built from a core zip (see core_zip_payload_sections)."""
+	settings = {"target": target, "version": version, "core_zip": True, "member_date_time": member_date_time(),
+				"strip": strip_settings(load_manifest().get("strip", []))}
+	inputs = [(os.path.abspath(core_zip), os.path.basename(core_zip))]
+	shared_archive = core_zip_shared_archive(core_zip)
+	if shared_archive is not None:
+		inputs.append((shared_archive, os.path.basename(shared_archive)))
+	return compute_fingerprint(inputs, FINGERPRINT_TEMPLATES, settings)
 
 
-def create_windows_exe(output_file_py: str, output_name: str):
+def create_windows_exe(output_file_py: str, output_name: str, payload_path: str):
 	print("Creating Windows executable...")
-	subprocess.run(["pip", "install", "pyinstaller"], check=True)
-	subprocess.run(
-		[
-			"pyinstaller",
-			"--onefile",
-			"--console",
-			"--name",
-			output_name,
-			"--distpath",
-			"./installers_output",
-			output_file_py,
-		],
-		check=True,
-	)
-	if os.path.exists("build"):
-		shutil.rmtree("build", ignore_errors=True)
-	for spec_file in glob.glob("metaffi-installer-*.spec"):
-		os.remove(spec_file)
-	for spec_file in glob.glob(f"{output_name}.spec"):
-		os.remove(spec_file)
+	toolchain = get_toolchain()
+	work_dir = os.path.abspath(os.path.join("temp_build", output_name))
+	try:
+		toolchain.pyinstaller(
+			[
+				"--onefile",
+				"--console",
+				"--add-data",
+				f"{os.path.abspath(payload_path)};.",
+				"--name",
+				output_name,
+				"--distpath",
+				"./installers_output",
+				*pyinstaller_work_args(work_dir),
+				os.path.abspath(output_file_py),
+			]
+		)
+	finally:
+		remove_work_dir(work_dir)
 
 
-def create_linux_executable(output_file_py: str, output_name: str):
+def create_linux_executable(output_file_py: str, output_name: str, payload_path: str):
 	print("Creating Linux executable...")
-	if platform.system() == "Windows":
-		if os.path.isabs(output_file_py):
-			output_file_py = output_file_py[0].lower() + output_file_py[1:]
-			output_file_py = output_file_py.replace(":", "").replace("\\", "/")
-			output_file_py = "/mnt/" + output_file_py
-
-		wsl_command = """
-		python3 -m venv .venv
-		source .venv/bin/activate
-		pip install pyinstaller pycrosskit python-dotenv distro
-		pyinstaller --onefile --console --hidden-import pycrosskit --hidden-import pycrosskit.envariables --hidden-import python-dotenv --hidden-import dotenv --hidden-import distro --name {} --distpath ./installers_output {}
-		""".format(
-			output_name, output_file_py
-		)
-		subprocess.run(["wsl", "-e", "bash", "-c", wsl_command], check=True)
-	else:
-		subprocess.run(["python3", "-m", "pip", "install", "pyinstaller", "pycrosskit", "python-dotenv", "distro"], check=True)
-		subprocess.run(
+	use_wsl = platform.system() == "Windows"
+	toolchain = get_toolchain(wsl=use_wsl)
+	work_dir = os.path.abspath(os.path.join("temp_build", output_name))
+
+	# paths as seen by the toolchain, which runs inside WSL on Windows hosts
+	tool_path = to_wsl_path if use_wsl else os.path.abspath
+	try:
+		toolchain.pyinstaller(
 			[
-				"pyinstaller",
 				"--onefile",
 				"--console",
+				"--add-data",
+				f"{tool_path(payload_path)}:.",
 				"--hidden-import",
 				"pycrosskit",
 				"--hidden-import",
@@ -330,16 +451,13 @@ def create_linux_executable(output_file_py: str, output_name: str):
 				"--name",
 				output_name,
 				"--distpath",
-				"./installers_output",
-				output_file_py,
-			],
-			check=True,
+				tool_path("./installers_output"),
+				*pyinstaller_work_args(tool_path(work_dir)),
+				tool_path(output_file_py),
+			]
 		)
-
-	if os.path.exists("build"):
-		shutil.rmtree("build", ignore_errors=True)
-	for spec_file in glob.glob(f"{output_name}.spec"):
-		os.remove(spec_file)
+	finally:
+		remove_work_dir(work_dir)
 
 
 def cleanup_temp_files(*paths: str):
@@ -348,76 +466,167 @@ def cleanup_temp_files(*paths: str):
 			os.remove(p)
 
 
-def build_windows_installer(version: str, output_name: str | None, config: str):
-	output_dir = get_output_dir("windows", config)
+def build_windows_installer(version: str, output_name: str | None, config: str, workers: int | None = None, cache: CompressionCache | None = None,
+							force: bool = False, artifacts: ArtifactCache | None = None, core_zip: str | None = None):
+	"""Builds the Windows installer, from the output directory or, if core_zip is given, from the members of that core zip."""
 	os.makedirs("./installers_output", exist_ok=True)
 
-	create_uninstaller_exe()
-	shutil.copy2("./installers_output/uninstall.exe", output_dir)
-
-	windows_files = get_windows_metaffi_files(output_dir)
-	windows_zip = zip_installer_files(windows_files, output_dir)
-
-	output_file_py = "./installers_output/metaffi_installer_windows.py"
-	shutil.copy("templates/metaffi_installer_template.py", output_file_py)
-	create_installer_file(output_file_py, windows_zip, b"", version)
-
 	if output_name is None or output_name == "":
 		output_name = f"metaffi-installer-{version}-windows"
+	artifact_path = f"./installers_output/{output_name}.exe"
 
-	create_windows_exe(output_file_py, output_name)
-	cleanup_temp_files(output_file_py, "./installers_output/uninstall.exe")
-	return f"./installers_output/{output_name}.exe"
+	if core_zip is not None:
+		fingerprint = core_zip_fingerprint("windows", version, core_zip)
+	else:
+		output_dir = get_output_dir("windows", config)
+		resolved = resolve_installer_files("windows", output_dir, artifact_path)
+		fingerprint = installer_fingerprint("windows", version, config, resolved)
+	if report_up_to_date(artifact_path, fingerprint, force):
+		return artifact_path
+
+	if core_zip is not None:
+		sections = core_zip_payload_sections(core_zip, "windows", artifact_path)
+	else:
+		create_uninstaller_exe(artifacts)
+		shutil.copy2("./installers_output/uninstall.exe", output_dir)
 
+		windows_files = installer_files(resolved, "windows", output_dir)
+		sections = [("windows_x64", zip_installer_files(windows_files, output_dir, workers, cache, artifact_path=artifact_path))]
 
-def build_ubuntu_installer(version: str, output_name: str | None, config: str):
-	output_dir = get_output_dir("ubuntu", config)
-	os.makedirs("./installers_output", exist_ok=True)
+	payload_path = write_installer_payload("./installers_output/payload_windows", sections)
+	for _, stream in sections:
+		stream.close()
+	print_peak_rss("windows payload")
 
-	create_uninstaller_elf()
-	shutil.copy2("./installers_output/uninstall", output_dir)
+	output_file_py = "./installers_output/metaffi_installer_windows.py"
+	create_installer_file(output_file_py, version)
 
-	ubuntu_files = get_ubuntu_metaffi_files(output_dir)
-	ubuntu_zip = zip_installer_files(ubuntu_files, output_dir)
+	create_windows_exe(output_file_py, output_name, payload_path)
+	cleanup_temp_files(output_file_py, payload_path, "./installers_output/uninstall.exe")
+	save_fingerprint(artifact_path, fingerprint)
+	return artifact_path
 
-	output_file_py = "./installers_output/metaffi_installer_ubuntu.py"
-	shutil.copy("templates/metaffi_installer_template.py", output_file_py)
-	create_installer_file(output_file_py, b"", ubuntu_zip, version)
+
+def build_ubuntu_installer(version: str, output_name: str | None, config: str, workers: int | None = None, cache: CompressionCache | None = None,
+						   force: bool = False, artifacts: ArtifactCache | None = None, core_zip: str | None = None):
+	"""Builds the Ubuntu installer, from the output directory or, if core_zip is given, from the members of that core zip."""
+	os.makedirs("./installers_output", exist_ok=True)
 
 	if output_name is None or output_name == "":
 		ubuntu_tag = get_ubuntu_version_tag()
 		output_name = f"metaffi-installer-{version}-ubuntu-{ubuntu_tag}"
+	artifact_path = f"./installers_output/{output_name}"
+
+	if core_zip is not None:
+		fingerprint = core_zip_fingerprint("ubuntu", version, core_zip)
+	else:
+		output_dir = get_output_dir("ubuntu", config)
+		resolved = resolve_installer_files("ubuntu", output_dir, artifact_path)
+		fingerprint = installer_fingerprint("ubuntu", version, config, resolved)
+	if report_up_to_date(artifact_path, fingerprint, force):
+		return artifact_path
+
+	if core_zip is not None:
+		sections = core_zip_payload_sections(core_zip, "ubuntu", artifact_path)
+	else:
+		create_uninstaller_elf(artifacts)
+		shutil.copy2("./installers_output/uninstall", output_dir)
 
-	create_linux_executable(output_file_py, output_name)
-	cleanup_temp_files(output_file_py, "./installers_output/uninstall")
-	return f"./installers_output/{output_name}"
+		ubuntu_files = installer_files(resolved, "ubuntu", output_dir)
+		sections = [("ubuntu_x64", zip_installer_files(ubuntu_files, output_dir, workers, cache, artifact_path=artifact_path))]
 
+	payload_path = write_installer_payload("./installers_output/payload_ubuntu", sections)
+	for _, stream in sections:
+		stream.close()
+	print_peak_rss("ubuntu payload")
 
-def build_all_installers(version: str, config: str):
-	windows_output_dir = get_output_dir("windows", config)
-	ubuntu_output_dir = get_output_dir("ubuntu", config)
-	os.makedirs("./installers_output", exist_ok=True)
+	output_file_py = "./installers_output/metaffi_installer_ubuntu.py"
+	create_installer_file(output_file_py, version)
 
-	create_uninstaller_exe()
-	create_uninstaller_elf()
+	create_linux_executable(output_file_py, output_name, payload_path)
+	cleanup_temp_files(output_file_py, payload_path, "./installers_output/uninstall")
+	save_fingerprint(artifact_path, fingerprint)
+	return artifact_path
 
-	shutil.copy2("./installers_output/uninstall.exe", windows_output_dir)
-	shutil.copy2("./installers_output/uninstall", ubuntu_output_dir)
 
-	windows_files = get_windows_metaffi_files(windows_output_dir)
-	ubuntu_files = get_ubuntu_metaffi_files(ubuntu_output_dir)
+# Per-platform steps of the installer pipeline:
+# (uninstaller builder, uninstaller file name, payload section, executable builder)
+PLATFORM_PIPELINES = {
+	"windows": (create_uninstaller_exe, "uninstall.exe", "windows_x64", create_windows_exe),
+	"ubuntu": (create_uninstaller_elf, "uninstall", "ubuntu_x64", create_linux_executable),
+}
 
-	windows_zip = zip_installer_files(windows_files, windows_output_dir)
-	ubuntu_zip = zip_installer_files(ubuntu_files, ubuntu_output_dir)
 
-	output_file_py = "./installers_output/metaffi_installer.py"
-	shutil.copy("templates/metaffi_installer_template.py", output_file_py)
-	create_installer_file(output_file_py, windows_zip, ubuntu_zip, version)
+def add_platform_stages(scheduler: StageScheduler, target: str, version: str, config: str, output_name: str, artifact_path: str,
+						workers: int | None, cache: CompressionCache | None, force: bool, artifacts: ArtifactCache | None):
+	"""Adds the resolve -> uninstaller -> compress -> executable stages of one platform to scheduler.
+
+	The resolve stage resolves and fingerprints the installer files (see resolve_installer_files);
+	if the installer is up to date, it stops the chain and the other stages are skipped.
+	"""
+	create_uninstaller, uninstaller_name, section_name, create_executable = PLATFORM_PIPELINES[target]
+	output_dir = get_output_dir(target, config)
+
+	def resolve() -> Tuple[Dict[str, List[FileEntry]], dict]:
+		resolved = resolve_installer_files(target, output_dir, artifact_path)
+		fingerprint = installer_fingerprint(target, version, config, resolved)
+		if report_up_to_date(artifact_path, fingerprint, force):
+			raise StopChain()
+		return resolved, fingerprint
+
+	def build_uninstaller(_):
+		create_uninstaller(artifacts)
+		shutil.copy2(f"./installers_output/{uninstaller_name}", output_dir)
+
+	def compress(resolution, _) -> str:
+		files = installer_files(resolution[0], target, output_dir)
+		payload_zip = zip_installer_files(files, output_dir, workers, cache, artifact_path=artifact_path)
+		payload_path = write_installer_payload(f"./installers_output/payload_{target}", [(section_name, payload_zip)])
+		payload_zip.close()
+		print_peak_rss(f"{target} payload")
+		return payload_path
+
+	def build_executable(resolution, payload_path: str):
+		output_file_py = f"./installers_output/metaffi_installer_{target}.py"
+		create_installer_file(output_file_py, version)
+		create_executable(output_file_py, output_name, payload_path)
+		cleanup_temp_files(output_file_py, payload_path, f"./installers_output/{uninstaller_name}")
+		save_fingerprint(artifact_path, resolution[1])
+
+	scheduler.add(f"{target}:resolve", resolve)
+	scheduler.add(f"{target}:uninstaller", build_uninstaller, [f"{target}:resolve"])
+	scheduler.add(f"{target}:compress", compress, [f"{target}:resolve", f"{target}:uninstaller"])
+	scheduler.add(f"{target}:executable", build_executable, [f"{target}:resolve", f"{target}:compress"])
+
+
+def build_all_installers(version: str, config: str, workers: int | None = None, cache: CompressionCache | None = None, force: bool = False,
+						artifacts: ArtifactCache | None = None):
+	"""Builds the Windows and Ubuntu installers.
+
+	The two platform pipelines are independent and run concurrently as a stage graph
+	(see build_scheduler); a per-stage timeline is printed at the end.
+	"""
+	os.makedirs("./installers_output", exist_ok=True)
 
 	ubuntu_tag = get_ubuntu_version_tag()
-	create_windows_exe(output_file_py, f"metaffi-installer-{version}-windows")
-	create_linux_executable(output_file_py, f"metaffi-installer-{version}-ubuntu-{ubuntu_tag}")
-	cleanup_temp_files(output_file_py, "./installers_output/uninstall.exe", "./installers_output/uninstall")
+	output_names = {
+		"windows": f"metaffi-installer-{version}-windows",
+		"ubuntu": f"metaffi-installer-{version}-ubuntu-{ubuntu_tag}",
+	}
+	artifact_paths = {
+		"windows": f"./installers_output/{output_names['windows']}.exe",
+		"ubuntu": f"./installers_output/{output_names['ubuntu']}",
+	}
+
+	scheduler = StageScheduler(workers=len(PLATFORM_PIPELINES))
+	for target in PLATFORM_PIPELINES:
+		add_platform_stages(scheduler, target, version, config, output_names[target], artifact_paths[target],
+							workers, cache, force, artifacts)
+
+	try:
+		scheduler.run()
+	finally:
+		scheduler.print_timeline()
 
 
 def prompt_choice(prompt_text: str, flag: str, choices: list[str], default: str | None = None) -> str:
@@ -476,6 +685,7 @@ def main():
   %(prog)s --target windows --config Debug
   %(prog)s --target ubuntu --config Release --version 1.0.0
   %(prog)s --target all --config Debug
+  %(prog)s --target ubuntu --from-core-zip installers_output/metaffi-core-1.0.0-Release-ubuntu.zip
   %(prog)s                                    (interactive prompts)"""
 	)
 	parser.add_argument("--target", choices=["all", "windows", "ubuntu"], default=None,
@@ -486,7 +696,26 @@ def main():
 						help="Build configuration: Debug or Release (default: Debug)")
 	parser.add_argument("--output-name", default=None,
 						help="Output installer name without extension (default: auto-generated)")
+	parser.add_argument("--jobs", type=int, default=None,
+						help=f"Number of compression worker threads (default: {default_workers()})")
+	parser.add_argument("--force", action="store_true",
+						help="Rebuild even if the stored input fingerprint matches (see build_fingerprint.py)")
+	parser.add_argument("--from-core-zip", default=None, metavar="ZIP",
+						help="Build the payload from the members of a core zip (see build_core_zip.py), copied without recompressing, instead of from the output directory; "
+							 "a deduplicated core zip needs its metaffi-shared-*.zip next to it")
+	add_cache_arguments(parser)
+	add_toolchain_arguments(parser)
+	add_determinism_arguments(parser, check=False)
+	add_profile_arguments(parser)
+	add_size_report_arguments(parser)
+	add_strip_arguments(parser)
+	add_lock_arguments(parser)
 	args = parser.parse_args()
+	configure_toolchain(args)
+	configure_determinism(args)
+	configure_size_report(args)
+	configure_strip(args)
+	configure_lock(args)
 
 	# Prompt for any missing switches
 	target = args.target if args.target is not None else prompt_choice(
@@ -497,7 +726,15 @@ def main():
 		"Enter version", "--version", default=METAFFI_VERSION
 	)
 
-	config = args.config if args.config is not None else prompt_choice(
+	if args.from_core_zip is not None:
+		if target == "all":
+			parser.error("--from-core-zip takes a single --target")
+		if not os.path.isfile(args.from_core_zip):
+			parser.error(f"core zip not found: {args.from_core_zip}")
+		args.from_core_zip = os.path.abspath(args.from_core_zip)
+
+	# the configuration only selects the output directory, which a core zip replaces
+	config = args.config if args.config is not None or args.from_core_zip is not None else prompt_choice(
 		"Select build configuration:", "--config", ["Debug", "Release"], default="Debug"
 	)
 
@@ -511,19 +748,37 @@ def main():
 		if raw and raw.lower() != "auto":
 			output_name = raw
 
-	# Build
+	cache = cache_from_args(args)
+	artifacts = artifact_cache_from_args(args)
+
+	# the phase profile is written next to the installers, also when the build fails
+	configure_profile(args, f"build_installer {target}")
+	try:
+		build_target(target, version, config, output_name, args, cache, artifacts)
+	finally:
+		finish_profile(f"./installers_output/{output_name or f'metaffi-installer-{version}-{target}'}")
+
+
+def build_target(target: str, version: str, config: str, output_name: str | None, args: argparse.Namespace, cache: CompressionCache | None,
+		  artifacts: ArtifactCache | None):
 	if target == "all":
-		build_all_installers(version, config)
+		build_all_installers(version, config, args.jobs, cache, args.force, artifacts)
+		if cache is not None:
+			cache.finish()
 		print("Done")
 		return
 
 	if target == "windows":
-		output = build_windows_installer(version, output_name, config)
+		output = build_windows_installer(version, output_name, config, args.jobs, cache, args.force, artifacts, args.from_core_zip)
+		if cache is not None:
+			cache.finish()
 		print(f"Done. Built: {os.path.abspath(output)}")
 		return
 
 	if target == "ubuntu":
-		output = build_ubuntu_installer(version, output_name, config)
+		output = build_ubuntu_installer(version, output_name, config, args.jobs, cache, args.force, artifacts, args.from_core_zip)
+		if cache is not None:
+			cache.finish()
 		print(f"Done. Built: {os.path.abspath(output)}")
 		return
 
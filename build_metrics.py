@@ -0,0 +1,291 @@
+"""
+Lightweight resource measurements shared by the installer builders.
+
+Builders wrap their named phases (manifest resolution, compression, template rendering,
+PyInstaller, ...) in `with phase(name) as record:`. While a profile is active (see
+configure_profile) each phase records its wall time, CPU time (of the process and its
+finished child processes, so PyInstaller runs are included), the bytes it read and wrote
+and the peak RSS of the process while it ran, sampled every RSS_SAMPLE_SECONDS by a
+background thread (where the current RSS cannot be read, as on macOS, the process-lifetime
+peak at the end of the phase). finish_profile() writes the phases next to
+the artifact as <artifact>.profile.json and as <artifact>.trace.json, a Chrome trace
+(open in chrome://tracing or https://ui.perfetto.dev). Without an active profile,
+phase() records nothing.
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+from dataclasses import asdict, dataclass, field
+from typing import Iterator, List
+
+
+def _process_memory_counters():
+	"""Returns the PROCESS_MEMORY_COUNTERS of the current process (Windows only), or None."""
+	import ctypes
+	from ctypes import wintypes
+
+	class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+		_fields_ = [
+			("cb", wintypes.DWORD),
+			("PageFaultCount", wintypes.DWORD),
+			("PeakWorkingSetSize", ctypes.c_size_t),
+			("WorkingSetSize", ctypes.c_size_t),
+			("QuotaPeakPagedPoolUsage", ctypes.c_size_t),
+			("QuotaPagedPoolUsage", ctypes.c_size_t),
+			("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+			("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+			("PagefileUsage", ctypes.c_size_t),
+			("PeakPagefileUsage", ctypes.c_size_t),
+		]
+
+	counters = PROCESS_MEMORY_COUNTERS()
+	counters.cb = ctypes.sizeof(counters)
+	handle = ctypes.windll.kernel32.GetCurrentProcess()
+	if not ctypes.windll.psapi.GetProcessMemoryInfo(handle, ctypes.byref(counters), counters.cb):
+		return None
+	return counters
+
+
+def get_peak_rss_bytes() -> int:
+	"""Returns the peak resident set size of the current process in bytes.
+
+	Uses getrusage() on POSIX and GetProcessMemoryInfo() on Windows.
+	Returns 0 if the value cannot be determined.
+	"""
+	try:
+		if sys.platform == "win32":
+			counters = _process_memory_counters()
+			return int(counters.PeakWorkingSetSize) if counters is not None else 0
+
+		import resource
+		peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+		# ru_maxrss is in bytes on macOS and in kilobytes on Linux
+		if sys.platform == "darwin":
+			return int(peak)
+		return int(peak) * 1024
+	except Exception as e:
+		print(f"Warning: could not read peak RSS: {e}")
+		return 0
+
+
+def get_rss_bytes() -> int:
+	"""Returns the current resident set size of the current process in bytes.
+
+	Reads /proc/self/statm on Linux and uses GetProcessMemoryInfo() on Windows.
+	Returns 0 elsewhere or if the value cannot be determined.
+	"""
+	try:
+		if sys.platform == "win32":
+			counters = _process_memory_counters()
+			return int(counters.WorkingSetSize) if counters is not None else 0
+		if sys.platform.startswith("linux"):
+			with open("/proc/self/statm", "rb") as f:
+				return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+	except Exception:
+		pass
+	return 0
+
+
+def format_bytes(size: int) -> str:
+	"""Formats a byte count as a short human-readable string (e.g. '12.3 MB')."""
+	if abs(size) < 1024:
+		return f"{size:,} B"
+
+	value = float(size)
+	for unit in ("KB", "MB", "GB"):
+		value /= 1024
+		if abs(value) < 1024:
+			break
+	return f"{value:,.1f} {unit}"
+
+
+def print_peak_rss(label: str = "build"):
+	"""Prints the peak RSS of the current process, for build logs."""
+	print(f"Peak RSS ({label}): {format_bytes(get_peak_rss_bytes())} (pid {os.getpid()})")
+
+
+PROFILE_SUFFIX = ".profile.json"
+TRACE_SUFFIX = ".trace.json"
+
+# Interval at which the RSS of open phases is sampled
+RSS_SAMPLE_SECONDS = 0.01
+
+
+@dataclass
+class PhaseRecord:
+	"""Measurements of one phase of a build. Code inside the phase may set bytes_in, bytes_out and args."""
+	name: str
+	thread: str
+	start_seconds: float = 0.0
+	wall_seconds: float = 0.0
+	cpu_seconds: float = 0.0
+	bytes_in: int = 0
+	bytes_out: int = 0
+	peak_rss_bytes: int = 0
+	args: dict = field(default_factory=dict)
+
+
+def _cpu_seconds() -> float:
+	"""Returns the CPU time of this process and of its child processes that have finished."""
+	times = os.times()
+	return times.user + times.system + times.children_user + times.children_system
+
+
+class BuildProfile:
+	"""Collects the phases of one build run. Phases may run concurrently on several threads."""
+
+	def __init__(self, name: str):
+		self.name = name
+		self.started_at = time.time()
+		self.phases: List[PhaseRecord] = []
+		self._start = time.perf_counter()
+		self._cpu_start = _cpu_seconds()
+		self._lock = threading.Lock()
+		self._open: List[PhaseRecord] = []
+		self._stop_sampling = threading.Event()
+		self._sampler: threading.Thread | None = None
+
+	def _sample_rss(self):
+		"""Raises the peak RSS of every open phase to the current RSS."""
+		rss = get_rss_bytes()
+		with self._lock:
+			for record in self._open:
+				record.peak_rss_bytes = max(record.peak_rss_bytes, rss)
+
+	def _run_sampler(self):
+		while not self._stop_sampling.wait(RSS_SAMPLE_SECONDS):
+			self._sample_rss()
+
+	def _start_sampler(self):
+		with self._lock:
+			if self._sampler is None and get_rss_bytes():
+				self._sampler = threading.Thread(target=self._run_sampler, name="rss-sampler", daemon=True)
+				self._sampler.start()
+
+	def close(self):
+		"""Stops the RSS sampler."""
+		self._stop_sampling.set()
+		if self._sampler is not None:
+			self._sampler.join()
+
+	@contextlib.contextmanager
+	def phase(self, name: str, bytes_in: int = 0, **args) -> Iterator[PhaseRecord]:
+		record = PhaseRecord(name=name, thread=threading.current_thread().name, bytes_in=bytes_in, args=args)
+		start = time.perf_counter()
+		cpu_start = _cpu_seconds()
+		record.start_seconds = start - self._start
+		self._start_sampler()
+		with self._lock:
+			self._open.append(record)
+		self._sample_rss()
+		try:
+			yield record
+		except BaseException as e:
+			record.args["error"] = f"{type(e).__name__}: {e}"
+			raise
+		finally:
+			record.wall_seconds = time.perf_counter() - start
+			record.cpu_seconds = _cpu_seconds() - cpu_start
+			self._sample_rss()
+			with self._lock:
+				self._open.remove(record)
+				if self._sampler is None:
+					record.peak_rss_bytes = get_peak_rss_bytes()
+				self.phases.append(record)
+
+	def report(self) -> dict:
+		"""Returns the JSON report: totals of the run and every phase in start order."""
+		return {
+			"name": self.name,
+			"started_at": self.started_at,
+			"wall_seconds": time.perf_counter() - self._start,
+			"cpu_seconds": _cpu_seconds() - self._cpu_start,
+			"peak_rss_bytes": get_peak_rss_bytes(),
+			"phases": [asdict(phase) for phase in sorted(self.phases, key=lambda p: p.start_seconds)],
+		}
+
+	def chrome_trace(self) -> dict:
+		"""Returns the phases in the Chrome trace event format, one track per thread."""
+		threads = {name: tid for tid, name in enumerate(dict.fromkeys(p.thread for p in sorted(self.phases, key=lambda p: p.start_seconds)), 1)}
+		pid = os.getpid()
+		events = [{"name": "process_name", "ph": "M", "pid": pid, "tid": 0, "args": {"name": self.name}}]
+		events += [{"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": name}} for name, tid in threads.items()]
+		for p in self.phases:
+			events.append({
+				"name": p.name,
+				"cat": self.name,
+				"ph": "X",
+				"pid": pid,
+				"tid": threads[p.thread],
+				"ts": round(p.start_seconds * 1e6),
+				"dur": round(p.wall_seconds * 1e6),
+				"args": {"cpu_seconds": round(p.cpu_seconds, 3), "bytes_in": p.bytes_in, "bytes_out": p.bytes_out,
+						 "peak_rss_bytes": p.peak_rss_bytes, **p.args},
+			})
+		return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+	def write(self, artifact_path: str) -> tuple[str, str]:
+		"""Writes <artifact>.profile.json and <artifact>.trace.json and returns their paths."""
+		report_path = artifact_path + PROFILE_SUFFIX
+		trace_path = artifact_path + TRACE_SUFFIX
+		os.makedirs(os.path.dirname(os.path.abspath(report_path)), exist_ok=True)
+		with open(report_path, "w") as f:
+			json.dump(self.report(), f, indent=2)
+			f.write("\n")
+		with open(trace_path, "w") as f:
+			json.dump(self.chrome_trace(), f)
+		return report_path, trace_path
+
+	def print_summary(self):
+		"""Prints one line per phase, in start order."""
+		report = self.report()
+		print(f"\nBuild profile ({self.name}): {report['wall_seconds']:.1f}s wall, {report['cpu_seconds']:.1f}s CPU, "
+			  f"peak RSS {format_bytes(report['peak_rss_bytes'])}")
+		width = max((len(p["name"]) for p in report["phases"]), default=0)
+		for p in report["phases"]:
+			print(f"  {p['name']:<{width}}  {p['wall_seconds']:8.2f}s wall  {p['cpu_seconds']:8.2f}s CPU  "
+				  f"in {format_bytes(p['bytes_in']):>10}  out {format_bytes(p['bytes_out']):>10}  peak {format_bytes(p['peak_rss_bytes'])}")
+
+
+_profile: BuildProfile | None = None
+
+
+@contextlib.contextmanager
+def phase(name: str, bytes_in: int = 0, **args) -> Iterator[PhaseRecord]:
+	"""Measures a named phase into the active profile; a no-op when no profile is active."""
+	profile = _profile
+	if profile is None:
+		yield PhaseRecord(name=name, thread="", bytes_in=bytes_in, args=args)
+		return
+	with profile.phase(name, bytes_in, **args) as record:
+		yield record
+
+
+def add_profile_arguments(parser: argparse.ArgumentParser):
+	"""Adds the --no-profile switch shared by the builders."""
+	parser.add_argument("--no-profile", action="store_true",
+						help=f"Do not write the phase timing report (<artifact>{PROFILE_SUFFIX}) and Chrome trace (<artifact>{TRACE_SUFFIX})")
+
+
+def configure_profile(args: argparse.Namespace, name: str):
+	"""Starts profiling the phases of this run unless --no-profile was given."""
+	global _profile
+	_profile = None if args.no_profile else BuildProfile(name)
+
+
+def finish_profile(artifact_path: str):
+	"""Prints the active profile and writes it next to artifact_path, then stops profiling."""
+	global _profile
+	profile = _profile
+	_profile = None
+	if profile is None:
+		return
+	profile.close()
+	profile.print_summary()
+	report_path, trace_path = profile.write(artifact_path)
+	print(f"Profile: {report_path}, trace: {trace_path}")
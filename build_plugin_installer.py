@@ -2,30 +2,65 @@
 Build a plugin installer zip from a lang-plugin-* directory.
 
 Usage:
-  python build_plugin_installer.py --plugin <path-to-lang-plugin-dir> --target <windows|ubuntu> [--config <Debug|Release>] [--version <version>] [--output-dir <path>]
+  python build_plugin_installer.py --plugin <path-to-lang-plugin-dir> --target <windows|ubuntu> [--config <Debug|Release>] [--version <version>] [--output-dir <path>] [--jobs <n>] [--deterministic] [--check-reproducible] [--auto-tune] [--installer-script] [--no-profile] [--size-budget <file>] [--accept-size-growth] [--strip] [--relock]
+
+Batch mode: --plugin and --target accept several values; every plugin is built for every
+target in one process, up to --plugin-jobs at a time, followed by a combined summary.
+  python build_plugin_installer.py --plugin <dir> <dir> ... --target windows ubuntu [--plugin-jobs <n>]
+
+Directories matching the component patterns of plugin_manifest.json's "exclude" list (and
+__pycache__) are not walked at all. "size_limits" leaves out files above a size, first matching
+rule wins (patterns as in "compression"):
+  "size_limits": [{ "pattern": "*.log", "max_bytes": 1048576 }]
 
 Output:
   installers_output/metaffi-plugin-<name>-<version>-<platform>.zip
+  installers_output/metaffi-plugin-<name>-<version>-<platform>-installer.py (with --installer-script)
+  installers_output/metaffi-plugin-<name>-<version>-<platform>.zip.profile.json and .trace.json (phase timings;
+  installers_output/metaffi-plugin-batch.profile.json and .trace.json in batch mode)
+  installers_output/metaffi-plugin-<name>-<version>-<platform>.zip.sizes.json (size report, see size_report.py)
+  installers_output/metaffi-plugin-<name>-<version>-<platform>.zip.lock.json (resolved files and digests, see manifest_lock.py)
+  installers_output/metaffi-debug-plugin-<name>-<version>-<platform>.zip (with --strip, the "strip" patterns of plugin_manifest.json; see debug_split.py)
 """
 
 import argparse
-import glob
+import fnmatch
 import json
 import os
 import shutil
 import sys
-import zipfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+from build_metrics import add_profile_arguments, configure_profile, finish_profile
+from compression_cache import CompressionCache, add_cache_arguments, cache_from_args
+from compression_policy import CompressionPolicy, auto_tune, write_manifest_policy
+from debug_split import add_strip_arguments, configure_strip, strip_package_entries
+from manifest_lock import add_installed_lock, add_lock_arguments, configure_lock, resolve_locked
+from manifest_resolver import ManifestResolver, ResolvedFile, is_excluded
+from packaging_engine import PackageEntry, add_determinism_arguments, check_reproducible, configure_determinism, default_workers, write_zip
+from size_report import add_size_report_arguments, configure_size_report, report_archive_sizes
+from template_renderer import Base64Value, render_template
+
+
+# Compiled Python caches are never packaged
+PLUGIN_EXCLUDES = ['__pycache__', '*.pyc']
+
+PLUGIN_INSTALLER_TEMPLATE = os.path.join('templates', 'metaffi_plugin_installer_template.py')
 
 
 class PluginInstallerBuilder:
 	"""Reads a plugin manifest and packages the plugin into a distributable zip."""
 
-	def __init__(self, plugin_dir: str, target: str, config: str, version_override: str | None, output_dir_override: str | None, build_type: str | None = None):
+	def __init__(self, plugin_dir: str, target: str, config: str, version_override: str | None, output_dir_override: str | None, build_type: str | None = None, workers: int | None = None, cache: CompressionCache | None = None):
 		self.plugin_dir = os.path.abspath(plugin_dir)
 		self.install_dir = os.path.join(self.plugin_dir, 'install')
 		self.target = target
 		self.config = config
 		self.build_type = build_type
+		self.workers = workers
+		self.cache = cache
 
 		# Load and validate the manifest (lives under install/)
 		manifest_path = os.path.join(self.install_dir, 'plugin_manifest.json')
@@ -35,7 +70,12 @@ class PluginInstallerBuilder:
 		with open(manifest_path, 'r') as f:
 			self.manifest = json.load(f)
 
+		self.manifest_path = manifest_path
 		self.plugin_name = self.manifest['name']
+		self.compression_policy = CompressionPolicy.from_manifest(self.manifest)
+		self.excludes = PLUGIN_EXCLUDES + self.manifest.get('exclude', [])
+		self.size_limits = self.manifest.get('size_limits', [])
+		self.resolvers: list[ManifestResolver] = []
 		self.version = version_override or self.manifest.get('version', '0.0.0')
 
 		# Determine the build output base directory
@@ -51,146 +91,349 @@ class PluginInstallerBuilder:
 		if not os.path.isdir(self.output_dir):
 			raise FileNotFoundError(f"Plugin output directory not found: {self.output_dir}")
 
-	def _resolve_output_globs(self) -> list[tuple[str, str]]:
+	def _resolver(self, root: str) -> ManifestResolver:
+		"""A resolver for root that does not descend into excluded directories, counted in the walk report."""
+		resolver = ManifestResolver(root, prune=[pattern for pattern in self.excludes if '/' not in pattern])
+		self.resolvers.append(resolver)
+		return resolver
+
+	def _within_size_limit(self, file: ResolvedFile) -> bool:
+		"""Returns False, with a warning, for files larger than the first size_limits rule matching them."""
+		for rule in self.size_limits:
+			name = file.arcname if '/' in rule['pattern'] else file.arcname.rsplit('/', 1)[-1]
+			if fnmatch.fnmatchcase(name, rule['pattern']):
+				if file.size <= rule['max_bytes']:
+					return True
+				print(f"  WARNING: skipping {file.arcname} ({file.size:,} bytes), above the size limit of '{rule['pattern']}' ({rule['max_bytes']:,} bytes)")
+				return False
+		return True
+
+	def _resolve_output_globs(self) -> list[ResolvedFile]:
 		"""Resolve files.<platform> glob patterns against the CMake output dir.
 
-		Returns list of (arcname, absolute_path) tuples.
+		Archive names are relative to the output dir.
 		"""
 		platform_key = self.target
 		patterns = self.manifest.get('files', {}).get(platform_key, [])
 		if not patterns:
 			raise ValueError(f"No files listed for platform '{platform_key}' in manifest")
 
-		results: list[tuple[str, str]] = []
+		# All patterns are matched against a single index of the output dir
+		resolver = self._resolver(self.output_dir)
+
+		results: list[ResolvedFile] = []
 		for pattern in patterns:
-			# Resolve glob against the output directory
-			full_pattern = os.path.join(self.output_dir, pattern)
-			matched = glob.glob(full_pattern, recursive=True)
+			matched = resolver.match(pattern)
 
 			if not matched:
 				raise FileNotFoundError(
 					f"Pattern '{pattern}' matched no files in {self.output_dir}"
 				)
 
-			for abs_path in matched:
-				if os.path.isdir(abs_path):
-					continue
-
-				# Skip __pycache__ directories and .pyc files
-				if '__pycache__' in abs_path or abs_path.endswith('.pyc'):
-					continue
-
-				# Archive name is relative to the output dir
-				rel = os.path.relpath(abs_path, self.output_dir).replace('\\', '/')
-				results.append((rel, abs_path))
+			for file in matched:
+				if not is_excluded(file.arcname, self.excludes) and self._within_size_limit(file):
+					results.append(file)
 
 		return results
 
-	def _resolve_extra_files(self) -> list[tuple[str, str]]:
+	def _resolve_extra_files(self) -> list[ResolvedFile]:
 		"""Resolve extra_files glob patterns against the plugin source directory.
 
-		Returns list of (arcname, absolute_path) tuples.
+		Archive names are the target prefix followed by the path relative to the pattern base.
 		"""
 		extra = self.manifest.get('extra_files', {})
-		results: list[tuple[str, str]] = []
+		resolver = self._resolver(self.plugin_dir)
+		results: list[ResolvedFile] = []
 
 		for pattern, target_prefix in extra.items():
-			full_pattern = os.path.join(self.plugin_dir, pattern)
-			matched = glob.glob(full_pattern, recursive=True)
+			matched = resolver.match(pattern)
 
 			if not matched:
 				print(f"WARNING: extra_files pattern '{pattern}' matched no files")
 				continue
 
-			for abs_path in matched:
-				if os.path.isdir(abs_path):
-					continue
-
-				# Skip __pycache__ and .pyc files
-				if '__pycache__' in abs_path or abs_path.endswith('.pyc'):
+			for file in matched:
+				if is_excluded(file.arcname, self.excludes):
 					continue
+				abs_path = file.src
 
 				# Archive name: target_prefix + relative path from the pattern base
 				pattern_base = os.path.dirname(os.path.join(self.plugin_dir, pattern.split('*')[0]))
 				rel = os.path.relpath(abs_path, pattern_base).replace('\\', '/')
 				arcname = target_prefix.rstrip('/') + '/' + rel if target_prefix else rel
-				results.append((arcname, abs_path))
+				file = ResolvedFile(src=abs_path, arcname=arcname, size=file.size, mtime=file.mtime)
+				if self._within_size_limit(file):
+					results.append(file)
 
 		return results
 
-	def build(self) -> str:
-		"""Build the plugin zip and return the output path."""
+	def _resolve_files(self) -> dict[str, list[ResolvedFile]]:
+		"""Resolve the output and extra files through the plugin zip's lock file (see manifest_lock)."""
+		inputs = {
+			'output_dir': self.output_dir,
+			'plugin_dir': self.plugin_dir,
+			'files': self.manifest.get('files', {}).get(self.target, []),
+			'extra_files': self.manifest.get('extra_files', {}),
+			'exclude': self.excludes,
+			'size_limits': self.size_limits,
+		}
+
+		def resolve() -> dict[str, list[ResolvedFile]]:
+			files = {'output': self._resolve_output_globs(), 'extra': self._resolve_extra_files()}
+			self.print_walk_report()
+			return files
+
+		return resolve_locked(self.zip_path, inputs, resolve, self.workers)
+
+	def print_walk_report(self):
+		directories = sum(resolver.directories_scanned for resolver in self.resolvers)
+		files = sum(resolver.files_visited for resolver in self.resolvers)
+		pruned = sum(resolver.directories_pruned for resolver in self.resolvers)
+		print(f"  Visited {directories:,} directories and {files:,} files ({pruned:,} excluded directories skipped)")
+
+	@property
+	def zip_path(self) -> str:
+		build_type_suffix = f"-{self.build_type}" if self.build_type else ""
+		return os.path.join('installers_output', f"metaffi-plugin-{self.plugin_name}-{self.version}{build_type_suffix}-{self.target}.zip")
 
-		# Collect all files
-		output_files = self._resolve_output_globs()
-		extra_files = self._resolve_extra_files()
+	def package_entries(self) -> list[PackageEntry]:
+		"""Resolve everything that goes into the plugin zip, in archive order."""
 
-		# Ensure output directory exists
-		os.makedirs('installers_output', exist_ok=True)
-
-		build_type_suffix = f"-{self.build_type}" if self.build_type else ""
-		zip_name = f"metaffi-plugin-{self.plugin_name}-{self.version}{build_type_suffix}-{self.target}.zip"
-		zip_path = os.path.join('installers_output', zip_name)
+		# Collect all files
+		files = self._resolve_files()
 
-		print(f"Building plugin installer: {zip_name}")
+		print(f"Building plugin installer: {os.path.basename(self.zip_path)}")
 		print(f"  Plugin: {self.plugin_name}")
 		print(f"  Version: {self.version}")
 		print(f"  Target: {self.target}")
 		print(f"  Output dir: {self.output_dir}")
 
-		with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED, compresslevel=9) as zf:
-			# Add plugin_manifest.json (from install/ subdir)
-			manifest_path = os.path.join(self.install_dir, 'plugin_manifest.json')
-			zf.write(manifest_path, arcname='plugin_manifest.json')
-			print(f"  + plugin_manifest.json")
-
-			# Add plugin_hooks.py (from install/ subdir)
-			hooks_path = os.path.join(self.install_dir, 'plugin_hooks.py')
-			if os.path.isfile(hooks_path):
-				zf.write(hooks_path, arcname='plugin_hooks.py')
-				print(f"  + plugin_hooks.py")
-			else:
-				print(f"  WARNING: plugin_hooks.py not found in {self.install_dir}")
-
-			# Add output files (DLLs/SOs, jars, etc.)
-			for arcname, abs_path in output_files:
-				zf.write(abs_path, arcname=arcname)
-				print(f"  + {arcname}")
-
-			# Add extra files (tests, helpers, etc.)
-			for arcname, abs_path in extra_files:
-				zf.write(abs_path, arcname=arcname)
-				print(f"  + {arcname} (extra)")
+		entries: list[PackageEntry] = []
+
+		# Add plugin_manifest.json (from install/ subdir)
+		manifest_path = os.path.join(self.install_dir, 'plugin_manifest.json')
+		entries.append(PackageEntry(src=manifest_path, arcname='plugin_manifest.json'))
+		print(f"  + plugin_manifest.json")
+
+		# Add plugin_hooks.py (from install/ subdir)
+		hooks_path = os.path.join(self.install_dir, 'plugin_hooks.py')
+		if os.path.isfile(hooks_path):
+			entries.append(PackageEntry(src=hooks_path, arcname='plugin_hooks.py'))
+			print(f"  + plugin_hooks.py")
+		else:
+			print(f"  WARNING: plugin_hooks.py not found in {self.install_dir}")
+
+		# Add output files (DLLs/SOs, jars, etc.)
+		for file in files['output']:
+			entries.append(PackageEntry(src=file.src, arcname=file.arcname))
+			print(f"  + {file.arcname}")
+
+		# Add extra files (tests, helpers, etc.)
+		for file in files['extra']:
+			entries.append(PackageEntry(src=file.src, arcname=file.arcname))
+			print(f"  + {file.arcname} (extra)")
+
+		for entry in entries:
+			entry.compression = self.compression_policy.method_for(entry.arcname)
+		entries = strip_package_entries(self.zip_path, entries, self.manifest.get('strip', []), self.workers)
+		return add_installed_lock(entries, self.workers)
+
+	def build(self, entries: list[PackageEntry] | None = None) -> str:
+		"""Build the plugin zip and return the output path. entries defaults to package_entries()."""
+		if entries is None:
+			entries = self.package_entries()
+
+		os.makedirs('installers_output', exist_ok=True)
+		zip_path = self.zip_path
+		with open(zip_path, 'wb') as f:
+			self.members = write_zip(f, entries, workers=self.workers, cache=self.cache)
+		self.entries = entries
 
 		file_size = os.path.getsize(zip_path)
 		print(f"\nCreated: {os.path.abspath(zip_path)} ({file_size:,} bytes)")
+		report_archive_sizes(zip_path, self.members)
 		return zip_path
 
+	def check_reproducible(self, zip_path: str) -> bool:
+		"""Rebuild the zip written by build() and return True if both builds are byte-identical."""
+		return check_reproducible(zip_path, self.entries, self.workers)
+
+	def create_installer_script(self, zip_path: str) -> str:
+		"""Render the plugin installer template around a built plugin zip and return the script path."""
+		script_path = os.path.splitext(zip_path)[0] + '-installer.py'
+
+		# the zip is base64-encoded into the script in chunks, the other platform's payload stays empty
+		with open(zip_path, 'rb') as payload:
+			render_template(PLUGIN_INSTALLER_TEMPLATE, script_path, {
+				'WINDOWS_X64_ZIP': Base64Value(payload) if self.target == 'windows' else '',
+				'UBUNTU_X64_ZIP': Base64Value(payload) if self.target == 'ubuntu' else '',
+				'PLUGIN_VERSION': self.version,
+				'PLUGIN_NAME': self.plugin_name,
+			})
+
+		print(f"Created: {os.path.abspath(script_path)} ({os.path.getsize(script_path):,} bytes)")
+		return script_path
+
+
+	def auto_tune(self):
+		"""Measure codecs on the plugin's files and write the recommended compression rules into plugin_manifest.json."""
+		files = [(file.src, file.arcname) for file in self._resolve_output_globs() + self._resolve_extra_files()]
+
+		print(f"Auto-tuning compression policy for {self.plugin_name}...")
+		policy = auto_tune(files).merged_with(self.compression_policy)
+		self.manifest['compression'] = policy.to_manifest()
+		self.compression_policy = policy
+		write_manifest_policy(self.manifest_path, policy)
+		print(f"Wrote {len(policy.rules)} compression rule(s) to {self.manifest_path}")
+
+
+@dataclass
+class PluginBuildResult:
+	"""Outcome of one plugin/target build in batch mode."""
+	plugin_dir: str
+	target: str
+	zip_path: str | None = None
+	files: int = 0
+	size: int = 0
+	seconds: float = 0.0
+	error: str | None = None
+
+
+def build_plugin_batch(plugin_dirs: list[str], targets: list[str], plugin_jobs: int | None = None, workers: int | None = None,
+					   installer_script: bool = False, verify_reproducible: bool = False, **builder_args) -> list[PluginBuildResult]:
+	"""Build every plugin for every target, up to plugin_jobs builds at a time.
+
+	The `workers` compression threads are shared out between the concurrent builds. A failing
+	build is recorded in its result and does not stop the others. builder_args are passed to
+	each PluginInstallerBuilder.
+	"""
+	jobs = [(plugin_dir, target) for plugin_dir in plugin_dirs for target in targets]
+	plugin_jobs = max(1, min(plugin_jobs or default_workers(), len(jobs)))
+	workers_per_build = max(1, (workers or default_workers()) // plugin_jobs)
+
+	def build_one(plugin_dir: str, target: str) -> PluginBuildResult:
+		result = PluginBuildResult(plugin_dir=plugin_dir, target=target)
+		start = time.perf_counter()
+		try:
+			builder = PluginInstallerBuilder(plugin_dir=plugin_dir, target=target, workers=workers_per_build, **builder_args)
+			result.zip_path = builder.build()
+			if verify_reproducible and not builder.check_reproducible(result.zip_path):
+				raise RuntimeError(f"{result.zip_path} is not reproducible")
+			if installer_script:
+				builder.create_installer_script(result.zip_path)
+			result.files = len(builder.members)
+			result.size = os.path.getsize(result.zip_path)
+		except Exception as e:
+			result.error = f"{type(e).__name__}: {e}"
+			print(f"\nERROR: {plugin_dir} ({target}) failed: {result.error}")
+		result.seconds = time.perf_counter() - start
+		return result
+
+	with ThreadPoolExecutor(max_workers=plugin_jobs, thread_name_prefix='plugin') as pool:
+		return list(pool.map(lambda job: build_one(*job), jobs))
+
+
+def print_batch_summary(results: list[PluginBuildResult], wall_seconds: float):
+	"""Print the sizes and timings of a batch build."""
+	width = max(len(os.path.basename(os.path.normpath(r.plugin_dir))) for r in results)
+	print(f"\nPlugin batch summary ({wall_seconds:.1f}s wall, {sum(r.seconds for r in results):.1f}s total build time):")
+	for r in results:
+		name = os.path.basename(os.path.normpath(r.plugin_dir))
+		if r.error:
+			print(f"  {name:<{width}}  {r.target:<8} FAILED  {r.seconds:7.1f}s  {r.error}")
+		else:
+			print(f"  {name:<{width}}  {r.target:<8} ok      {r.seconds:7.1f}s  {r.files:5} files  {r.size:>14,} bytes  {os.path.basename(r.zip_path)}")
+	failed = sum(1 for r in results if r.error)
+	print(f"  {len(results) - failed} succeeded, {failed} failed, {sum(r.size for r in results):,} bytes total")
+
 
 def main():
 	parser = argparse.ArgumentParser(description='Build a MetaFFI plugin installer zip')
-	parser.add_argument('--plugin', required=True, help='Path to the lang-plugin-* directory')
-	parser.add_argument('--target', required=True, choices=['windows', 'ubuntu'], help='Target platform')
+	parser.add_argument('--plugin', required=True, nargs='+', action='extend', help='Path to the lang-plugin-* directory (several for batch mode)')
+	parser.add_argument('--target', required=True, nargs='+', action='extend', choices=['windows', 'ubuntu'], help='Target platform (several for batch mode)')
 	parser.add_argument('--config', default='Debug', choices=['Debug', 'Release'], help='Build configuration (default: Debug)')
 	parser.add_argument('--version', default=None, help='Version override (default: from manifest)')
 	parser.add_argument('--output-dir', default=None, help='Build output base directory (default: $METAFFI_HOME). Plugin files are resolved under <output-dir>/<plugin-name>/')
 	parser.add_argument('--build-type', default=None, help='Build type to embed in the zip name (e.g. Debug, Release). Omit to exclude from the name.')
+	parser.add_argument('--jobs', type=int, default=None, help=f'Number of compression worker threads, shared by concurrent batch builds (default: {default_workers()})')
+	parser.add_argument('--plugin-jobs', type=int, default=None, help=f'Batch mode: maximum number of plugin zips built at once (default: {default_workers()})')
+	add_cache_arguments(parser)
+	add_determinism_arguments(parser)
+	add_profile_arguments(parser)
+	add_size_report_arguments(parser)
+	add_strip_arguments(parser)
+	add_lock_arguments(parser)
+	parser.add_argument('--auto-tune', action='store_true', help="Measure codecs on samples of each file type, write the recommended 'compression' rules into plugin_manifest.json and exit")
+	parser.add_argument('--installer-script', action='store_true', help='Also render a self-contained Python installer script around the zip from templates/metaffi_plugin_installer_template.py')
 	args = parser.parse_args()
-
-	if not os.path.isdir(args.plugin):
-		print(f"Error: Plugin directory not found: {args.plugin}")
-		sys.exit(1)
+	configure_determinism(args)
+	configure_size_report(args)
+	configure_strip(args)
+	configure_lock(args)
+
+	for plugin_dir in args.plugin:
+		if not os.path.isdir(plugin_dir):
+			print(f"Error: Plugin directory not found: {plugin_dir}")
+			sys.exit(1)
+
+	cache = cache_from_args(args)
+	if len(args.plugin) > 1 or len(args.target) > 1:
+		if args.auto_tune:
+			print("Error: --auto-tune takes a single --plugin and --target")
+			sys.exit(1)
+
+		start = time.perf_counter()
+		configure_profile(args, 'plugin batch')
+		try:
+			results = build_plugin_batch(
+				args.plugin,
+				args.target,
+				plugin_jobs=args.plugin_jobs,
+				workers=args.jobs,
+				installer_script=args.installer_script,
+				verify_reproducible=args.check_reproducible,
+				config=args.config,
+				version_override=args.version,
+				output_dir_override=args.output_dir,
+				build_type=args.build_type,
+				cache=cache,
+			)
+		finally:
+			finish_profile(os.path.join('installers_output', 'metaffi-plugin-batch'))
+		print_batch_summary(results, time.perf_counter() - start)
+		if cache is not None:
+			cache.finish()
+		if any(r.error for r in results):
+			sys.exit(1)
+		print("Done")
+		return
 
 	builder = PluginInstallerBuilder(
-		plugin_dir=args.plugin,
-		target=args.target,
+		plugin_dir=args.plugin[0],
+		target=args.target[0],
 		config=args.config,
 		version_override=args.version,
 		output_dir_override=args.output_dir,
 		build_type=args.build_type,
+		workers=args.jobs,
+		cache=cache,
 	)
 
-	builder.build()
+	if args.auto_tune:
+		builder.auto_tune()
+		return
+
+	configure_profile(args, f'plugin zip {os.path.basename(builder.zip_path)}')
+	try:
+		zip_path = builder.build()
+		if args.check_reproducible and not builder.check_reproducible(zip_path):
+			sys.exit(1)
+		if args.installer_script:
+			builder.create_installer_script(zip_path)
+	finally:
+		finish_profile(builder.zip_path)
+	if cache is not None:
+		cache.finish()
 	print("Done")
 
 
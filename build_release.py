@@ -0,0 +1,365 @@
+"""
+Single-pass release build: core zips, installer payloads and plugin zips from one compression pass.
+
+Run separately, build_core_zip.py, build_installer.py and build_plugin_installer.py each
+compress their own files, so xllr, the metaffi CLI and include/ are compressed once for the
+core zip and again for the installer payload. build_release resolves the core and plugin
+manifests of every target together, compresses each unique file (by content and compression
+method) exactly once into the compression cache, and then writes every archive by copying
+the compressed members. The installer payload is the core zip itself, wrapped in the payload
+container. With --no-cache the members live in a temporary cache for the duration of the run.
+
+With --dedup, files that are byte-identical in several archives of a target are moved into a
+companion archive that the installers link them from (see shared_files). The release size and
+extraction time with and without deduplication are measured, and the extracted trees compared.
+
+Usage:
+  python build_release.py --version <version> --build-type <Debug|Release> [--target windows ubuntu] [--plugin <lang-plugin-dir> ...] [--installers] [--dedup] [--jobs <n>] [--deterministic] [--check-reproducible] [--no-profile] [--size-budget <file>] [--accept-size-growth] [--strip] [--relock]
+
+Output (installers_output/):
+  metaffi-core-<version>-<build_type>-<target>.zip
+  metaffi-plugin-<name>-<version>-<build_type>-<target>.zip
+  metaffi-shared-<version>-<build_type>-<target>.zip (with --dedup; also the "shared" payload section)
+  payload_<target>/metaffi_payload.bin, or with --installers the installer executables built around it
+  metaffi-release-<version>-<build_type>.profile.json and .trace.json (phase timings)
+  <archive>.sizes.json next to every zip (size report, see size_report.py)
+  <archive>.lock.json next to every core and plugin zip (resolved files and digests, see manifest_lock.py)
+  metaffi-debug-*.zip next to every core and plugin zip (with --strip, see debug_split.py)
+"""
+
+import argparse
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import zipfile
+from dataclasses import dataclass
+from typing import Dict, List
+
+from artifact_cache import ArtifactCache, artifact_cache_from_args
+from build_core_zip import resolve_output_dir
+from build_fingerprint import save_fingerprint
+from build_installer import (PLATFORM_PIPELINES, FileEntry, cleanup_temp_files, create_installer_file, get_output_dir, get_ubuntu_version_tag,
+							 installer_fingerprint, load_manifest, resolve_manifest_files, to_package_entries, write_installer_payload)
+from build_metrics import add_profile_arguments, configure_profile, finish_profile, print_peak_rss
+from build_plugin_installer import PluginInstallerBuilder
+from build_toolchain import add_toolchain_arguments, configure_toolchain
+from compression_cache import CompressionCache, add_cache_arguments, cache_from_args, sha256_file
+from compression_policy import CompressionMethod, CompressionPolicy
+from debug_split import add_strip_arguments, configure_strip, strip_package_entries
+from manifest_lock import add_installed_lock, add_lock_arguments, configure_lock
+from packaging_engine import (DEFAULT_COMPRESS_LEVEL, ArchiveMember, PackageEntry, add_determinism_arguments, check_reproducible, compress_into_cache,
+							  configure_determinism, default_workers, member_cache_key, resolve_workers, write_zip)
+from shared_files import (SHARED_FILES_NAME, SHARED_PAYLOAD_SECTION, SHARED_STORE_DIR, extract_shared_blobs, find_shared_contents, materialize_shared_files,
+						  shared_archive_name, shared_blob_entries, split_shared_entries, write_shared_files_list)
+from size_report import add_size_report_arguments, configure_size_report, report_archive_sizes
+
+
+@dataclass
+class ReleaseArchive:
+	"""An archive written by the release build, with the entries compressed into it."""
+	kind: str
+	target: str
+	path: str
+	entries: List[PackageEntry]
+	# where the archive is extracted, relative to METAFFI_HOME
+	install_subdir: str = ""
+
+
+def release_output_dir(target: str, build_type: str) -> str:
+	"""Returns the build output tree of target, from the environment (as build_core_zip) or the conventional location."""
+	try:
+		return resolve_output_dir(target, build_type).replace("\\", "/").rstrip("/") + "/"
+	except EnvironmentError:
+		return get_output_dir(target, build_type)
+
+
+def core_archive(target: str, version: str, build_type: str, output_dir: str, policy: CompressionPolicy) -> tuple[ReleaseArchive, List[FileEntry]]:
+	"""Returns the core zip of target and the manifest files resolved for it."""
+	manifest = load_manifest()[target]
+	path = os.path.join("installers_output", f"metaffi-core-{version}-{build_type}-{target}.zip")
+	files = resolve_manifest_files(manifest["files"], output_dir, manifest.get("exclude"), path)
+	entries = strip_package_entries(path, to_package_entries(files, output_dir, policy), load_manifest().get("strip", []))
+	return ReleaseArchive("core", target, path, add_installed_lock(entries)), files
+
+
+def compression_seconds(archives: List[ReleaseArchive], members: Dict[str, ArchiveMember], cache: CompressionCache) -> float:
+	"""Returns the compression time of every member of archives, counting shared files once per archive."""
+	default_method = CompressionMethod("deflate", DEFAULT_COMPRESS_LEVEL)
+	total = 0.0
+	for archive in archives:
+		for entry in archive.entries:
+			if not os.path.isdir(entry.src):
+				total += members[member_cache_key(cache, entry.src, entry.compression or default_method)].compress_seconds
+	return total
+
+
+def print_release_summary(archives: List[ReleaseArchive], members: Dict[str, ArchiveMember], cache: CompressionCache,
+						  compress_wall: float, total_wall: float):
+	"""Prints the archives and compares the single pass with compressing every archive separately.
+
+	The separate-scripts figure is estimated from the measured per-file compression times, at the
+	parallelism reached by this run's compression pass.
+	"""
+	print("\nRelease archives:")
+	for archive in archives:
+		print(f"  {archive.kind:<8} {archive.target:<8} {len(archive.entries):5} files  {os.path.getsize(archive.path):>14,} bytes  {archive.path}")
+
+	unique_seconds = sum(member.compress_seconds for member in members.values())
+	separate_seconds = compression_seconds(archives, members, cache)
+	parallelism = unique_seconds / compress_wall if compress_wall > 0 and unique_seconds > 0 else 1.0
+	separate_wall = total_wall - compress_wall + separate_seconds / parallelism
+	references = sum(len(archive.entries) for archive in archives)
+
+	print(f"\nSingle pass: {total_wall:.1f}s wall, {len(members)} unique files compressed once "
+		  f"({unique_seconds:.1f}s of compression) for {references} archive members")
+	print(f"Separate scripts (estimated): {separate_wall:.1f}s wall, {separate_seconds:.1f}s of compression"
+		  + (f" ({separate_wall / total_wall:.2f}x)" if total_wall > 0 else ""))
+
+
+def deduplicate_target(target: str, version: str, build_type: str, archives: List[ReleaseArchive], work_dir: str) -> ReleaseArchive | None:
+	"""Moves the files found in several archives of target into a companion archive and returns it (None if nothing is shared).
+
+	The archives' entries are replaced by the files they keep plus their shared_files.json.
+	"""
+	target_archives = [archive for archive in archives if archive.target == target]
+	shared = find_shared_contents({archive.path: archive.entries for archive in target_archives})
+	if not shared:
+		return None
+
+	name = shared_archive_name(version, build_type, target)
+	for archive in target_archives:
+		kept, files = split_shared_entries(archive.entries, shared)
+		if files:
+			listing_path = os.path.join(work_dir, f"{os.path.basename(archive.path)}.{SHARED_FILES_NAME}")
+			write_shared_files_list(listing_path, name, files)
+			archive.entries = kept + [PackageEntry(src=listing_path, arcname=SHARED_FILES_NAME)]
+	return ReleaseArchive("shared", target, os.path.join("installers_output", name), shared_blob_entries(shared))
+
+
+def extract_release(archives: List[ReleaseArchive], shared_archive: ReleaseArchive | None, install_dir: str) -> float:
+	"""Extracts the archives as the installers do, into install_dir as METAFFI_HOME, and returns the seconds taken."""
+	start = time.perf_counter()
+	store_dir = os.path.join(install_dir, SHARED_STORE_DIR)
+	if shared_archive is not None:
+		with zipfile.ZipFile(shared_archive.path) as zf:
+			extract_shared_blobs(zf, store_dir)
+	for archive in archives:
+		archive_dir = os.path.join(install_dir, archive.install_subdir)
+		with zipfile.ZipFile(archive.path) as zf:
+			zf.extractall(archive_dir)
+		if os.path.isfile(os.path.join(archive_dir, SHARED_FILES_NAME)):
+			materialize_shared_files(archive_dir, store_dir)
+	return time.perf_counter() - start
+
+
+def tree_contents(root: str) -> Dict[str, str]:
+	"""Returns {relative path: sha256} of an extracted release, without the deduplication bookkeeping."""
+	contents = {}
+	for directory, dirs, names in os.walk(root):
+		dirs[:] = [d for d in dirs if d != SHARED_STORE_DIR]
+		for name in names:
+			if name != SHARED_FILES_NAME:
+				path = os.path.join(directory, name)
+				contents[os.path.relpath(path, root).replace("\\", "/")] = sha256_file(path)
+	return contents
+
+
+def verify_dedup(target: str, original: Dict[str, List[PackageEntry]], archives: List[ReleaseArchive], shared_archive: ReleaseArchive,
+				 workers: int, cache: CompressionCache):
+	"""Compares the deduplicated archives of target with the same archives written without deduplication.
+
+	Both variants are extracted into temporary METAFFI_HOME trees, which must come out identical;
+	prints the release size and extraction time of each.
+	"""
+	target_archives = [archive for archive in archives if archive.target == target and archive.kind != "shared"]
+	with tempfile.TemporaryDirectory(prefix="metaffi-dedup-") as temp_dir:
+		full_archives = []
+		for archive in target_archives:
+			path = os.path.join(temp_dir, os.path.basename(archive.path))
+			with open(path, "wb") as f:
+				write_zip(f, original[archive.path], workers=workers, cache=cache)
+			full_archives.append(ReleaseArchive(archive.kind, target, path, original[archive.path], archive.install_subdir))
+
+		full_seconds = extract_release(full_archives, None, os.path.join(temp_dir, "full"))
+		dedup_seconds = extract_release(target_archives, shared_archive, os.path.join(temp_dir, "dedup"))
+		if tree_contents(os.path.join(temp_dir, "full")) != tree_contents(os.path.join(temp_dir, "dedup")):
+			raise RuntimeError(f"{target}: the deduplicated release does not extract to the same files as the full release")
+
+		full_size = sum(os.path.getsize(archive.path) for archive in full_archives)
+		dedup_size = sum(os.path.getsize(archive.path) for archive in target_archives + [shared_archive])
+
+	print(f"\nDeduplication ({target}): {len(shared_archive.entries)} shared files in {os.path.basename(shared_archive.path)}, extracted trees identical")
+	print(f"  release size:    {full_size:>14,} -> {dedup_size:>14,} bytes ({100.0 * (dedup_size - full_size) / full_size:+.1f}%)")
+	print(f"  extraction time: {full_seconds:>13.2f}s -> {dedup_seconds:>13.2f}s")
+
+
+def build_installer_executable(target: str, version: str, config: str, files: List[FileEntry], payload_path: str,
+							   shared_archive: ReleaseArchive | None = None):
+	"""Wraps a release payload into the platform installer executable, as build_installer does.
+
+	files are the core files resolved for the payload, which the saved fingerprint covers. shared_archive is the
+	shared files archive bundled with a deduplicated payload; its digest is part of the saved fingerprint, so
+	build_installer does not take a deduplicated installer for its own, or the reverse.
+	"""
+	create_executable = PLATFORM_PIPELINES[target][3]
+	if target == "windows":
+		output_name = f"metaffi-installer-{version}-windows"
+		artifact_path = f"./installers_output/{output_name}.exe"
+	else:
+		output_name = f"metaffi-installer-{version}-ubuntu-{get_ubuntu_version_tag()}"
+		artifact_path = f"./installers_output/{output_name}"
+
+	output_file_py = f"./installers_output/metaffi_installer_{target}.py"
+	create_installer_file(output_file_py, version)
+	create_executable(output_file_py, output_name, payload_path)
+	cleanup_temp_files(output_file_py, payload_path)
+	shared_files = sha256_file(shared_archive.path) if shared_archive is not None else None
+	save_fingerprint(artifact_path, installer_fingerprint(target, version, config, {"output": files}, shared_files=shared_files))
+
+
+def build_release(targets: List[str], version: str, build_type: str, plugin_dirs: List[str], workers: int | None, cache: CompressionCache,
+				  artifacts: ArtifactCache | None = None, installers: bool = False, verify_reproducible: bool = False,
+				  dedup: bool = False) -> List[ReleaseArchive]:
+	"""Builds the core zip, installer payload and plugin zips of every target from a single compression pass.
+
+	With dedup, files shared by several archives of a target go into a companion archive instead (see deduplicate_target).
+	"""
+	start = time.perf_counter()
+	workers = resolve_workers(workers)
+	policy = CompressionPolicy.from_manifest(load_manifest())
+	os.makedirs("installers_output", exist_ok=True)
+
+	core_files: Dict[str, List[FileEntry]] = {}
+	core_archives: List[ReleaseArchive] = []
+	plugin_builds: List[tuple[PluginInstallerBuilder, ReleaseArchive]] = []
+	for target in targets:
+		output_dir = release_output_dir(target, build_type)
+		print(f"{target}: output dir {output_dir}")
+
+		# the uninstaller is part of the core file list
+		create_uninstaller, uninstaller_name = PLATFORM_PIPELINES[target][:2]
+		create_uninstaller(artifacts)
+		shutil.copy2(f"./installers_output/{uninstaller_name}", output_dir)
+		cleanup_temp_files(f"./installers_output/{uninstaller_name}")
+
+		archive, core_files[target] = core_archive(target, version, build_type, output_dir, policy)
+		core_archives.append(archive)
+		for plugin_dir in plugin_dirs:
+			builder = PluginInstallerBuilder(plugin_dir=plugin_dir, target=target, config=build_type, version_override=version,
+											 output_dir_override=output_dir.rstrip("/"), build_type=build_type, workers=workers, cache=cache)
+			plugin_builds.append((builder, ReleaseArchive("plugin", target, builder.zip_path, builder.package_entries(), builder.plugin_name)))
+
+	archives = core_archives + [archive for _, archive in plugin_builds]
+	original_entries = {archive.path: archive.entries for archive in archives}
+	shared_archives: Dict[str, ReleaseArchive] = {}
+	work_dir = tempfile.mkdtemp(prefix="metaffi-release-")  # shared_files.json listings
+	if dedup:
+		for target in targets:
+			shared_archive = deduplicate_target(target, version, build_type, archives, work_dir)
+			if shared_archive is not None:
+				shared_archives[target] = shared_archive
+		archives += shared_archives.values()
+	all_entries = [entry for archive in archives for entry in archive.entries]
+	print(f"\nCompressing {len(all_entries)} archive members with {workers} workers...")
+	compress_start = time.perf_counter()
+	members = compress_into_cache(all_entries, cache, workers)
+	compress_wall = time.perf_counter() - compress_start
+	print(f"Compressed {len(members)} unique files in {compress_wall:.1f}s")
+
+	# every archive below is assembled from cached members only
+	payload_archives: List[ReleaseArchive] = []
+	for archive in core_archives + list(shared_archives.values()):
+		with open(archive.path, "wb") as f:
+			written = write_zip(f, archive.entries, workers=workers, cache=cache)
+		print(f"Created: {os.path.abspath(archive.path)}")
+		report_archive_sizes(archive.path, written)
+
+	for archive in core_archives:
+		section_name = PLATFORM_PIPELINES[archive.target][2]
+		sections = [(section_name, archive.path)]
+		if archive.target in shared_archives:
+			sections.append((SHARED_PAYLOAD_SECTION, shared_archives[archive.target].path))
+		streams = [(name, open(path, "rb")) for name, path in sections]
+		try:
+			payload_path = write_installer_payload(f"./installers_output/payload_{archive.target}", streams)
+		finally:
+			for _, stream in streams:
+				stream.close()
+		payload_archives.append(ReleaseArchive("payload", archive.target, payload_path, archive.entries))
+
+	for builder, archive in plugin_builds:
+		builder.build(archive.entries)
+
+	print_peak_rss("release")
+	compress_archives = archives + payload_archives
+	print_release_summary(compress_archives, members, cache, compress_wall, time.perf_counter() - start)
+
+	try:
+		for target, shared_archive in shared_archives.items():
+			verify_dedup(target, original_entries, archives, shared_archive, workers, cache)
+	finally:
+		shutil.rmtree(work_dir, ignore_errors=True)
+
+	if verify_reproducible:
+		reproducible = [check_reproducible(archive.path, archive.entries, workers) for archive in archives]
+		if not all(reproducible):
+			raise RuntimeError("Release archives are not reproducible")
+
+	if installers:
+		for archive in payload_archives:
+			build_installer_executable(archive.target, version, build_type, core_files[archive.target], archive.path, shared_archives.get(archive.target))
+	return compress_archives
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Build the MetaFFI core zips, installer payloads and plugin zips in a single compression pass")
+	parser.add_argument("--target", nargs="+", choices=["windows", "ubuntu"],
+						default=["windows" if platform.system() == "Windows" else "ubuntu"], help="Target platforms (default: this host)")
+	parser.add_argument("--version", required=True)
+	parser.add_argument("--build-type", required=True, choices=["Debug", "Release"])
+	parser.add_argument("--plugin", nargs="+", action="extend", default=[], help="lang-plugin-* directories to build plugin zips for")
+	parser.add_argument("--installers", action="store_true", help="Also build the installer executables around the payloads")
+	parser.add_argument("--dedup", action="store_true", help="Store files shared by several archives of a target once, in a companion archive")
+	parser.add_argument("--jobs", type=int, default=None, help=f"Number of compression worker threads (default: {default_workers()})")
+	add_cache_arguments(parser)
+	add_toolchain_arguments(parser)
+	add_determinism_arguments(parser)
+	add_profile_arguments(parser)
+	add_size_report_arguments(parser)
+	add_strip_arguments(parser)
+	add_lock_arguments(parser)
+	args = parser.parse_args()
+	configure_determinism(args)
+	configure_size_report(args)
+	configure_strip(args)
+	configure_lock(args)
+
+	for plugin_dir in args.plugin:
+		if not os.path.isdir(plugin_dir):
+			print(f"Error: Plugin directory not found: {plugin_dir}", file=sys.stderr)
+			sys.exit(1)
+
+	configure_toolchain(args)
+	configure_profile(args, f"release {args.version} {args.build_type}")
+	artifacts = artifact_cache_from_args(args)
+	cache = cache_from_args(args)
+	try:
+		if cache is not None:
+			build_release(args.target, args.version, args.build_type, args.plugin, args.jobs, cache, artifacts, args.installers, args.check_reproducible, args.dedup)
+			cache.finish()
+			return
+
+		# the single pass needs somewhere to keep the compressed members between archives
+		with tempfile.TemporaryDirectory(prefix="metaffi-release-") as temp_cache_dir:
+			build_release(args.target, args.version, args.build_type, args.plugin, args.jobs,
+						  CompressionCache(temp_cache_dir, max_bytes=sys.maxsize), artifacts, args.installers, args.check_reproducible, args.dedup)
+	finally:
+		finish_profile(os.path.join("installers_output", f"metaffi-release-{args.version}-{args.build_type}"))
+
+
+if __name__ == "__main__":
+	os.chdir(os.path.dirname(os.path.abspath(__file__)))
+	main()
@@ -0,0 +1,125 @@
+"""
+Runs build stages as a dependency graph on a thread pool and records a timeline.
+
+Stages are plain callables. A stage starts as soon as all of its dependencies
+have finished and receives their results as positional arguments, in the order
+the dependencies were declared. If a stage fails, the stages depending on it
+are skipped, independent stages still run, and the first error is re-raised
+once the graph has drained. A stage that raises StopChain (e.g. because its
+artifact is up to date) skips the stages depending on it without failing the build.
+"""
+
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List
+
+from build_metrics import phase
+
+
+TIMELINE_BAR_WIDTH = 40
+
+
+class StopChain(Exception):
+	"""Raised by a stage to skip the stages depending on it; the build does not fail."""
+
+
+@dataclass
+class Stage:
+	"""A unit of work in the build graph."""
+	name: str
+	fn: Callable[..., Any]
+	deps: List[str] = field(default_factory=list)
+	result: Any = None
+	status: str = "pending"  # pending, running, done, stopped, failed, skipped
+	start: float = 0.0
+	end: float = 0.0
+	error: BaseException | None = None
+
+	@property
+	def seconds(self) -> float:
+		return self.end - self.start
+
+
+class StageScheduler:
+	"""Schedules stages on `workers` threads as soon as their dependencies complete."""
+
+	def __init__(self, workers: int):
+		self.workers = max(1, workers)
+		self.stages: Dict[str, Stage] = {}
+		self._origin = 0.0
+
+	def add(self, name: str, fn: Callable[..., Any], deps: List[str] | tuple = ()):
+		"""Adds a stage. Dependencies must have been added before."""
+		if name in self.stages:
+			raise ValueError(f"Duplicate stage: {name}")
+		for dep in deps:
+			if dep not in self.stages:
+				raise ValueError(f"Stage {name} depends on unknown stage {dep}")
+		self.stages[name] = Stage(name=name, fn=fn, deps=list(deps))
+
+	def _run_stage(self, stage: Stage):
+		stage.start = time.perf_counter() - self._origin
+		try:
+			with phase(stage.name):
+				return stage.fn(*[self.stages[dep].result for dep in stage.deps])
+		finally:
+			stage.end = time.perf_counter() - self._origin
+
+	def run(self) -> Dict[str, Any]:
+		"""Runs every stage and returns {name: result}. Raises the first stage error, if any."""
+		self._origin = time.perf_counter()
+		running: Dict[Future, Stage] = {}
+
+		with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="stage") as pool:
+			while True:
+				for stage in self.stages.values():
+					if stage.status != "pending":
+						continue
+					dep_states = [self.stages[dep].status for dep in stage.deps]
+					if any(s in ("stopped", "failed", "skipped") for s in dep_states):
+						stage.status = "skipped"
+					elif all(s == "done" for s in dep_states):
+						stage.status = "running"
+						running[pool.submit(self._run_stage, stage)] = stage
+
+				if not running:
+					break
+
+				finished, _ = wait(running, return_when=FIRST_COMPLETED)
+				for future in finished:
+					stage = running.pop(future)
+					try:
+						stage.result = future.result()
+						stage.status = "done"
+					except StopChain:
+						stage.status = "stopped"
+					except BaseException as e:
+						stage.error = e
+						stage.status = "failed"
+						print(f"Stage {stage.name} failed: {e}")
+
+		failed = [s for s in self.stages.values() if s.status == "failed"]
+		if failed:
+			raise failed[0].error
+		return {name: stage.result for name, stage in self.stages.items()}
+
+	def print_timeline(self):
+		"""Prints when each stage ran, relative to the start of the build."""
+		ran = [s for s in self.stages.values() if s.status in ("done", "stopped", "failed")]
+		if not ran:
+			return
+
+		total = max(s.end for s in ran) or 1e-9
+		busy = sum(s.seconds for s in ran)
+		width = max(len(s.name) for s in self.stages.values())
+		print(f"\nStage timeline (wall {total:.1f}s, stage time {busy:.1f}s, {busy / total:.2f}x overlap):")
+		for stage in sorted(self.stages.values(), key=lambda s: (s.status not in ("done", "stopped", "failed"), s.start)):
+			if stage.status not in ("done", "stopped", "failed"):
+				print(f"  {stage.name:<{width}}  {stage.status}")
+				continue
+			first = min(int(stage.start / total * TIMELINE_BAR_WIDTH), TIMELINE_BAR_WIDTH - 1)
+			last = min(max(first + 1, round(stage.end / total * TIMELINE_BAR_WIDTH)), TIMELINE_BAR_WIDTH)
+			bar = " " * first + "#" * (last - first) + " " * (TIMELINE_BAR_WIDTH - last)
+			marker = {"done": "", "stopped": "  stopped", "failed": "  FAILED"}[stage.status]
+			print(f"  {stage.name:<{width}}  {stage.start:7.1f}s {stage.end:7.1f}s {stage.seconds:7.1f}s  |{bar}|{marker}")
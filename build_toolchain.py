@@ -0,0 +1,206 @@
+"""
+Managed build toolchain (PyInstaller and the packages bundled into the installers).
+
+The toolchain is a virtual environment created once per toolchain.lock and reused by
+every build: <cache_root>/toolchain/<platform>-py<XY>-<lock hash>/. Linux executables
+built from Windows use a matching environment inside WSL (under ~/.cache/metaffi-installer).
+Editing toolchain.lock produces a new environment; old ones can be deleted freely.
+
+Packages are installed from PyPI, or only from a local wheelhouse directory when one is
+given with --wheelhouse or $METAFFI_WHEELHOUSE, so builds work without network access.
+
+Usage:
+  python build_toolchain.py create [--wheelhouse <dir>] [--wsl]
+  python build_toolchain.py download --wheelhouse <dir> [--platform win_amd64|manylinux2014_x86_64] [--python-version 3.11]
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import platform
+import shlex
+import shutil
+import subprocess
+import sys
+import threading
+from dataclasses import dataclass
+from typing import Dict, List
+
+from build_metrics import phase
+from compression_cache import get_cache_root
+
+
+TOOLCHAIN_LOCK = os.path.join(os.path.dirname(os.path.abspath(__file__)), "toolchain.lock")
+
+# Written into an environment once it is fully installed
+TOOLCHAIN_MARKER = "toolchain.json"
+
+_wheelhouse = os.environ.get("METAFFI_WHEELHOUSE") or None
+_toolchains: Dict[bool, "Toolchain"] = {}
+_toolchains_lock = threading.Lock()
+
+
+def lock_sha256() -> str:
+	with open(TOOLCHAIN_LOCK, "rb") as f:
+		return hashlib.sha256(f.read()).hexdigest()
+
+
+def locked_versions() -> Dict[str, str]:
+	"""Returns {package: version} pinned by toolchain.lock."""
+	versions = {}
+	with open(TOOLCHAIN_LOCK, "r") as f:
+		for line in f:
+			requirement = line.split("#", 1)[0].split(";", 1)[0].strip()
+			if "==" in requirement:
+				name, version = requirement.split("==", 1)
+				versions[name.strip().lower()] = version.strip()
+	return versions
+
+
+def to_wsl_path(path: str) -> str:
+	"""Converts an absolute Windows path (e.g. C:\\dir) into its WSL mount path (/mnt/c/dir)."""
+	path = os.path.abspath(path).replace("\\", "/")
+	if len(path) > 1 and path[1] == ":":
+		path = "/mnt/" + path[0].lower() + path[2:]
+	return path
+
+
+def _pip_source_args(wheelhouse: str | None, wsl: bool = False) -> List[str]:
+	if not wheelhouse:
+		return []
+	return ["--no-index", "--find-links", to_wsl_path(wheelhouse) if wsl else os.path.abspath(wheelhouse)]
+
+
+@dataclass
+class Toolchain:
+	"""A ready toolchain environment; python is a path on the host, or inside WSL if wsl is set."""
+	python: str
+	wsl: bool
+	versions: Dict[str, str]
+
+	def run_module(self, module: str, args: List[str]):
+		"""Runs `python -m module args` in the toolchain environment."""
+		command = [self.python, "-m", module, *args]
+		if self.wsl:
+			command = ["wsl", "-e", "bash", "-c", shlex.join(command)]
+		subprocess.run(command, check=True)
+
+	def pyinstaller(self, args: List[str]):
+		name = args[args.index("--name") + 1] if "--name" in args else "pyinstaller"
+		with phase(f"pyinstaller {name}", wsl=self.wsl):
+			self.run_module("PyInstaller", args)
+
+
+def _ensure_native(wheelhouse: str | None) -> Toolchain:
+	digest = lock_sha256()
+	tag = f"{sys.platform}-py{sys.version_info[0]}{sys.version_info[1]}-{digest[:12]}"
+	venv_dir = os.path.join(get_cache_root(), "toolchain", tag)
+	bin_dir = "Scripts" if sys.platform == "win32" else "bin"
+	python = os.path.join(venv_dir, bin_dir, "python.exe" if sys.platform == "win32" else "python")
+
+	if not os.path.isfile(os.path.join(venv_dir, TOOLCHAIN_MARKER)):
+		print(f"Creating build toolchain {tag} from {os.path.basename(TOOLCHAIN_LOCK)}...")
+		with phase("create toolchain"):
+			shutil.rmtree(venv_dir, ignore_errors=True)
+			subprocess.run([sys.executable, "-m", "venv", venv_dir], check=True)
+			subprocess.run([python, "-m", "pip", "install", "--disable-pip-version-check", *_pip_source_args(wheelhouse), "-r", TOOLCHAIN_LOCK], check=True)
+			with open(os.path.join(venv_dir, TOOLCHAIN_MARKER), "w") as f:
+				json.dump({"lock_sha256": digest, "python": platform.python_version()}, f)
+
+	return Toolchain(python=python, wsl=False, versions={"python": platform.python_version(), **locked_versions()})
+
+
+def _ensure_wsl(wheelhouse: str | None) -> Toolchain:
+	digest = lock_sha256()
+	pip_args = shlex.join(["--disable-pip-version-check", *_pip_source_args(wheelhouse, wsl=True), "-r", to_wsl_path(TOOLCHAIN_LOCK)])
+	marker = json.dumps({"lock_sha256": digest})
+
+	# pip output goes to stderr so that stdout only carries the environment's python and its version
+	script = f"""
+	set -e
+	PYV=$(python3 -c 'import sys; print("%d%d" % sys.version_info[:2])')
+	VENV="${{XDG_CACHE_HOME:-$HOME/.cache}}/metaffi-installer/toolchain/linux-py$PYV-{digest[:12]}"
+	if [ ! -f "$VENV/{TOOLCHAIN_MARKER}" ]; then
+		echo "Creating WSL build toolchain in $VENV..." 1>&2
+		rm -rf "$VENV"
+		python3 -m venv "$VENV" 1>&2
+		"$VENV/bin/python" -m pip install {pip_args} 1>&2
+		echo {shlex.quote(marker)} > "$VENV/{TOOLCHAIN_MARKER}"
+	fi
+	echo "$VENV/bin/python"
+	"$VENV/bin/python" -c 'import platform; print(platform.python_version())'
+	"""
+	with phase("prepare wsl toolchain"):
+		result = subprocess.run(["wsl", "-e", "bash", "-c", script], check=True, stdout=subprocess.PIPE, text=True)
+	python, python_version = result.stdout.split()[-2:]
+	return Toolchain(python=python, wsl=True, versions={"python": python_version, **locked_versions()})
+
+
+def get_toolchain(wsl: bool = False) -> Toolchain:
+	"""Returns the toolchain for native builds, or for Linux builds inside WSL, creating it on first use."""
+	with _toolchains_lock:
+		if wsl not in _toolchains:
+			_toolchains[wsl] = _ensure_wsl(_wheelhouse) if wsl else _ensure_native(_wheelhouse)
+		return _toolchains[wsl]
+
+
+def add_toolchain_arguments(parser: argparse.ArgumentParser):
+	"""Adds the --wheelhouse switch shared by the builders that run PyInstaller."""
+	parser.add_argument("--wheelhouse", default=os.environ.get("METAFFI_WHEELHOUSE"),
+						help="Install the build toolchain only from this directory of wheels, without network access (default: $METAFFI_WHEELHOUSE)")
+
+
+def configure_toolchain(args: argparse.Namespace):
+	"""Applies the --wheelhouse switch to toolchains created from now on."""
+	global _wheelhouse
+	_wheelhouse = args.wheelhouse
+
+
+def download_wheelhouse(wheelhouse: str, target_platform: str | None, python_version: str | None):
+	"""Downloads every wheel in toolchain.lock into wheelhouse, optionally for another platform/Python.
+
+	pip evaluates the lock's environment markers for this host, so download the Windows-only
+	wheels (sys_platform == "win32") on a Windows host.
+	"""
+	command = [sys.executable, "-m", "pip", "download", "--disable-pip-version-check", "-r", TOOLCHAIN_LOCK, "-d", wheelhouse]
+	if target_platform or python_version:
+		command += ["--only-binary=:all:"]
+	if target_platform:
+		command += ["--platform", target_platform]
+	if python_version:
+		command += ["--python-version", python_version]
+	subprocess.run(command, check=True)
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Manage the MetaFFI installer build toolchain")
+	subparsers = parser.add_subparsers(dest="command", required=True)
+
+	create_parser = subparsers.add_parser("create", help="Create (or verify) the toolchain environment")
+	add_toolchain_arguments(create_parser)
+	create_parser.add_argument("--wsl", action="store_true", help="Create the WSL toolchain used for Linux builds on Windows")
+
+	download_parser = subparsers.add_parser("download", help="Download the locked wheels into a wheelhouse directory")
+	download_parser.add_argument("--wheelhouse", required=True, help="Directory to download the wheels into")
+	download_parser.add_argument("--platform", default=None, help="Target platform tag, e.g. win_amd64 or manylinux2014_x86_64 (default: this host)")
+	download_parser.add_argument("--python-version", default=None, help="Target Python version, e.g. 3.11 (default: this interpreter)")
+
+	args = parser.parse_args()
+
+	if args.command == "create":
+		configure_toolchain(args)
+		toolchain = get_toolchain(wsl=args.wsl)
+		print(f"Toolchain ready: {toolchain.python}")
+		for name, version in toolchain.versions.items():
+			print(f"  {name} {version}")
+		return
+
+	if args.command == "download":
+		os.makedirs(args.wheelhouse, exist_ok=True)
+		download_wheelhouse(args.wheelhouse, args.platform, args.python_version)
+		print(f"Wheelhouse ready: {os.path.abspath(args.wheelhouse)}")
+
+
+if __name__ == "__main__":
+	main()
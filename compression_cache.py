@@ -0,0 +1,231 @@
+"""
+Content-addressed on-disk cache of compressed archive members.
+
+Members are keyed by the SHA-256 of the file content together with the codec,
+compression level and packaging engine format, and store the compressed bytes
+alongside their CRC and sizes. Builders splice cached members straight into
+their archives instead of recompressing unchanged files.
+
+The cache is capped in size; least recently used entries are evicted first.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+from dataclasses import dataclass
+
+
+DEFAULT_CACHE_MAX_MB = 4096
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def get_cache_root() -> str:
+	"""Returns the root directory for local build caches.
+
+	$METAFFI_INSTALLER_CACHE overrides the default of %LOCALAPPDATA%/metaffi-installer
+	on Windows and ~/.cache/metaffi-installer elsewhere.
+	"""
+	root = os.environ.get("METAFFI_INSTALLER_CACHE")
+	if root:
+		return root
+
+	if sys.platform == "win32" and os.environ.get("LOCALAPPDATA"):
+		return os.path.join(os.environ["LOCALAPPDATA"], "metaffi-installer")
+
+	xdg = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+	return os.path.join(xdg, "metaffi-installer")
+
+
+# (path, size, mtime) -> digest, so that a file packaged into several archives is hashed once per process
+_digests: dict[tuple, str] = {}
+_digests_lock = threading.Lock()
+
+
+def sha256_file(path: str) -> str:
+	"""Returns the hex SHA-256 digest of a file, read in chunks.
+
+	Digests are remembered for the rest of the process while the file's size and
+	modification time stay the same.
+	"""
+	st = os.stat(path)
+	memo_key = (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+	with _digests_lock:
+		if memo_key in _digests:
+			return _digests[memo_key]
+
+	digest = hashlib.sha256()
+	with open(path, "rb") as f:
+		while True:
+			chunk = f.read(HASH_CHUNK_SIZE)
+			if not chunk:
+				break
+			digest.update(chunk)
+
+	with _digests_lock:
+		_digests[memo_key] = digest.hexdigest()
+	return _digests[memo_key]
+
+
+def remember_digest(path: str, size: int, mtime_ns: int, digest: str):
+	"""Records a digest known from elsewhere (e.g. a lock file) for a file of the given size and modification time."""
+	with _digests_lock:
+		_digests[(os.path.abspath(path), size, mtime_ns)] = digest
+
+
+@dataclass
+class CachedMember:
+	"""A compressed member stored in the cache."""
+	path: str
+	crc: int
+	file_size: int
+	compress_size: int
+
+
+class CompressionCache:
+	"""Stores compressed member bytes under <cache_dir>/members, keyed by content hash."""
+
+	def __init__(self, cache_dir: str | None = None, max_bytes: int = DEFAULT_CACHE_MAX_MB * 1024 * 1024):
+		self.cache_dir = os.path.join(cache_dir or get_cache_root(), "members")
+		self.max_bytes = max_bytes
+		self.hits = 0
+		self.misses = 0
+		self.bytes_reused = 0
+		self._lock = threading.Lock()
+		os.makedirs(self.cache_dir, exist_ok=True)
+
+	@staticmethod
+	def make_key(content_sha256: str, codec: str, level: int | None, engine_format: str) -> str:
+		"""Builds the cache key from the content hash and everything that affects the compressed bytes."""
+		descriptor = f"{content_sha256}:{codec}:{level}:{engine_format}"
+		return hashlib.sha256(descriptor.encode("utf-8")).hexdigest()
+
+	def _paths(self, key: str) -> tuple[str, str]:
+		bucket = os.path.join(self.cache_dir, key[:2])
+		return os.path.join(bucket, key + ".bin"), os.path.join(bucket, key + ".json")
+
+	def lookup(self, key: str) -> CachedMember | None:
+		"""Returns the cached member for key, or None on a miss. Hits are marked as recently used."""
+		data_path, meta_path = self._paths(key)
+		try:
+			with open(meta_path, "r") as f:
+				meta = json.load(f)
+			if os.path.getsize(data_path) != meta["compress_size"]:
+				raise ValueError("size mismatch")
+			os.utime(meta_path)
+		except (OSError, ValueError, KeyError):
+			with self._lock:
+				self.misses += 1
+			return None
+
+		with self._lock:
+			self.hits += 1
+			self.bytes_reused += meta["file_size"]
+		return CachedMember(path=data_path, crc=meta["crc"], file_size=meta["file_size"], compress_size=meta["compress_size"])
+
+	def open_writer(self, key: str) -> "CacheWriter":
+		"""Returns a writer that stores a member's compressed bytes under key once committed."""
+		return CacheWriter(self, key)
+
+	def _commit(self, key: str, temp_path: str, crc: int, file_size: int, compress_size: int):
+		data_path, meta_path = self._paths(key)
+		os.makedirs(os.path.dirname(data_path), exist_ok=True)
+		os.replace(temp_path, data_path)
+
+		meta_temp = meta_path + f".{os.getpid()}.{threading.get_ident()}.tmp"
+		with open(meta_temp, "w") as f:
+			json.dump({"crc": crc, "file_size": file_size, "compress_size": compress_size}, f)
+		os.replace(meta_temp, meta_path)
+
+	def evict(self):
+		"""Deletes least recently used entries until the cache fits in max_bytes."""
+		with self._lock:
+			entries = []
+			total = 0
+			for bucket in os.scandir(self.cache_dir):
+				if not bucket.is_dir():
+					continue
+				for item in os.scandir(bucket.path):
+					if not item.name.endswith(".json"):
+						continue
+					data_path = item.path[:-len(".json")] + ".bin"
+					try:
+						size = os.path.getsize(data_path)
+						last_used = item.stat().st_mtime
+					except OSError:
+						continue
+					entries.append((last_used, size, item.path, data_path))
+					total += size
+
+			entries.sort()
+			for _, size, meta_path, data_path in entries:
+				if total <= self.max_bytes:
+					break
+				for path in (meta_path, data_path):
+					try:
+						os.remove(path)
+					except OSError:
+						pass
+				total -= size
+
+	def clear(self):
+		"""Removes every cached member."""
+		shutil.rmtree(self.cache_dir, ignore_errors=True)
+		os.makedirs(self.cache_dir, exist_ok=True)
+
+	def print_summary(self):
+		"""Prints the hit/miss counters of this build."""
+		lookups = self.hits + self.misses
+		rate = (100.0 * self.hits / lookups) if lookups else 0.0
+		print(f"Compression cache: {self.hits} hits, {self.misses} misses ({rate:.0f}% hit rate), "
+			  f"{self.bytes_reused:,} bytes not recompressed [{self.cache_dir}]")
+
+	def finish(self):
+		"""Evicts down to the size cap and prints the summary. Call once at the end of a build."""
+		self.evict()
+		self.print_summary()
+
+
+class CacheWriter:
+	"""Collects a member's compressed bytes into a temporary file next to the cache."""
+
+	def __init__(self, cache: CompressionCache, key: str):
+		self.cache = cache
+		self.key = key
+		fd, self.temp_path = tempfile.mkstemp(prefix="member_", suffix=".tmp", dir=cache.cache_dir)
+		self.file = os.fdopen(fd, "wb")
+
+	def write(self, data: bytes):
+		self.file.write(data)
+
+	def commit(self, crc: int, file_size: int, compress_size: int):
+		self.file.close()
+		self.cache._commit(self.key, self.temp_path, crc, file_size, compress_size)
+
+	def discard(self):
+		self.file.close()
+		try:
+			os.remove(self.temp_path)
+		except OSError:
+			pass
+
+
+def add_cache_arguments(parser: argparse.ArgumentParser):
+	"""Adds the --cache-dir/--cache-max-mb/--no-cache switches shared by all builders."""
+	parser.add_argument("--cache-dir", default=None,
+						help=f"Local build cache root, shared by the compression and artifact caches (default: $METAFFI_INSTALLER_CACHE or {get_cache_root()})")
+	parser.add_argument("--cache-max-mb", type=int, default=DEFAULT_CACHE_MAX_MB,
+						help=f"Compression cache size cap in MB, least recently used entries are evicted (default: {DEFAULT_CACHE_MAX_MB})")
+	parser.add_argument("--no-cache", action="store_true", help="Disable the local build caches")
+
+
+def cache_from_args(args: argparse.Namespace) -> CompressionCache | None:
+	"""Creates the compression cache selected on the command line, or None if disabled."""
+	if args.no_cache:
+		return None
+	return CompressionCache(args.cache_dir, args.cache_max_mb * 1024 * 1024)
@@ -0,0 +1,327 @@
+"""
+Per-file-type compression policy for the installer builders.
+
+Manifests may declare a top-level "compression" list of rules. Each rule maps a
+glob to a codec; the first rule that matches an archive name wins:
+
+  "compression": [
+    { "pattern": "*.jar", "method": "store" },
+    { "pattern": "*.so", "method": "lzma", "level": 6 },
+    { "pattern": "include/**", "method": "deflate", "level": 9 }
+  ]
+
+Patterns without a '/' match the file name, patterns with a '/' match the full
+archive name. Files matching no rule use deflate level 9.
+
+auto_tune() samples each file type, measures size against time for each
+candidate codec and returns a recommended rule list; write_manifest_policy() stores
+a policy as the "compression" list of a manifest file, leaving the rest of the file
+as written.
+"""
+
+import bz2
+import fnmatch
+import json
+import lzma
+import os
+import re
+import struct
+import time
+import zipfile
+import zlib
+from dataclasses import dataclass
+from typing import Iterable, List
+
+
+CODECS = ("store", "deflate", "bzip2", "lzma")
+
+_COMPRESS_TYPES = {
+	"store": zipfile.ZIP_STORED,
+	"deflate": zipfile.ZIP_DEFLATED,
+	"bzip2": zipfile.ZIP_BZIP2,
+	"lzma": zipfile.ZIP_LZMA,
+}
+
+_DEFAULT_LEVELS = {"store": None, "deflate": 9, "bzip2": 9, "lzma": 6}
+
+# Valid (lowest, highest) level of each codec; store takes no level
+_LEVEL_RANGES = {"store": None, "deflate": (0, 9), "bzip2": (1, 9), "lzma": (0, 9)}
+
+# LZMA dictionary size for each preset level (same as xz/liblzma presets)
+_LZMA_DICT_SIZES = [1 << 18, 1 << 20, 1 << 21, 1 << 22, 1 << 22, 1 << 23, 1 << 23, 1 << 24, 1 << 25, 1 << 26]
+
+# Candidates measured by auto_tune()
+AUTO_TUNE_CANDIDATES = [
+	("store", None),
+	("deflate", 1),
+	("deflate", 6),
+	("deflate", 9),
+	("bzip2", 9),
+	("lzma", 6),
+	("lzma", 9),
+]
+
+# Bytes sampled per file type by auto_tune()
+AUTO_TUNE_SAMPLE_BYTES = 16 * 1024 * 1024
+
+# A slower codec is only recommended if it saves at least this fraction of the faster codec's output...
+AUTO_TUNE_MIN_GAIN = 0.03
+
+# ...and costs no more than this many seconds per MB saved
+AUTO_TUNE_MAX_SECONDS_PER_MB_SAVED = 0.5
+
+
+@dataclass(frozen=True)
+class CompressionMethod:
+	"""A codec and level used to compress an archive member."""
+	codec: str
+	level: int | None = None
+
+	def __post_init__(self):
+		if self.codec not in CODECS:
+			raise ValueError(f"Unknown compression method '{self.codec}', expected one of: {', '.join(CODECS)}")
+		levels = _LEVEL_RANGES[self.codec]
+		if levels is None and self.level is not None:
+			raise ValueError(f"Compression method '{self.codec}' takes no level, got {self.level!r}")
+		if levels is not None and self.level is not None and (type(self.level) is not int or not levels[0] <= self.level <= levels[1]):
+			raise ValueError(f"Invalid level {self.level!r} for compression method '{self.codec}', expected {levels[0]}-{levels[1]}")
+		if self.level is None and _DEFAULT_LEVELS[self.codec] is not None:
+			object.__setattr__(self, "level", _DEFAULT_LEVELS[self.codec])
+
+	@property
+	def compress_type(self) -> int:
+		return _COMPRESS_TYPES[self.codec]
+
+	def __str__(self) -> str:
+		return self.codec if self.level is None else f"{self.codec}-{self.level}"
+
+
+DEFAULT_METHOD = CompressionMethod("deflate", 9)
+
+
+@dataclass(frozen=True)
+class CompressionRule:
+	"""Maps a glob pattern to a compression method."""
+	pattern: str
+	method: CompressionMethod
+
+	def matches(self, arcname: str) -> bool:
+		if "/" in self.pattern:
+			return fnmatch.fnmatchcase(arcname, self.pattern)
+		return fnmatch.fnmatchcase(arcname.rsplit("/", 1)[-1], self.pattern)
+
+
+class CompressionPolicy:
+	"""An ordered list of compression rules; the first matching rule wins."""
+
+	def __init__(self, rules: Iterable[CompressionRule] = (), default: CompressionMethod = DEFAULT_METHOD):
+		self.rules = list(rules)
+		self.default = default
+
+	@classmethod
+	def from_manifest(cls, manifest: dict) -> "CompressionPolicy":
+		"""Reads the "compression" rule list of a manifest. A missing list yields the default policy."""
+		rules = []
+		for raw in manifest.get("compression", []):
+			if "pattern" not in raw or "method" not in raw:
+				raise ValueError(f"Compression rule must have 'pattern' and 'method': {raw}")
+			try:
+				method = CompressionMethod(raw["method"], raw.get("level"))
+			except ValueError as e:
+				raise ValueError(f"Compression rule for '{raw['pattern']}': {e}") from None
+			rules.append(CompressionRule(raw["pattern"], method))
+		return cls(rules)
+
+	def to_manifest(self) -> list:
+		"""Returns the rules in manifest form."""
+		result = []
+		for rule in self.rules:
+			raw = {"pattern": rule.pattern, "method": rule.method.codec}
+			if rule.method.level is not None:
+				raw["level"] = rule.method.level
+			result.append(raw)
+		return result
+
+	def merged_with(self, existing: "CompressionPolicy") -> "CompressionPolicy":
+		"""Returns this policy followed by the rules of existing whose patterns it does not redefine."""
+		patterns = {rule.pattern for rule in self.rules}
+		return CompressionPolicy(self.rules + [rule for rule in existing.rules if rule.pattern not in patterns], self.default)
+
+	def method_for(self, arcname: str) -> CompressionMethod:
+		"""Returns the compression method for an archive member name."""
+		for rule in self.rules:
+			if rule.matches(arcname):
+				return rule.method
+		return self.default
+
+
+class _StoreCompressor:
+	def compress(self, data: bytes) -> bytes:
+		return data
+
+	def flush(self) -> bytes:
+		return b""
+
+
+class _ZipLZMACompressor:
+	"""Raw LZMA1 stream with the 4-byte zip LZMA header (APPNOTE 5.8.8)."""
+
+	def __init__(self, level: int):
+		dict_size = _LZMA_DICT_SIZES[level]
+		# lc=3, lp=0, pb=2 are the liblzma defaults for every preset
+		props = bytes([(2 * 5 + 0) * 9 + 3]) + struct.pack("<I", dict_size)
+		self._header = struct.pack("<BBH", 9, 4, len(props)) + props
+		self._compressor = lzma.LZMACompressor(lzma.FORMAT_RAW, filters=[
+			{"id": lzma.FILTER_LZMA1, "preset": level, "dict_size": dict_size, "lc": 3, "lp": 0, "pb": 2},
+		])
+
+	def compress(self, data: bytes) -> bytes:
+		out = self._compressor.compress(data)
+		if self._header:
+			out = self._header + out
+			self._header = b""
+		return out
+
+	def flush(self) -> bytes:
+		return self._header + self._compressor.flush()
+
+
+def new_compressor(method: CompressionMethod):
+	"""Returns a streaming compressor (compress()/flush()) producing zip member data for method."""
+	if method.codec == "store":
+		return _StoreCompressor()
+	if method.codec == "deflate":
+		return zlib.compressobj(method.level, zlib.DEFLATED, -zlib.MAX_WBITS)
+	if method.codec == "bzip2":
+		return bz2.BZ2Compressor(method.level)
+	return _ZipLZMACompressor(method.level)
+
+
+def file_type_of(arcname: str) -> str:
+	"""Returns the glob that identifies a file's type for auto-tuning (e.g. '*.so')."""
+	name = arcname.rsplit("/", 1)[-1]
+	stem, ext = os.path.splitext(name)
+	if ext and stem:
+		return f"*{ext.lower()}"
+
+	# extensionless files (executables) are tuned individually
+	return name
+
+
+def _measure(method: CompressionMethod, samples: List[bytes]) -> tuple[int, float]:
+	start = time.perf_counter()
+	size = 0
+	for data in samples:
+		compressor = new_compressor(method)
+		size += len(compressor.compress(data)) + len(compressor.flush())
+	return size, time.perf_counter() - start
+
+
+def _read_samples(paths: List[str], budget: int) -> List[bytes]:
+	samples = []
+	for path in sorted(paths, key=os.path.getsize, reverse=True):
+		if budget <= 0:
+			break
+		with open(path, "rb") as f:
+			data = f.read(budget)
+		samples.append(data)
+		budget -= len(data)
+	return samples
+
+
+def auto_tune(files: Iterable[tuple[str, str]], sample_bytes: int = AUTO_TUNE_SAMPLE_BYTES, verbose: bool = True) -> CompressionPolicy:
+	"""Measures each candidate codec on samples of every file type and recommends a policy.
+
+	files is an iterable of (absolute_path, arcname). For each type the cheapest candidate is
+	kept unless a slower one saves at least AUTO_TUNE_MIN_GAIN of the output at no more than
+	AUTO_TUNE_MAX_SECONDS_PER_MB_SAVED.
+	"""
+	by_type: dict[str, List[str]] = {}
+	for abs_path, arcname in files:
+		if os.path.isfile(abs_path):
+			by_type.setdefault(file_type_of(arcname), []).append(abs_path)
+
+	rules = []
+	for file_type in sorted(by_type):
+		samples = _read_samples(by_type[file_type], sample_bytes)
+		raw_size = sum(len(s) for s in samples)
+		if raw_size == 0:
+			continue
+
+		measured = []
+		for codec, level in AUTO_TUNE_CANDIDATES:
+			method = CompressionMethod(codec, level)
+			size, seconds = _measure(method, samples)
+			measured.append((method, size, seconds))
+
+		# walk candidates from fastest to slowest, upgrading only when the saving pays for the time
+		measured.sort(key=lambda m: m[2])
+		best_method, best_size, best_seconds = measured[0]
+		for method, size, seconds in measured[1:]:
+			saved = best_size - size
+			if saved <= 0 or saved < best_size * AUTO_TUNE_MIN_GAIN:
+				continue
+			if (seconds - best_seconds) / (saved / (1024 * 1024)) > AUTO_TUNE_MAX_SECONDS_PER_MB_SAVED:
+				continue
+			best_method, best_size, best_seconds = method, size, seconds
+
+		if verbose:
+			print(f"  {file_type}: {len(by_type[file_type])} file(s), sampled {raw_size:,} bytes")
+			for method, size, seconds in sorted(measured, key=lambda m: m[1]):
+				marker = "*" if method == best_method else " "
+				print(f"    {marker} {str(method):<10} {size:>14,} bytes ({100.0 * size / raw_size:5.1f}%) {seconds:8.3f}s")
+
+		rules.append(CompressionRule(file_type, best_method))
+
+	return CompressionPolicy(rules)
+
+
+_WHITESPACE = re.compile(r"\s*")
+
+
+def _top_level_value_span(text: str, key: str) -> tuple[int, int] | None:
+	"""Returns the (start, end) offsets of the value of a key of the top-level JSON object in text, or None."""
+	decoder = json.JSONDecoder()
+	pos = _WHITESPACE.match(text, text.index("{") + 1).end()
+	while text[pos] != "}":
+		name, pos = decoder.raw_decode(text, pos)
+		pos = _WHITESPACE.match(text, pos).end() + 1  # ':'
+		start = _WHITESPACE.match(text, pos).end()
+		_, end = decoder.raw_decode(text, start)
+		if name == key:
+			return start, end
+		pos = _WHITESPACE.match(text, end).end()
+		if text[pos] == ",":
+			pos = _WHITESPACE.match(text, pos + 1).end()
+	return None
+
+
+def write_manifest_policy(manifest_path: str, policy: CompressionPolicy):
+	"""Replaces the "compression" list of a manifest file with policy.
+
+	Only the text of that list changes (it is added as the first key if missing), so the
+	formatting of the rest of the manifest is kept. Rules go one per line, indented like the
+	top-level keys, unless the whole manifest is written on a single line.
+	"""
+	with open(manifest_path, "r") as f:
+		text = f.read()
+
+	first_key = _WHITESPACE.match(text, text.index("{") + 1)
+	empty = text[first_key.end()] == "}"
+	if "\n" not in text.strip():
+		value = json.dumps(policy.to_manifest(), separators=(",", ":"))
+		key, separator = '"compression":', "" if empty else ","
+	else:
+		indent = first_key.group().rpartition("\n")[2] or "  "
+		rules = ["{ " + ", ".join(f"{json.dumps(k)}: {json.dumps(v)}" for k, v in rule.items()) + " }" for rule in policy.to_manifest()]
+		value = "[\n" + ",\n".join(indent * 2 + rule for rule in rules) + "\n" + indent + "]" if rules else "[]"
+		key, separator = "\n" + indent + '"compression": ', "\n" if empty else "," + first_key.group()
+
+	span = _top_level_value_span(text, "compression")
+	if span is not None:
+		text = text[:span[0]] + value + text[span[1]:]
+	else:
+		text = text[:first_key.start()] + key + value + separator + text[first_key.end():]
+
+	with open(manifest_path, "w") as f:
+		f.write(text)
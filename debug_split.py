@@ -0,0 +1,236 @@
+"""
+Symbol stripping stage: ship stripped ELF binaries and keep their debug info in separate archives.
+
+Manifests select the binaries to strip with a top-level "strip" list of patterns (as the
+"compression" rules: patterns without a '/' match the file name, patterns with a '/' match
+the full archive name):
+
+  "strip": ["*.so", "metaffi"]
+
+With --strip, every selected ELF file is split with objcopy ($OBJCOPY, default objcopy) into
+a stripped binary, which is packaged instead of the original, and its debug info. The debug
+info of an artifact goes into metaffi-debug-<artifact>.zip next to it, at the path debuggers
+look up by build-id:
+
+  .build-id/<first 2 hex digits>/<remaining digits>.debug
+
+The stripped binary keeps its build-id note and gets a .gnu_debuglink to <file name>.debug.
+Binaries without a build-id are stored under by-name/<arcname>.debug instead. Files that are
+not ELF (e.g. Windows PE binaries) are packaged unchanged. debug_manifest.json in the debug
+archive lists, per binary, its build-id, debug file and the sizes before and after stripping.
+"""
+
+import argparse
+import atexit
+import fnmatch
+import json
+import os
+import shutil
+import struct
+import subprocess
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, replace
+from typing import List
+
+from build_metrics import phase
+from packaging_engine import PackageEntry, default_workers, write_zip
+
+
+DEBUG_MANIFEST_NAME = "debug_manifest.json"
+
+ELF_MAGIC = b"\x7fELF"
+# e_ident through e_shstrndx of a 64-bit ELF header (a 32-bit header is 52 bytes)
+ELF_HEADER_SIZE = 64
+SHT_NOTE = 7
+NT_GNU_BUILD_ID = 3
+
+
+@dataclass
+class StrippedBinary:
+	"""A binary split into its stripped file and its debug info."""
+	arcname: str
+	build_id: str | None
+	stripped_path: str
+	debug_path: str
+	original_size: int
+	stripped_size: int
+
+	@property
+	def debug_arcname(self) -> str:
+		if self.build_id is None:
+			return f"by-name/{self.arcname}.debug"
+		return f".build-id/{self.build_id[:2]}/{self.build_id[2:]}.debug"
+
+
+def is_elf(path: str) -> bool:
+	with open(path, "rb") as f:
+		return f.read(4) == ELF_MAGIC
+
+
+def elf_build_id(path: str) -> str | None:
+	"""Returns the GNU build-id of an ELF file as hex, from its SHT_NOTE sections, or None if it has none.
+
+	Only the ELF header, the section header table and the note sections are read.
+	"""
+	with open(path, "rb") as f:
+		header = f.read(ELF_HEADER_SIZE)
+		is_64 = header[4] == 2
+		endian = "<" if header[5] == 1 else ">"
+		if is_64:
+			shoff, = struct.unpack_from(endian + "Q", header, 0x28)
+			shentsize, shnum = struct.unpack_from(endian + "HH", header, 0x3A)
+			section = endian + "IIQQQQIIQQ"
+		else:
+			shoff, = struct.unpack_from(endian + "I", header, 0x20)
+			shentsize, shnum = struct.unpack_from(endian + "HH", header, 0x2E)
+			section = endian + "IIIIIIIIII"
+		f.seek(shoff)
+		table = f.read(shnum * shentsize)
+
+		for i in range(shnum):
+			_, sh_type, _, _, offset, size, *_ = struct.unpack_from(section, table, i * shentsize)
+			if sh_type != SHT_NOTE:
+				continue
+			f.seek(offset)
+			notes = f.read(size)
+			pos = 0
+			while pos + 12 <= len(notes):
+				namesz, descsz, note_type = struct.unpack_from(endian + "III", notes, pos)
+				name_start = pos + 12
+				desc_start = name_start + (namesz + 3) // 4 * 4
+				if note_type == NT_GNU_BUILD_ID and notes[name_start:name_start + namesz].rstrip(b"\0") == b"GNU":
+					return notes[desc_start:desc_start + descsz].hex()
+				pos = desc_start + (descsz + 3) // 4 * 4
+	return None
+
+
+def matches_strip_pattern(arcname: str, patterns: List[str]) -> bool:
+	for pattern in patterns:
+		name = arcname if "/" in pattern else arcname.rsplit("/", 1)[-1]
+		if fnmatch.fnmatchcase(name, pattern):
+			return True
+	return False
+
+
+def objcopy_path() -> str:
+	objcopy = os.environ.get("OBJCOPY") or shutil.which("objcopy")
+	if objcopy is None:
+		raise FileNotFoundError("objcopy (binutils) is required for --strip; install it or set $OBJCOPY")
+	return objcopy
+
+
+def split_debug_info(src: str, arcname: str, out_dir: str) -> StrippedBinary:
+	"""Writes the stripped binary and the debug info of an ELF file into out_dir."""
+	objcopy = objcopy_path()
+	os.makedirs(out_dir, exist_ok=True)
+	name = os.path.basename(arcname)
+	debug_path = os.path.join(out_dir, f"{name}.debug")
+	stripped_path = os.path.join(out_dir, name)
+	subprocess.run([objcopy, "--only-keep-debug", src, debug_path], check=True)
+	subprocess.run([objcopy, "--strip-unneeded", f"--add-gnu-debuglink={debug_path}", src, stripped_path], check=True)
+	shutil.copymode(src, stripped_path)
+	return StrippedBinary(arcname=arcname, build_id=elf_build_id(src), stripped_path=stripped_path, debug_path=debug_path,
+						  original_size=os.path.getsize(src), stripped_size=os.path.getsize(stripped_path))
+
+
+def debug_archive_path(artifact_path: str) -> str:
+	"""Returns the debug archive of an artifact: metaffi-core-1.0-ubuntu.zip -> metaffi-debug-core-1.0-ubuntu.zip."""
+	name = os.path.basename(artifact_path)
+	for extension in (".zip", ".exe"):
+		name = name.removesuffix(extension)
+	return os.path.join(os.path.dirname(artifact_path), f"metaffi-debug-{name.removeprefix('metaffi-')}.zip")
+
+
+def write_debug_archive(path: str, binaries: List[StrippedBinary], work_dir: str, workers: int | None = None):
+	manifest = {
+		binary.arcname: {
+			"build_id": binary.build_id,
+			"debug_file": binary.debug_arcname,
+			"original_size": binary.original_size,
+			"stripped_size": binary.stripped_size,
+			"debug_size": os.path.getsize(binary.debug_path),
+		}
+		for binary in binaries
+	}
+	manifest_path = os.path.join(work_dir, DEBUG_MANIFEST_NAME)
+	with open(manifest_path, "w") as f:
+		json.dump(manifest, f, indent=2, sort_keys=True)
+
+	entries = [PackageEntry(src=manifest_path, arcname=DEBUG_MANIFEST_NAME)]
+	entries += [PackageEntry(src=binary.debug_path, arcname=binary.debug_arcname) for binary in binaries]
+	with open(path, "wb") as f:
+		write_zip(f, entries, workers=workers)
+
+
+def print_strip_report(artifact_path: str, binaries: List[StrippedBinary], debug_path: str):
+	original = sum(binary.original_size for binary in binaries)
+	stripped = sum(binary.stripped_size for binary in binaries)
+	print(f"\nStripped {len(binaries)} binaries of {os.path.basename(artifact_path)}: {original:,} -> {stripped:,} bytes "
+		  f"(saved {original - stripped:,} bytes, {100.0 * (original - stripped) / original if original else 0.0:.1f}%)")
+	for binary in binaries:
+		print(f"  {binary.arcname:<40} {binary.original_size:>14,} -> {binary.stripped_size:>14,}  build-id {binary.build_id or '(none)'}")
+	print(f"Debug info: {os.path.abspath(debug_path)}")
+
+
+_strip = False
+_work_dir: str | None = None
+_work_dir_lock = threading.Lock()
+
+
+def _stage_dir() -> str:
+	"""Returns the directory holding the stripped files of this run, removed at exit."""
+	global _work_dir
+	with _work_dir_lock:
+		if _work_dir is None:
+			_work_dir = tempfile.mkdtemp(prefix="metaffi-strip-")
+			atexit.register(shutil.rmtree, _work_dir, ignore_errors=True)
+		return _work_dir
+
+
+def strip_package_entries(artifact_path: str, entries: List[PackageEntry], patterns: List[str], workers: int | None = None) -> List[PackageEntry]:
+	"""With --strip, packages stripped copies of the ELF files matching patterns and writes their debug archive next to artifact_path.
+
+	Returns the entries to package: unchanged without --strip, otherwise with the selected binaries replaced by their stripped copies.
+	"""
+	if not _strip or not patterns:
+		return entries
+	selected = [entry for entry in entries if not os.path.isdir(entry.src) and matches_strip_pattern(entry.arcname, patterns) and is_elf(entry.src)]
+	if not selected:
+		return entries
+
+	with phase("strip debug info", bytes_in=sum(os.path.getsize(entry.src) for entry in selected)) as record:
+		work_dir = tempfile.mkdtemp(prefix=os.path.basename(artifact_path) + "-", dir=_stage_dir())
+		with ThreadPoolExecutor(max_workers=workers or default_workers()) as pool:
+			binaries = list(pool.map(lambda item: split_debug_info(item[1].src, item[1].arcname, os.path.join(work_dir, str(item[0]))),
+									 enumerate(selected)))
+		# keep the original where stripping saves nothing (already stripped binaries)
+		binaries = [binary for binary in binaries if binary.stripped_size < binary.original_size]
+		record.bytes_out = sum(binary.stripped_size for binary in binaries)
+		if not binaries:
+			return entries
+
+		debug_path = debug_archive_path(artifact_path)
+		write_debug_archive(debug_path, binaries, work_dir, workers)
+		print_strip_report(artifact_path, binaries, debug_path)
+
+	stripped = {binary.arcname: binary.stripped_path for binary in binaries}
+	return [replace(entry, src=stripped[entry.arcname]) if entry.arcname in stripped else entry for entry in entries]
+
+
+def strip_settings(patterns: List[str]) -> dict:
+	"""Returns the strip switch and patterns a package depends on, for build fingerprints."""
+	return {"enabled": _strip, "patterns": list(patterns)}
+
+
+def add_strip_arguments(parser: argparse.ArgumentParser):
+	"""Adds the --strip switch shared by the archive builders."""
+	parser.add_argument("--strip", action="store_true",
+						help="Package stripped copies of the ELF binaries matching the manifest's \"strip\" patterns and write their debug info into metaffi-debug-*.zip")
+
+
+def configure_strip(args: argparse.Namespace):
+	"""Applies the --strip switch to every package built from now on."""
+	global _strip
+	_strip = args.strip
@@ -0,0 +1,369 @@
+"""
+Binary patches and delta packages between two releases of a core or plugin zip.
+
+A binary patch turns one version of a file into the next (all integers little-endian):
+
+  header   8s magic "MFFIDLTA", u16 format version, u64 base size, u64 target size,
+           32s SHA-256 of the base file, 32s SHA-256 of the target file
+  body     xz stream of: u64 length of the instruction stream, the instructions, the literal bytes
+
+Instructions are u8 opcode, u64, u64: COPY (base offset, length) copies a range of the base
+file, INSERT (length, 0) takes the next bytes of the literal stream.
+
+Patches are made from memory-mapped files. The common prefix and suffix are found first by
+comparing chunks. In between, matches are looked up only at anchors: positions holding one
+of a few byte values picked from the base file, which the regex engine finds without any
+Python work per byte. The MATCH_BLOCK bytes at each base anchor are indexed by hash. A target
+anchor whose block is in the index starts a match, which is extended in both directions over
+the whole common run, and the scan resumes after it. Anchors depend on the content, not on
+offsets, so insertions and deletions do not shift them. A patch is applied as a stream: the
+instructions are read first, then the target is written while the literals are decompressed,
+with COPY ranges read from the base file.
+
+A delta package is a zip holding delta_manifest.json, the full content of added files under
+add/ and the patches of changed files under patch/. The manifest records the SHA-256 of every
+file of the base release; a package is only applied to an installation whose files all match
+it, and names that would leave the installation directory are rejected. The matching applier
+lives in the installer templates (templates/metaffi_installer_template.py
+and templates/metaffi_plugin_installer_template.py).
+"""
+
+import collections
+import contextlib
+import hashlib
+import json
+import lzma
+import mmap
+import ntpath
+import os
+import posixpath
+import re
+import struct
+import tempfile
+import zipfile
+from typing import BinaryIO, Dict, Iterable, List
+
+
+DELTA_MAGIC = b"MFFIDLTA"
+DELTA_FORMAT_VERSION = 1
+
+DELTA_MANIFEST_NAME = "delta_manifest.json"
+
+HEADER_STRUCT = "<8sHQQ32s32s"
+HEADER_SIZE = struct.calcsize(HEADER_STRUCT)
+OP_STRUCT = "<BQQ"
+OP_SIZE = struct.calcsize(OP_STRUCT)
+
+OP_COPY = 0
+OP_INSERT = 1
+
+# Length of the block compared at an anchor; common runs shorter than this are not found
+MATCH_BLOCK = 64
+
+# Average distance between anchors the anchor bytes are picked for, the most byte values used per pass,
+# the most passes, and the share of the unmatched bytes a pass must match for another pass to run
+ANCHOR_SPACING = 256
+ANCHOR_BYTES = 4
+ANCHOR_PASSES = 4
+ANCHOR_PASS_MIN_MATCHED = 0.01
+
+# Bytes of the base file sampled to pick the anchor bytes, in slices of ANCHOR_SAMPLE_SLICE
+ANCHOR_SAMPLE_SIZE = 1024 * 1024
+ANCHOR_SAMPLE_SLICE = 64 * 1024
+
+# xz preset of the instruction and literal stream: within a few percent of preset 6, at half the time or less
+PATCH_PRESET = 3
+
+COPY_CHUNK_SIZE = 1024 * 1024
+
+_EXTEND_STEPS = (64 * 1024, 4096, 256, 16, 1)
+
+
+@contextlib.contextmanager
+def _mapped(path: str):
+	"""Yields the read-only memory map of a file (empty bytes for an empty file)."""
+	with open(path, "rb") as f:
+		if os.fstat(f.fileno()).st_size == 0:
+			yield b""
+			return
+		with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+			yield data
+
+
+def _forward_match(base, base_pos: int, target, target_pos: int, limit: int) -> int:
+	"""Returns the length, up to limit, of the common run of base[base_pos:] and target[target_pos:]."""
+	limit = min(limit, len(base) - base_pos, len(target) - target_pos)
+	length = 0
+	for step in _EXTEND_STEPS:
+		while length + step <= limit and base[base_pos + length:base_pos + length + step] == target[target_pos + length:target_pos + length + step]:
+			length += step
+	return length
+
+
+def _backward_match(base, base_end: int, target, target_end: int, limit: int) -> int:
+	"""Returns the length, up to limit, of the common run of base[:base_end] and target[:target_end]."""
+	limit = min(limit, base_end, target_end)
+	length = 0
+	for step in _EXTEND_STEPS:
+		while length + step <= limit and base[base_end - length - step:base_end - length] == target[target_end - length - step:target_end - length]:
+			length += step
+	return length
+
+
+def _sample_counts(regions: Iterable[tuple[int, int]], data) -> collections.Counter:
+	"""Returns the byte value counts of up to ANCHOR_SAMPLE_SIZE bytes sampled evenly from regions of data."""
+	regions = list(regions)
+	total = sum(end - start for start, end in regions)
+	stride = max(ANCHOR_SAMPLE_SLICE, total * ANCHOR_SAMPLE_SLICE // ANCHOR_SAMPLE_SIZE)
+	counts = collections.Counter()
+	skip = 0
+	for start, end in regions:
+		offset = start + skip
+		while offset < end:
+			counts.update(data[offset:min(end, offset + ANCHOR_SAMPLE_SLICE)])
+			offset += stride
+		skip = offset - end
+	return counts
+
+
+def _anchor_bytes(counts: collections.Counter, used: set[int]) -> list[int]:
+	"""Returns the anchor bytes of a pass: the unused byte values whose frequency in counts is closest to one in
+	ANCHOR_SPACING * ANCHOR_BYTES, as many as needed (at most ANCHOR_BYTES) to make up one in ANCHOR_SPACING together."""
+	sampled = max(1, sum(counts.values()))
+	wanted = 1.0 / (ANCHOR_SPACING * ANCHOR_BYTES)
+	values = []
+	for value in sorted(set(range(256)) - used, key=lambda value: (abs(counts[value] / sampled - wanted), value))[:ANCHOR_BYTES]:
+		if not counts[value]:
+			break
+		values.append(value)
+		if sum(counts[v] for v in values) * ANCHOR_SPACING >= sampled:
+			break
+	return values
+
+
+def _match_gap(base, target, pattern: re.Pattern, index: Dict[int, int], gap_start: int, gap_end: int) -> List[tuple[int, int, int]]:
+	"""Returns the runs of target[gap_start:gap_end] found in base through the anchors of pattern."""
+	copies = []
+	pos = literal_start = gap_start
+	while True:
+		anchor = pattern.search(target, pos, gap_end - MATCH_BLOCK + 1)
+		if anchor is None:
+			return copies
+		pos = anchor.start()
+		block = target[pos:pos + MATCH_BLOCK]
+		offset = index.get(hash(block))
+		if offset is None or base[offset:offset + MATCH_BLOCK] != block:
+			pos += 1
+			continue
+
+		# grow the match backwards into the pending literal bytes, then forwards
+		back = _backward_match(base, offset, target, pos, pos - literal_start)
+		length = back + _forward_match(base, offset, target, pos, gap_end - pos)
+		copies.append((pos - back, offset - back, length))
+		pos = literal_start = pos - back + length
+
+
+def _find_copies(base, target) -> List[tuple[int, int, int]]:
+	"""Returns the (target offset, base offset, length) runs of target copied from base, in target order.
+
+	The first pass picks its anchor bytes from base; every further pass picks new ones from the target
+	bytes still unmatched and scans only those, until a pass matches less than ANCHOR_PASS_MIN_MATCHED of
+	them or ANCHOR_PASSES are done.
+	"""
+	prefix = _forward_match(base, 0, target, 0, len(target))
+	suffix = _backward_match(base, len(base), target, len(target), min(len(base), len(target)) - prefix)
+	copies = [(0, 0, prefix), (len(target) - suffix, len(base) - suffix, suffix)]
+	gaps = [(prefix, len(target) - suffix)]
+
+	counts = _sample_counts([(0, len(base))], base)
+	used: set[int] = set()
+	for _ in range(ANCHOR_PASSES):
+		gaps = [(start, end) for start, end in gaps if end - start >= MATCH_BLOCK]
+		values = _anchor_bytes(counts, used)
+		if not gaps or not values:
+			break
+		used.update(values)
+		pattern = re.compile(b"[" + b"".join(re.escape(bytes([value])) for value in values) + b"]")
+		# built without a Python loop: {hash of the block at an anchor: its offset}
+		offsets = list(map(re.Match.start, pattern.finditer(base, 0, max(0, len(base) - MATCH_BLOCK + 1))))
+		blocks = map(base.__getitem__, map(slice, offsets, map(MATCH_BLOCK.__add__, offsets)))
+		index = dict(zip(map(hash, blocks), offsets))
+
+		found = []
+		remaining = []
+		for gap_start, gap_end in gaps:
+			position = gap_start
+			for copy in _match_gap(base, target, pattern, index, gap_start, gap_end):
+				remaining.append((position, copy[0]))
+				position = copy[0] + copy[2]
+				found.append(copy)
+			remaining.append((position, gap_end))
+		copies += found
+		if sum(copy[2] for copy in found) < ANCHOR_PASS_MIN_MATCHED * sum(end - start for start, end in gaps):
+			break
+		gaps = remaining
+		counts = _sample_counts(gaps, target)
+
+	return sorted(copy for copy in copies if copy[2])
+
+
+def create_patch(base_path: str, target_path: str, patch_path: str):
+	"""Writes a binary patch that turns the file at base_path into the one at target_path to patch_path."""
+	with _mapped(base_path) as base, _mapped(target_path) as target:
+		ops = bytearray()
+		literals: List[tuple[int, int]] = []
+		position = 0
+		for start, base_start, length in _find_copies(base, target):
+			if start > position:
+				ops += struct.pack(OP_STRUCT, OP_INSERT, start - position, 0)
+				literals.append((position, start))
+			ops += struct.pack(OP_STRUCT, OP_COPY, base_start, length)
+			position = start + length
+		if position < len(target):
+			ops += struct.pack(OP_STRUCT, OP_INSERT, len(target) - position, 0)
+			literals.append((position, len(target)))
+
+		with open(patch_path, "wb") as out:
+			out.write(struct.pack(HEADER_STRUCT, DELTA_MAGIC, DELTA_FORMAT_VERSION, len(base), len(target),
+								  hashlib.sha256(base).digest(), hashlib.sha256(target).digest()))
+			compressor = lzma.LZMACompressor(preset=PATCH_PRESET)
+			out.write(compressor.compress(struct.pack("<Q", len(ops)) + bytes(ops)))
+			for start, end in literals:
+				for chunk_start in range(start, end, COPY_CHUNK_SIZE):
+					out.write(compressor.compress(target[chunk_start:min(end, chunk_start + COPY_CHUNK_SIZE)]))
+			out.write(compressor.flush())
+
+
+class _PatchBody:
+	"""Reads the xz body of a binary patch, decompressing at most the requested bytes at a time."""
+
+	def __init__(self, patch: BinaryIO):
+		self._patch = patch
+		self._decompressor = lzma.LZMADecompressor()
+
+	def read(self, size: int) -> bytes:
+		"""Returns the next size bytes of the body; raises ValueError if it ends before."""
+		parts = []
+		while size > 0:
+			data = self._patch.read(COPY_CHUNK_SIZE) if self._decompressor.needs_input else b""
+			if self._decompressor.eof or (not data and self._decompressor.needs_input):
+				raise ValueError("Binary patch is truncated")
+			chunk = self._decompressor.decompress(data, max_length=min(size, COPY_CHUNK_SIZE))
+			parts.append(chunk)
+			size -= len(chunk)
+		return b"".join(parts)
+
+
+def _copy_hashed(read, size: int, out: BinaryIO, digest) -> None:
+	"""Writes size bytes returned by read(n) calls to out, adding them to digest."""
+	while size > 0:
+		chunk = read(min(size, COPY_CHUNK_SIZE))
+		if not chunk:
+			raise ValueError("Binary patch refers past the end of the base file")
+		digest.update(chunk)
+		out.write(chunk)
+		size -= len(chunk)
+
+
+def apply_patch(base_path: str, patch: BinaryIO, out: BinaryIO):
+	"""Applies the binary patch read from patch to the file at base_path and writes the target to out.
+
+	The base is hashed and copied from in chunks, the patch body is decompressed as it is consumed
+	and the target is hashed as it is written, so no file is held in memory whole. Raises ValueError
+	if the base or the written target does not match the patch hashes.
+	"""
+	header = patch.read(HEADER_SIZE)
+	if len(header) != HEADER_SIZE:
+		raise ValueError("Not a MetaFFI binary patch (truncated header)")
+	magic, version, base_size, target_size, base_sha256, target_sha256 = struct.unpack(HEADER_STRUCT, header)
+	if magic != DELTA_MAGIC:
+		raise ValueError("Not a MetaFFI binary patch (bad magic)")
+	if version != DELTA_FORMAT_VERSION:
+		raise ValueError(f"Unsupported binary patch version {version}")
+
+	with open(base_path, "rb") as base:
+		if os.fstat(base.fileno()).st_size != base_size or hashlib.file_digest(base, "sha256").digest() != base_sha256:
+			raise ValueError("Binary patch does not apply: the base file does not match")
+
+		body = _PatchBody(patch)
+		ops = body.read(struct.unpack("<Q", body.read(8))[0])
+		digest = hashlib.sha256()
+		written = 0
+		for op, a, b in struct.iter_unpack(OP_STRUCT, ops):
+			if op == OP_COPY:
+				base.seek(a)
+				_copy_hashed(base.read, b, out, digest)
+				written += b
+			else:
+				_copy_hashed(body.read, a, out, digest)
+				written += a
+
+	if written != target_size or digest.digest() != target_sha256:
+		raise ValueError("Binary patch produced a corrupted file")
+
+
+def install_path(install_dir: str, name: str) -> str:
+	"""Returns the path of the file name (relative, '/'-separated) in install_dir.
+
+	Absolute names, drive letters and names whose '..' components leave install_dir raise ValueError.
+	"""
+	normalized = posixpath.normpath(name.replace("\\", "/"))
+	if posixpath.isabs(normalized) or ntpath.splitdrive(normalized)[0] or normalized in (".", "..") or normalized.startswith("../"):
+		raise ValueError(f"Refusing to install {name!r}: it is not a path inside {install_dir}")
+	return os.path.join(install_dir, *normalized.split("/"))
+
+
+def _file_sha256(path: str) -> str | None:
+	try:
+		with open(path, "rb") as f:
+			return hashlib.file_digest(f, "sha256").hexdigest()
+	except FileNotFoundError:
+		return None
+
+
+def apply_delta_package(package_path: str, install_dir: str) -> dict:
+	"""Applies a delta package to an installation of its base release and returns the manifest.
+
+	Every file name is checked to stay inside install_dir and every file of the base release is
+	verified by hash before anything is changed; new file contents are streamed into temporary
+	files next to their destination and only then moved into place.
+	"""
+	with zipfile.ZipFile(package_path) as package:
+		manifest = json.loads(package.read(DELTA_MANIFEST_NAME))
+		if manifest.get("format") != DELTA_FORMAT_VERSION:
+			raise ValueError(f"Unsupported delta package format {manifest.get('format')}")
+
+		paths = {name: install_path(install_dir, name) for name in [*manifest["base"], *manifest["files"], *manifest["removed"]]}
+		mismatched = [name for name, digest in manifest["base"].items() if _file_sha256(paths[name]) != digest]
+		if mismatched:
+			raise ValueError(f"{install_dir} is not {manifest['base_name']}: {len(mismatched)} file(s) differ, e.g. {mismatched[0]}")
+
+		prepared = []
+		try:
+			for name, entry in manifest["files"].items():
+				destination = paths[name]
+				os.makedirs(os.path.dirname(destination), exist_ok=True)
+				fd, temp_path = tempfile.mkstemp(prefix=".delta_", dir=os.path.dirname(destination))
+				prepared.append((temp_path, destination))
+				with os.fdopen(fd, "wb") as out, package.open(entry["member"]) as member:
+					if entry["action"] == "patch":
+						apply_patch(destination, member, out)
+					else:
+						digest = hashlib.sha256()
+						while chunk := member.read(COPY_CHUNK_SIZE):
+							digest.update(chunk)
+							out.write(chunk)
+						if digest.hexdigest() != entry["sha256"]:
+							raise ValueError(f"Delta package member {entry['member']} is corrupted")
+				if entry.get("mode"):
+					os.chmod(temp_path, entry["mode"])
+		except BaseException:
+			for temp_path, _ in prepared:
+				os.remove(temp_path)
+			raise
+
+	for temp_path, destination in prepared:
+		os.replace(temp_path, destination)
+	for name in manifest["removed"]:
+		os.remove(paths[name])
+	return manifest
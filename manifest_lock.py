@@ -0,0 +1,206 @@
+"""
+Lock files of the resolved manifests: the exact files, sizes and SHA-256 digests that went into an artifact.
+
+Every builder writes <artifact>.lock.json next to the artifact it packages:
+
+  {
+    "format": 1,
+    "inputs": "<sha256 of the manifest entries and roots that were resolved>",
+    "directories": { "<directory>": <st_mtime_ns, or null if it did not exist> },
+    "files": { "<group>": [ { "arcname": ..., "src": ..., "size": ..., "mtime_ns": ..., "sha256": ... } ] }
+  }
+
+The directories are the ones the resolution listed (see manifest_resolver). A later build with
+the same inputs takes the file list from the lock instead of resolving the manifest again as
+long as none of those directories changed (adding, removing or renaming a file changes the
+modification time of its directory) and every locked file still exists. Digests of files whose
+size and modification time match the lock are reused; the other files are hashed in parallel,
+largest first. Reused digests also seed the digest memo of compression_cache, so the build
+fingerprint, the compression cache and deduplication do not hash those files again.
+--relock ignores existing locks.
+
+Packages carry files.lock.json, the size and SHA-256 of every other file they install, which
+the installers check after installing (see INSTALLER_CONTRACT.md).
+"""
+
+import argparse
+import atexit
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List
+
+from build_metrics import phase
+from compression_cache import remember_digest, sha256_file
+from manifest_resolver import ResolvedFile, record_scanned_directories
+from packaging_engine import PackageEntry, default_workers
+
+
+LOCK_FORMAT_VERSION = 1
+
+LOCK_SUFFIX = ".lock.json"
+
+# Lock of the installed files, packaged at the root of core and plugin packages
+INSTALLED_LOCK_NAME = "files.lock.json"
+
+
+def lock_path(artifact_path: str) -> str:
+	return artifact_path + LOCK_SUFFIX
+
+
+def inputs_digest(inputs: dict) -> str:
+	"""Returns the digest of what a resolution depends on besides the file system, with environment variables expanded."""
+	return hashlib.sha256(os.path.expandvars(json.dumps(inputs, sort_keys=True)).encode("utf-8")).hexdigest()
+
+
+def load_lock(artifact_path: str) -> dict | None:
+	"""Returns the lock of an artifact, or None if there is none or it has another format."""
+	try:
+		with open(lock_path(artifact_path), "r") as f:
+			lock = json.load(f)
+	except (OSError, ValueError):
+		return None
+	return lock if lock.get("format") == LOCK_FORMAT_VERSION else None
+
+
+def directories_unchanged(directories: Dict[str, int | None]) -> bool:
+	for path, mtime_ns in directories.items():
+		try:
+			if os.stat(path).st_mtime_ns != mtime_ns:
+				return False
+		except OSError:
+			if mtime_ns is not None:
+				return False
+	return True
+
+
+def remember_locked_digests(lock: dict) -> Dict[str, os.stat_result]:
+	"""Seeds the digest memo with the locked files whose size and modification time are unchanged.
+
+	Returns {src: stat} of the locked files that still exist.
+	"""
+	stats: Dict[str, os.stat_result] = {}
+	for files in lock["files"].values():
+		for file in files:
+			try:
+				st = os.stat(file["src"])
+			except OSError:
+				continue
+			stats[file["src"]] = st
+			if (st.st_size, st.st_mtime_ns) == (file["size"], file["mtime_ns"]):
+				remember_digest(file["src"], st.st_size, st.st_mtime_ns, file["sha256"])
+	return stats
+
+
+def locked_files(lock: dict, stats: Dict[str, os.stat_result]) -> Dict[str, List[ResolvedFile]] | None:
+	"""Returns the files of a lock with their current stat data, or None if any of them is gone."""
+	if any(file["src"] not in stats for files in lock["files"].values() for file in files):
+		return None
+	return {
+		group: [ResolvedFile(src=file["src"], arcname=file["arcname"], size=stats[file["src"]].st_size, mtime=stats[file["src"]].st_mtime)
+				for file in files]
+		for group, files in lock["files"].items()
+	}
+
+
+def hash_files(files: List[ResolvedFile], workers: int | None = None) -> List[dict]:
+	"""Returns the lock records of files, hashing them in parallel, largest first."""
+	def record(file: ResolvedFile) -> dict:
+		st = os.stat(file.src)
+		return {"arcname": file.arcname, "src": file.src, "size": st.st_size, "mtime_ns": st.st_mtime_ns, "sha256": sha256_file(file.src)}
+
+	order = sorted(range(len(files)), key=lambda i: -files[i].size)
+	with ThreadPoolExecutor(max_workers=workers or default_workers()) as pool:
+		records = dict(zip(order, pool.map(lambda i: record(files[i]), order)))
+	return [records[i] for i in range(len(files))]
+
+
+_relock = False
+
+
+def resolve_locked(artifact_path: str, inputs: dict, resolve: Callable[[], Dict[str, List[ResolvedFile]]],
+				   workers: int | None = None) -> Dict[str, List[ResolvedFile]]:
+	"""Resolves the files of an artifact through its lock and writes the updated lock.
+
+	inputs is everything the resolution depends on besides the file system (manifest entries,
+	roots, ...); resolve returns the resolved files by group and runs only if the lock cannot
+	be reused.
+	"""
+	digest = inputs_digest(inputs)
+	previous = None if _relock else load_lock(artifact_path)
+	files = None
+	if previous is not None:
+		stats = remember_locked_digests(previous)
+		if previous["inputs"] == digest and directories_unchanged(previous["directories"]):
+			files = locked_files(previous, stats)
+
+	reused = files is not None
+	if reused:
+		directories = previous["directories"]
+		print(f"Resolved {sum(len(group) for group in files.values())} files from {lock_path(artifact_path)}")
+	else:
+		with record_scanned_directories() as directories:
+			files = resolve()
+
+	all_files = [file for group in files.values() for file in group]
+	with phase("hash files", bytes_in=sum(file.size for file in all_files)) as record:
+		records = hash_files(all_files, workers)
+		record.args.update(files=len(all_files), reused_lock=reused)
+
+	lock = {"format": LOCK_FORMAT_VERSION, "inputs": digest, "directories": directories, "files": {}}
+	position = 0
+	for group, group_files in files.items():
+		lock["files"][group] = records[position:position + len(group_files)]
+		position += len(group_files)
+	os.makedirs(os.path.dirname(os.path.abspath(artifact_path)), exist_ok=True)
+	with open(lock_path(artifact_path), "w") as f:
+		json.dump(lock, f, indent=2, sort_keys=True)
+		f.write("\n")
+	return files
+
+
+_work_dir: str | None = None
+_work_dir_lock = threading.Lock()
+
+
+def _stage_dir() -> str:
+	"""Returns the directory holding the installed file locks of this run, removed at exit."""
+	global _work_dir
+	with _work_dir_lock:
+		if _work_dir is None:
+			_work_dir = tempfile.mkdtemp(prefix="metaffi-lock-")
+			atexit.register(shutil.rmtree, _work_dir, ignore_errors=True)
+		return _work_dir
+
+
+def add_installed_lock(entries: List[PackageEntry], workers: int | None = None) -> List[PackageEntry]:
+	"""Returns entries with INSTALLED_LOCK_NAME, the size and SHA-256 of every file entry, appended."""
+	files = [entry for entry in entries if not os.path.isdir(entry.src) and entry.arcname != INSTALLED_LOCK_NAME]
+	with ThreadPoolExecutor(max_workers=workers or default_workers()) as pool:
+		digests = list(pool.map(lambda entry: sha256_file(entry.src), files))
+	lock = {
+		"format": LOCK_FORMAT_VERSION,
+		"files": {entry.arcname: {"size": os.path.getsize(entry.src), "sha256": digest} for entry, digest in zip(files, digests)},
+	}
+
+	fd, path = tempfile.mkstemp(suffix="-" + INSTALLED_LOCK_NAME, dir=_stage_dir())
+	with os.fdopen(fd, "w") as f:
+		json.dump(lock, f, indent=2, sort_keys=True)
+		f.write("\n")
+	os.chmod(path, 0o644)
+	return [entry for entry in entries if entry.arcname != INSTALLED_LOCK_NAME] + [PackageEntry(src=path, arcname=INSTALLED_LOCK_NAME)]
+
+
+def add_lock_arguments(parser: argparse.ArgumentParser):
+	"""Adds the lock file switches shared by the archive builders."""
+	parser.add_argument("--relock", action="store_true", help=f"Resolve the manifest and hash every file again instead of reusing <artifact>{LOCK_SUFFIX}")
+
+
+def configure_lock(args: argparse.Namespace):
+	"""Applies the lock file switches to every artifact resolved from now on."""
+	global _relock
+	_relock = args.relock
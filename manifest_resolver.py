@@ -0,0 +1,332 @@
+"""
+Resolves manifest file patterns against build output trees through an in-memory index.
+
+Each directory of a tree is listed at most once with os.scandir (lazily, the first
+time a pattern reaches it) and every manifest pattern is matched against that
+index, instead of running one glob.glob directory scan per pattern.
+
+Patterns use glob syntax with '/' separators: '*', '?' and '[...]' match within a
+path component, '**' matches any number of directories and '..' the parent directory
+(e.g. "../sdk/*.h"). As with glob, wildcards do not match names starting with '.'.
+Only files are matched, never directories.
+
+Manifest entries (installer_manifest.json "files" lists) can be:
+  "xllr.so"                                  a pattern relative to the root; arcname = relative path
+  { "src": ..., "dest": ..., "optional": true, "exclude": [...] }
+                                             src may be absolute and may use environment variables;
+                                             a dest ending in '/' receives the file under its name
+
+Exclude patterns without a '/' match any component of the archive name (e.g.
+"__pycache__" or "*.pyc"); patterns with a '/' match the whole archive name.
+Resolvers created with prune patterns (component patterns, as excludes) do not descend
+into matching directories reached through wildcards or '**' at all, instead of listing
+them and excluding their files afterwards.
+
+Inside record_scanned_directories(), the directories a resolution depends on are collected
+with their modification times, so that lock files (see manifest_lock) can tell whether
+resolving the same entries again could give a different result.
+"""
+
+import copy
+import fnmatch
+import json
+import os
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Dict, Iterable, Iterator, List
+
+from build_metrics import phase
+
+
+@dataclass(frozen=True)
+class ResolvedFile:
+	"""A file selected by a manifest, with the stat data collected while indexing."""
+	src: str
+	arcname: str
+	size: int
+	mtime: float
+
+
+@dataclass(frozen=True)
+class _IndexedFile:
+	path: str
+	size: int
+	mtime: float
+
+
+_recording = threading.local()
+
+
+@contextmanager
+def record_scanned_directories() -> Iterator[Dict[str, int | None]]:
+	"""Collects {directory: st_mtime_ns, or None if it does not exist} of the directories resolved in this thread inside the block."""
+	directories: Dict[str, int | None] = {}
+	previous = getattr(_recording, "directories", None)
+	_recording.directories = directories
+	try:
+		yield directories
+	finally:
+		_recording.directories = previous
+
+
+def _record_directory(path: str):
+	directories = getattr(_recording, "directories", None)
+	if directories is None or path in directories:
+		return
+	try:
+		directories[path] = os.stat(path).st_mtime_ns
+	except OSError:
+		directories[path] = None
+
+
+def has_magic(pattern: str) -> bool:
+	return any(c in pattern for c in "*?[")
+
+
+def is_excluded(arcname: str, excludes: Iterable[str]) -> bool:
+	"""Returns True if arcname matches any exclude pattern."""
+	parts = arcname.split("/")
+	for pattern in excludes:
+		if "/" in pattern:
+			if fnmatch.fnmatchcase(arcname, pattern):
+				return True
+		elif any(fnmatch.fnmatchcase(part, pattern) for part in parts):
+			return True
+	return False
+
+
+class PathIndex:
+	"""A lazily built index of a directory tree. Each directory is scanned at most once."""
+
+	def __init__(self, root: str, prune: Iterable[str] = ()):
+		self.root = os.path.abspath(root).replace("\\", "/").rstrip("/")
+		self.prune = list(prune)
+		self.directories_scanned = 0
+		self.files_visited = 0
+		self._pruned: set[str] = set()
+		self._listings: Dict[str, tuple[Dict[str, str], Dict[str, _IndexedFile]]] = {}
+
+	@property
+	def directories_pruned(self) -> int:
+		return len(self._pruned)
+
+	def _descend(self, rel_dir: str, name: str) -> bool:
+		"""Returns False for subdirectories matching a prune pattern, which are never listed."""
+		if any(fnmatch.fnmatchcase(name, pattern) for pattern in self.prune):
+			self._pruned.add(f"{rel_dir}/{name}" if rel_dir else name)
+			return False
+		return True
+
+	def _listing(self, rel_dir: str) -> tuple[Dict[str, str], Dict[str, _IndexedFile]]:
+		"""Returns ({normcased name: name} of subdirectories, {name: file}) of a directory relative to the root."""
+		listing = self._listings.get(rel_dir)
+		if listing is not None:
+			return listing
+
+		dirs: Dict[str, str] = {}
+		files: Dict[str, _IndexedFile] = {}
+		path = self.root + "/" + rel_dir if rel_dir else self.root
+		# recorded before listing, so that a change made while listing invalidates the record
+		_record_directory(path)
+		try:
+			with os.scandir(path) as it:
+				for entry in it:
+					try:
+						if entry.is_dir():
+							dirs[os.path.normcase(entry.name)] = entry.name
+						elif entry.is_file():
+							st = entry.stat()
+							files[entry.name] = _IndexedFile(path=f"{path}/{entry.name}", size=st.st_size, mtime=st.st_mtime)
+					except OSError:
+						continue
+		except OSError:
+			pass
+
+		self.directories_scanned += 1
+		self.files_visited += len(files)
+		self._listings[rel_dir] = (dirs, files)
+		return dirs, files
+
+	def _walk(self, rel_dir: str) -> Iterable[str]:
+		"""Yields rel_dir and every non-hidden, non-pruned directory below it."""
+		yield rel_dir
+		dirs, _ = self._listing(rel_dir)
+		for name in sorted(dirs.values()):
+			if not name.startswith(".") and self._descend(rel_dir, name):
+				yield from self._walk(f"{rel_dir}/{name}" if rel_dir else name)
+
+	def match(self, pattern: str) -> List[tuple[str, _IndexedFile]]:
+		"""Returns sorted (relative path, file) pairs for the files matching a root-relative pattern."""
+		parts = [p for p in pattern.replace("\\", "/").split("/") if p not in ("", ".")]
+		if not parts:
+			return []
+
+		candidates = [""]
+		for part in parts[:-1]:
+			next_candidates = []
+			for rel_dir in candidates:
+				if part == "..":
+					# the index cannot leave its root; ManifestResolver.match roots leading '..' above it
+					if rel_dir:
+						next_candidates.append(rel_dir.rpartition("/")[0])
+					continue
+				if part == "**":
+					next_candidates.extend(self._walk(rel_dir))
+					continue
+				dirs, _ = self._listing(rel_dir)
+				if has_magic(part):
+					names = [name for name in dirs.values()
+							 if fnmatch.fnmatch(name, part) and (part.startswith(".") or not name.startswith(".")) and self._descend(rel_dir, name)]
+				else:
+					names = [dirs[os.path.normcase(part)]] if os.path.normcase(part) in dirs else []
+				next_candidates.extend(f"{rel_dir}/{name}" if rel_dir else name for name in names)
+			candidates = list(dict.fromkeys(next_candidates))
+
+		last = parts[-1]
+		if last == "**":
+			# like glob, a trailing '**' matches every file below the preceding directories
+			candidates = list(dict.fromkeys(d for rel_dir in candidates for d in self._walk(rel_dir)))
+			last = "*"
+
+		result = []
+		for rel_dir in candidates:
+			_, files = self._listing(rel_dir)
+			for name, file in files.items():
+				if has_magic(last):
+					if not fnmatch.fnmatch(name, last) or (name.startswith(".") and not last.startswith(".")):
+						continue
+				elif os.path.normcase(name) != os.path.normcase(last):
+					continue
+				result.append((f"{rel_dir}/{name}" if rel_dir else name, file))
+		return sorted(result)
+
+
+class ManifestResolver:
+	"""Resolves manifest entries against a root directory, sharing one index per tree.
+
+	Directories matching a prune pattern are skipped by every index (see PathIndex).
+	"""
+
+	def __init__(self, root: str, prune: Iterable[str] = ()):
+		self.root = os.path.abspath(root).replace("\\", "/").rstrip("/")
+		self.prune = list(prune)
+		self._indexes: Dict[str, PathIndex] = {}
+
+	def index_for(self, root: str) -> PathIndex:
+		root = os.path.abspath(root).replace("\\", "/").rstrip("/")
+		if root not in self._indexes:
+			self._indexes[root] = PathIndex(root, self.prune)
+		return self._indexes[root]
+
+	@property
+	def directories_scanned(self) -> int:
+		return sum(index.directories_scanned for index in self._indexes.values())
+
+	@property
+	def files_visited(self) -> int:
+		return sum(index.files_visited for index in self._indexes.values())
+
+	@property
+	def directories_pruned(self) -> int:
+		return sum(index.directories_pruned for index in self._indexes.values())
+
+	def match(self, pattern: str, base: str | None = None) -> List[ResolvedFile]:
+		"""Returns the files matching pattern, with arcnames relative to the directory the pattern is resolved from.
+
+		Relative patterns are matched through the index of base (default: the resolver root); those whose
+		wildcard-free directory leaves base through '..' are indexed from that directory instead, with
+		arcnames such as "../sdk/x.h". Absolute patterns are indexed from their longest wildcard-free
+		directory, so only the directories they reach are scanned; absolute paths without wildcards
+		are a single stat.
+		"""
+		pattern = os.path.expandvars(pattern).replace("\\", "/")
+		base = os.path.abspath(base or self.root).replace("\\", "/").rstrip("/")
+		if not os.path.isabs(pattern):
+			parts = pattern.split("/")
+			split = next((i for i, part in enumerate(parts) if has_magic(part)), len(parts) - 1)
+			if ".." in parts[:split]:
+				root = os.path.normpath(os.path.join(base, *parts[:split])).replace("\\", "/")
+				index = self.index_for(root)
+				return [ResolvedFile(src=file.path, arcname=os.path.relpath(file.path, base).replace("\\", "/"), size=file.size, mtime=file.mtime)
+						for _, file in index.match("/".join(parts[split:]))]
+
+		if os.path.isabs(pattern):
+			parts = pattern.split("/")
+			split = next((i for i, part in enumerate(parts) if has_magic(part)), None)
+			if split is None:
+				_record_directory(os.path.dirname(pattern) or "/")
+				try:
+					st = os.stat(pattern)
+				except OSError:
+					return []
+				if not os.path.isfile(pattern):
+					return []
+				return [ResolvedFile(src=pattern, arcname=parts[-1], size=st.st_size, mtime=st.st_mtime)]
+			root = "/".join(parts[:split])
+			if root == "" or root.endswith(":"):
+				root += "/"  # filesystem root, or a Windows drive root such as C:/
+			index = self.index_for(root)
+			pattern = "/".join(parts[split:])
+		else:
+			index = self.index_for(base)
+
+		return [ResolvedFile(src=file.path, arcname=rel, size=file.size, mtime=file.mtime) for rel, file in index.match(pattern)]
+
+	def resolve(self, entries: list, excludes: Iterable[str] = ()) -> List[ResolvedFile]:
+		"""Resolves manifest entries (see module docstring) into files.
+
+		Required entries that match nothing raise FileNotFoundError; optional ones print a warning.
+		"""
+		with phase("resolve manifest") as record:
+			result = self._resolve(entries, list(excludes))
+			record.args.update(files=len(result), directories_scanned=self.directories_scanned, files_visited=self.files_visited,
+							   directories_pruned=self.directories_pruned)
+			return result
+
+	def _resolve(self, entries: list, excludes: List[str]) -> List[ResolvedFile]:
+		result: List[ResolvedFile] = []
+
+		for entry in entries:
+			if isinstance(entry, str):
+				matches = self.match(entry)
+				if not matches:
+					raise FileNotFoundError(f"No files found matching pattern: {entry} in {self.root}")
+				result.extend(file for file in matches if not is_excluded(file.arcname, excludes))
+
+			elif isinstance(entry, dict):
+				src_pattern = entry["src"]
+				dest = entry["dest"]
+				entry_excludes = excludes + list(entry.get("exclude", []))
+
+				matches = self.match(src_pattern)
+				if not matches:
+					if entry.get("optional", False):
+						print(f"Warning: optional file not found, skipping: {os.path.expandvars(src_pattern)}")
+						continue
+					raise FileNotFoundError(f"Required file not found: {os.path.expandvars(src_pattern)}")
+
+				for file in matches:
+					arcname = dest + os.path.basename(file.src) if dest.endswith("/") else dest
+					if not is_excluded(arcname, entry_excludes):
+						result.append(ResolvedFile(src=file.src, arcname=arcname, size=file.size, mtime=file.mtime))
+
+			else:
+				raise ValueError(f"Unexpected manifest entry type: {type(entry)}")
+
+		return result
+
+
+_manifest_cache: Dict[tuple, dict] = {}
+_manifest_lock = threading.Lock()
+
+
+def load_manifest_file(path: str) -> dict:
+	"""Reads a JSON manifest once per modification and returns a private copy of it."""
+	st = os.stat(path)
+	key = (os.path.abspath(path), st.st_mtime_ns, st.st_size)
+	with _manifest_lock:
+		if key not in _manifest_cache:
+			with open(path, "r") as f:
+				_manifest_cache[key] = json.load(f)
+		return copy.deepcopy(_manifest_cache[key])
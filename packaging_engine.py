@@ -0,0 +1,700 @@
+"""
+Shared packaging engine used by the installer builders.
+
+Files are read in fixed-size blocks and each block is deflated on a worker
+thread (zlib releases the GIL while compressing). Blocks of the same file are
+primed with the previous 32 KB of input and joined with sync flushes, the same
+technique pigz uses, so even a single large library is compressed on all cores.
+The compressed blocks are then written into the zip strictly in entry order, so
+the archive layout does not depend on the number of workers.
+
+At most a fixed window of blocks is in flight at any time, which keeps memory
+bounded regardless of payload size.
+
+Entries may carry their own CompressionMethod (see compression_policy). Store
+and deflate members use the block pipeline above; bzip2 and lzma members are
+compressed whole on a worker into a spooled temporary file.
+
+When a CompressionCache is given, unchanged files are spliced in from the
+cache instead of being compressed again. compress_into_cache() fills the cache
+without writing an archive, so that a file shared by several archives is
+compressed once and copied into each of them (see build_release).
+
+transplant_zip() copies the members of an existing zip into a new one raw: the compressed
+bytes, CRC and sizes are taken over as they are, without inflating or deflating anything.
+
+In deterministic mode (--deterministic, or whenever $SOURCE_DATE_EPOCH is set) the
+archive depends only on the file contents and names: members are sorted by name,
+timestamps are set to $SOURCE_DATE_EPOCH (default 1980-01-01) and permissions are
+normalized to 0644, or 0755 for executables. The compressed bytes never depend on
+the number of workers or on the compression cache.
+"""
+
+import argparse
+import collections
+import hashlib
+import os
+import struct
+import tempfile
+import time
+import zipfile
+import zlib
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import BinaryIO, Dict, Iterable, List
+
+from build_metrics import phase
+from compression_cache import CacheWriter, CompressionCache, sha256_file
+from compression_policy import CompressionMethod, new_compressor
+
+
+# Uncompressed bytes per compression task
+BLOCK_SIZE = 1024 * 1024
+
+# Deflate window size; each block is primed with this much of the preceding input
+DEFLATE_WINDOW = 32 * 1024
+
+# Number of in-flight blocks per worker before the writer waits for the oldest one
+BLOCKS_IN_FLIGHT_PER_WORKER = 4
+
+DEFAULT_COMPRESS_LEVEL = 9
+
+# Identifies the block layout of the compressed streams; part of every cache key
+ENGINE_FORMAT = f"deflate-blocks-{BLOCK_SIZE}-{DEFLATE_WINDOW}"
+
+COPY_CHUNK_SIZE = 1024 * 1024
+
+# Whole-file (bzip2/lzma) members spill from memory to disk past this size
+MEMBER_SPOOL_MAX_SIZE = 8 * 1024 * 1024
+
+_FLAG_LZMA_EOS = 0x02
+
+ZIP64_LIMIT = (1 << 31) - 1
+ZIP_MAX_ENTRIES = 0xFFFF
+
+_LOCAL_HEADER_STRUCT = "<4s2B4HL2L2H"
+_CENTRAL_DIR_STRUCT = "<4s4B4HL2L5H2L"
+_END_RECORD_STRUCT = "<4s4H2LH"
+_ZIP64_END_RECORD_STRUCT = "<4sQ2H2L4Q"
+_ZIP64_LOCATOR_STRUCT = "<4sLQL"
+
+_FLAG_ENCRYPTED = 0x01
+_FLAG_DATA_DESCRIPTOR = 0x08
+_FLAG_UTF8 = 0x800
+
+_LOCAL_HEADER_SIZE = struct.calcsize(_LOCAL_HEADER_STRUCT)
+_ZIP64_EXTRA_ID = 0x0001
+
+# Member timestamp of deterministic archives when $SOURCE_DATE_EPOCH is not set
+DETERMINISTIC_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+_deterministic = bool(os.environ.get("SOURCE_DATE_EPOCH"))
+
+
+@dataclass
+class PackageEntry:
+	"""A file to be packaged: absolute source path, its name inside the archive and,
+	optionally, the compression method to use instead of the archive default."""
+	src: str
+	arcname: str
+	compression: CompressionMethod | None = None
+
+
+@dataclass
+class ArchiveMember:
+	"""Describes a member written into an archive."""
+	arcname: str
+	src: str
+	file_size: int
+	compress_size: int
+	crc: int
+	compress_type: int
+	compress_seconds: float
+	header_offset: int
+
+
+def default_workers() -> int:
+	"""Returns the default number of compression workers (one per CPU)."""
+	return os.cpu_count() or 1
+
+
+def deterministic_date_time() -> tuple:
+	"""Returns the member timestamp of deterministic archives: $SOURCE_DATE_EPOCH, clamped to the zip date range."""
+	epoch = os.environ.get("SOURCE_DATE_EPOCH")
+	if not epoch:
+		return DETERMINISTIC_DATE_TIME
+	date_time = time.gmtime(int(epoch))[:6]
+	return min(max(date_time, DETERMINISTIC_DATE_TIME), (2107, 12, 31, 23, 59, 58))
+
+
+def member_date_time() -> list | None:
+	"""Returns the timestamp given to every member of archives written now, or None if they keep their file times."""
+	return list(deterministic_date_time()) if _deterministic else None
+
+
+def _normalize_zinfo(zinfo: zipfile.ZipInfo):
+	"""Replaces the filesystem metadata of a member with fixed values."""
+	zinfo.date_time = deterministic_date_time()
+	zinfo.create_system = 3
+	if zinfo.is_dir():
+		zinfo.external_attr = (0o40755 << 16) | 0x10
+	else:
+		mode = 0o755 if (zinfo.external_attr >> 16) & 0o111 else 0o644
+		zinfo.external_attr = (0o100000 | mode) << 16
+
+
+def member_mode(path: str) -> int:
+	"""Returns the permission bits recorded for a file written from path, as normalized by --deterministic."""
+	mode = os.stat(path).st_mode & 0o777
+	if _deterministic:
+		return 0o755 if mode & 0o111 else 0o644
+	return mode
+
+
+def resolve_workers(workers: int | None) -> int:
+	"""Validates a --jobs value, falling back to default_workers() when None or 0."""
+	if workers is None or workers == 0:
+		return default_workers()
+	if workers < 0:
+		raise ValueError(f"Worker count must be positive, got {workers}")
+	return workers
+
+
+class ZipAssembler:
+	"""Writes a zip archive from already-compressed member data.
+
+	The output must be seekable: each local header is written before its data
+	and patched with the final CRC and sizes once the member is complete.
+	"""
+
+	def __init__(self, fp: BinaryIO):
+		self.fp = fp
+		self.members: List[ArchiveMember] = []
+		self._central_records: List[bytes] = []
+		self._current: dict | None = None
+
+	def begin_member(self, zinfo: zipfile.ZipInfo, src: str, file_size_hint: int):
+		"""Writes the local header of a new member. Sizes and CRC are patched by end_member()."""
+		if self._current is not None:
+			raise RuntimeError(f"Member {self._current['zinfo'].filename} was not ended")
+
+		zip64 = file_size_hint * 1.05 > ZIP64_LIMIT
+		name, flag_bits = _encode_filename(zinfo)
+		flag_bits |= zinfo.flag_bits
+		extract_version = _extract_version(zinfo.compress_type, zip64)
+
+		extra = zinfo.extra
+		if zip64:
+			extra = struct.pack("<HHQQ", 1, 16, 0, 0) + extra
+
+		header_offset = self.fp.tell()
+		dosdate, dostime = _dos_date_time(zinfo.date_time)
+		self.fp.write(struct.pack(
+			_LOCAL_HEADER_STRUCT, b"PK\003\004", extract_version, 0, flag_bits, zinfo.compress_type,
+			dostime, dosdate, 0, 0xFFFFFFFF if zip64 else 0, 0xFFFFFFFF if zip64 else 0, len(name), len(extra),
+		))
+		self.fp.write(name)
+		self.fp.write(extra)
+
+		self._current = {
+			"zinfo": zinfo,
+			"src": src,
+			"name": name,
+			"flag_bits": flag_bits,
+			"zip64": zip64,
+			"header_offset": header_offset,
+			"extra": zinfo.extra,
+			"compress_size": 0,
+		}
+
+	def write(self, data: bytes):
+		"""Appends compressed bytes to the current member."""
+		self.fp.write(data)
+		self._current["compress_size"] += len(data)
+
+	def end_member(self, crc: int, file_size: int, compress_seconds: float = 0.0) -> ArchiveMember:
+		"""Patches the current member's local header with its CRC and sizes."""
+		current = self._current
+		self._current = None
+		zinfo = current["zinfo"]
+		compress_size = current["compress_size"]
+
+		if not current["zip64"] and (file_size > ZIP64_LIMIT or compress_size > ZIP64_LIMIT):
+			raise RuntimeError(f"{zinfo.filename} grew past the zip64 limit unexpectedly")
+
+		end_offset = self.fp.tell()
+		self.fp.seek(current["header_offset"] + 14)
+		if current["zip64"]:
+			self.fp.write(struct.pack("<L", crc))
+			self.fp.seek(current["header_offset"] + 30 + len(current["name"]) + 4)
+			self.fp.write(struct.pack("<QQ", file_size, compress_size))
+		else:
+			self.fp.write(struct.pack("<LLL", crc, compress_size, file_size))
+		self.fp.seek(end_offset)
+
+		member = ArchiveMember(
+			arcname=zinfo.filename,
+			src=current["src"],
+			file_size=file_size,
+			compress_size=compress_size,
+			crc=crc,
+			compress_type=zinfo.compress_type,
+			compress_seconds=compress_seconds,
+			header_offset=current["header_offset"],
+		)
+		self._central_records.append(self._central_record(zinfo, current, member))
+		self.members.append(member)
+		return member
+
+	def _central_record(self, zinfo: zipfile.ZipInfo, current: dict, member: ArchiveMember) -> bytes:
+		zip64_fields = []
+		file_size = member.file_size
+		compress_size = member.compress_size
+		header_offset = member.header_offset
+		if file_size > ZIP64_LIMIT:
+			zip64_fields.append(file_size)
+			file_size = 0xFFFFFFFF
+		if compress_size > ZIP64_LIMIT:
+			zip64_fields.append(compress_size)
+			compress_size = 0xFFFFFFFF
+		if header_offset > ZIP64_LIMIT:
+			zip64_fields.append(header_offset)
+			header_offset = 0xFFFFFFFF
+
+		extra = current["extra"]
+		if zip64_fields:
+			extra = struct.pack("<HH" + "Q" * len(zip64_fields), 1, 8 * len(zip64_fields), *zip64_fields) + extra
+
+		version = _extract_version(zinfo.compress_type, bool(zip64_fields) or current["zip64"])
+		name = current["name"]
+		dosdate, dostime = _dos_date_time(zinfo.date_time)
+		record = struct.pack(
+			_CENTRAL_DIR_STRUCT, b"PK\001\002", version, zinfo.create_system, version, 0,
+			current["flag_bits"], zinfo.compress_type, dostime, dosdate, member.crc, compress_size, file_size,
+			len(name), len(extra), 0, 0, zinfo.internal_attr, zinfo.external_attr, header_offset,
+		)
+		return record + name + extra
+
+	def close(self):
+		"""Writes the central directory and the end-of-archive records."""
+		if self._current is not None:
+			raise RuntimeError(f"Member {self._current['zinfo'].filename} was not ended")
+
+		cd_offset = self.fp.tell()
+		for record in self._central_records:
+			self.fp.write(record)
+		cd_size = self.fp.tell() - cd_offset
+		count = len(self._central_records)
+
+		if count > ZIP_MAX_ENTRIES or cd_offset > ZIP64_LIMIT or cd_size > ZIP64_LIMIT:
+			zip64_end_offset = self.fp.tell()
+			self.fp.write(struct.pack(
+				_ZIP64_END_RECORD_STRUCT, b"PK\006\006", 44, 45, 45, 0, 0, count, count, cd_size, cd_offset,
+			))
+			self.fp.write(struct.pack(_ZIP64_LOCATOR_STRUCT, b"PK\006\007", 0, zip64_end_offset, 1))
+			count = min(count, ZIP_MAX_ENTRIES)
+			cd_size = min(cd_size, 0xFFFFFFFF)
+			cd_offset = min(cd_offset, 0xFFFFFFFF)
+
+		self.fp.write(struct.pack(_END_RECORD_STRUCT, b"PK\005\006", 0, 0, count, count, cd_size, cd_offset, 0))
+		self.fp.flush()
+
+
+def _encode_filename(zinfo: zipfile.ZipInfo) -> tuple[bytes, int]:
+	try:
+		return zinfo.filename.encode("ascii"), 0
+	except UnicodeEncodeError:
+		return zinfo.filename.encode("utf-8"), _FLAG_UTF8
+
+
+def _extract_version(compress_type: int, zip64: bool) -> int:
+	version = 20
+	if zip64:
+		version = max(version, 45)
+	if compress_type == zipfile.ZIP_BZIP2:
+		version = max(version, 46)
+	elif compress_type == zipfile.ZIP_LZMA:
+		version = max(version, 63)
+	return version
+
+
+def _dos_date_time(date_time: tuple) -> tuple[int, int]:
+	dosdate = (date_time[0] - 1980) << 9 | date_time[1] << 5 | date_time[2]
+	dostime = date_time[3] << 11 | date_time[4] << 5 | (date_time[5] // 2)
+	return dosdate, dostime
+
+
+def _deflate_block(block: bytes, zdict: bytes | None, level: int, is_last: bool) -> tuple[bytes, float]:
+	"""Deflates one block as a raw deflate fragment. Runs on a worker thread."""
+	start = time.perf_counter()
+	if zdict:
+		compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=zdict)
+	else:
+		compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+	data = compressor.compress(block) + compressor.flush(zlib.Z_FINISH if is_last else zlib.Z_SYNC_FLUSH)
+	return data, time.perf_counter() - start
+
+
+def _compress_file(state: "_MemberState", method: CompressionMethod) -> tuple["_SpooledData", float]:
+	"""Compresses a whole file into a spooled temporary file. Runs on a worker thread."""
+	start = time.perf_counter()
+	compressor = new_compressor(method)
+	out = tempfile.SpooledTemporaryFile(max_size=MEMBER_SPOOL_MAX_SIZE, mode="w+b")
+	crc = 0
+	size = 0
+	with open(state.entry.src, "rb") as f:
+		while True:
+			chunk = f.read(BLOCK_SIZE)
+			if not chunk:
+				break
+			crc = zlib.crc32(chunk, crc)
+			size += len(chunk)
+			out.write(compressor.compress(chunk))
+	out.write(compressor.flush())
+	out.seek(0)
+
+	# read by the writer thread only after the future completes
+	state.crc = crc
+	state.bytes_read = size
+	return _SpooledData(out), time.perf_counter() - start
+
+
+class _MemberState:
+	def __init__(self, entry: PackageEntry, zinfo: zipfile.ZipInfo, file_size: int):
+		self.entry = entry
+		self.zinfo = zinfo
+		self.file_size = file_size
+		self.crc = 0
+		self.bytes_read = 0
+		self.compress_seconds = 0.0
+		self.cache_writer: CacheWriter | None = None
+
+
+@dataclass
+class _CachedData:
+	"""Compressed member data that lives in the compression cache."""
+	path: str
+
+
+@dataclass
+class _SpooledData:
+	"""Compressed member data held in a spooled temporary file."""
+	file: BinaryIO
+
+
+class _CompressionPipeline:
+	"""Schedules block compression on a thread pool and writes results in submission order."""
+
+	def __init__(self, assembler: ZipAssembler, workers: int, default_method: CompressionMethod, cache: CompressionCache | None,
+				 deterministic: bool = False):
+		self.assembler = assembler
+		self.deterministic = deterministic
+		self.default_method = default_method
+		self.cache = cache
+		self.pool = ThreadPoolExecutor(max_workers=workers) if workers > 1 else None
+		self.window = workers * BLOCKS_IN_FLIGHT_PER_WORKER
+		self.pending: collections.deque = collections.deque()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc, tb):
+		try:
+			if exc_type is None:
+				while self.pending:
+					self._drain_one()
+			else:
+				for state, future, _, is_last in self.pending:
+					future.cancel()
+					if is_last and state.cache_writer is not None:
+						state.cache_writer.discard()
+		finally:
+			if self.pool is not None:
+				self.pool.shutdown(wait=True)
+
+	def add(self, entry: PackageEntry):
+		zinfo = zipfile.ZipInfo.from_file(entry.src, entry.arcname)
+		if self.deterministic:
+			_normalize_zinfo(zinfo)
+
+		if zinfo.is_dir():
+			zinfo.compress_type = zipfile.ZIP_STORED
+			state = _MemberState(entry, zinfo, 0)
+			self._enqueue(state, _completed((b"", 0.0)), True, True)
+			return
+
+		method = entry.compression or self.default_method
+		zinfo.compress_type = method.compress_type
+		if method.codec == "lzma":
+			zinfo.flag_bits |= _FLAG_LZMA_EOS
+		state = _MemberState(entry, zinfo, zinfo.file_size)
+
+		if self.cache is not None:
+			key = member_cache_key(self.cache, entry.src, method)
+			cached = self.cache.lookup(key)
+			if cached is not None:
+				state.crc = cached.crc
+				state.bytes_read = cached.file_size
+				self._enqueue(state, _completed((_CachedData(cached.path), 0.0)), True, True)
+				return
+			state.cache_writer = self.cache.open_writer(key)
+
+		if method.codec not in ("deflate", "store"):
+			self._enqueue(state, self._submit(_compress_file, state, method), True, True)
+			return
+
+		with open(entry.src, "rb") as f:
+			block = f.read(BLOCK_SIZE)
+			zdict = None
+			is_first = True
+			while True:
+				next_block = f.read(BLOCK_SIZE) if len(block) == BLOCK_SIZE else b""
+				is_last = not next_block
+				state.crc = zlib.crc32(block, state.crc)
+				state.bytes_read += len(block)
+				if method.codec == "store":
+					future = _completed((block, 0.0))
+				else:
+					future = self._submit(_deflate_block, block, zdict, method.level, is_last)
+				self._enqueue(state, future, is_first, is_last)
+				if is_last:
+					break
+				zdict = block[-DEFLATE_WINDOW:]
+				block = next_block
+				is_first = False
+
+	def _submit(self, fn, *args) -> Future:
+		if self.pool is None:
+			return _completed(fn(*args))
+		return self.pool.submit(fn, *args)
+
+	def _enqueue(self, state: _MemberState, future: Future, is_first: bool, is_last: bool):
+		self.pending.append((state, future, is_first, is_last))
+		while len(self.pending) > self.window:
+			self._drain_one()
+
+	def _drain_one(self):
+		state, future, is_first, is_last = self.pending.popleft()
+		if is_first:
+			self.assembler.begin_member(state.zinfo, state.entry.src, state.file_size)
+
+		data, seconds = future.result()
+		if isinstance(data, _CachedData):
+			self._copy_cached(data.path)
+		elif isinstance(data, _SpooledData):
+			with data.file:
+				self._copy_spooled(data.file, state.cache_writer)
+		else:
+			self.assembler.write(data)
+			if state.cache_writer is not None:
+				state.cache_writer.write(data)
+		state.compress_seconds += seconds
+
+		if is_last:
+			member = self.assembler.end_member(state.crc, state.bytes_read, state.compress_seconds)
+			if state.cache_writer is not None:
+				state.cache_writer.commit(member.crc, member.file_size, member.compress_size)
+
+	def _copy_spooled(self, f: BinaryIO, cache_writer: CacheWriter | None):
+		while True:
+			chunk = f.read(COPY_CHUNK_SIZE)
+			if not chunk:
+				break
+			self.assembler.write(chunk)
+			if cache_writer is not None:
+				cache_writer.write(chunk)
+
+	def _copy_cached(self, path: str):
+		with open(path, "rb") as f:
+			while True:
+				chunk = f.read(COPY_CHUNK_SIZE)
+				if not chunk:
+					break
+				self.assembler.write(chunk)
+
+
+def member_cache_key(cache: CompressionCache, src: str, method: CompressionMethod) -> str:
+	"""Returns the compression cache key of a file compressed with method by this engine."""
+	return cache.make_key(sha256_file(src), method.codec, method.level, ENGINE_FORMAT)
+
+
+def _completed(result) -> Future:
+	future: Future = Future()
+	future.set_result(result)
+	return future
+
+
+def write_zip(fp: BinaryIO, entries: Iterable[PackageEntry], workers: int | None = None, compresslevel: int = DEFAULT_COMPRESS_LEVEL,
+			  cache: CompressionCache | None = None, deterministic: bool | None = None) -> List[ArchiveMember]:
+	"""Compresses entries concurrently and writes them as a zip archive into fp, in the given order.
+
+	fp must be a seekable binary file opened for writing. Entries without their own compression
+	method are deflated at compresslevel. If cache is given, members whose content was compressed
+	by an earlier build are copied from it. deterministic (default: --deterministic, see
+	configure_determinism) sorts the entries and normalizes their metadata. Returns the written members.
+	"""
+	workers = resolve_workers(workers)
+	if deterministic is None:
+		deterministic = _deterministic
+	if deterministic:
+		entries = sorted(entries, key=lambda entry: entry.arcname)
+
+	with phase("compress", workers=workers) as record:
+		start = fp.tell()
+		assembler = ZipAssembler(fp)
+		with _CompressionPipeline(assembler, workers, CompressionMethod("deflate", compresslevel), cache, deterministic) as pipeline:
+			for entry in entries:
+				pipeline.add(entry)
+		assembler.close()
+		record.bytes_in = sum(member.file_size for member in assembler.members)
+		record.bytes_out = fp.tell() - start
+		record.args["members"] = len(assembler.members)
+	return assembler.members
+
+
+def _without_zip64_extra(extra: bytes) -> bytes:
+	"""Returns a member's extra field without its zip64 record, which ZipAssembler writes itself when needed."""
+	kept = b""
+	pos = 0
+	while pos + 4 <= len(extra):
+		header_id, size = struct.unpack_from("<HH", extra, pos)
+		if header_id != _ZIP64_EXTRA_ID:
+			kept += extra[pos:pos + 4 + size]
+		pos += 4 + size
+	return kept
+
+
+def transplant_zip(fp: BinaryIO, source_path: str, deterministic: bool | None = None) -> List[ArchiveMember]:
+	"""Copies the members of the zip at source_path into a new zip archive in fp without recompressing them.
+
+	Each member's compressed bytes, CRC, sizes and compression method are copied raw; only the
+	headers are written anew (trailing data descriptors are folded into them). deterministic
+	(default: --deterministic) sorts the members and normalizes their metadata as write_zip()
+	does; the compressed bytes stay those of the source. Returns the written members.
+	"""
+	if deterministic is None:
+		deterministic = _deterministic
+
+	with phase("transplant members") as record, open(source_path, "rb") as src, zipfile.ZipFile(src) as source:
+		infos = source.infolist()
+		if deterministic:
+			infos = sorted(infos, key=lambda info: info.filename)
+
+		start = fp.tell()
+		assembler = ZipAssembler(fp)
+		for info in infos:
+			if info.flag_bits & _FLAG_ENCRYPTED:
+				raise ValueError(f"{source_path}: cannot transplant encrypted member {info.filename}")
+			src.seek(info.header_offset)
+			signature, *_, name_length, extra_length = struct.unpack(_LOCAL_HEADER_STRUCT, src.read(_LOCAL_HEADER_SIZE))
+			if signature != b"PK\003\004":
+				raise ValueError(f"{source_path}: bad local header of {info.filename}")
+			src.seek(name_length + extra_length, os.SEEK_CUR)
+
+			zinfo = zipfile.ZipInfo(info.filename, info.date_time)
+			zinfo.compress_type = info.compress_type
+			zinfo.flag_bits = info.flag_bits & ~(_FLAG_DATA_DESCRIPTOR | _FLAG_UTF8)
+			zinfo.extra = _without_zip64_extra(info.extra)
+			zinfo.create_system = info.create_system
+			zinfo.internal_attr = info.internal_attr
+			zinfo.external_attr = info.external_attr
+			if deterministic:
+				_normalize_zinfo(zinfo)
+
+			assembler.begin_member(zinfo, source_path, max(info.file_size, info.compress_size))
+			remaining = info.compress_size
+			while remaining > 0:
+				chunk = src.read(min(COPY_CHUNK_SIZE, remaining))
+				if not chunk:
+					raise ValueError(f"{source_path}: {info.filename} is truncated")
+				assembler.write(chunk)
+				remaining -= len(chunk)
+			assembler.end_member(info.CRC, info.file_size)
+		assembler.close()
+
+		record.bytes_in = sum(member.file_size for member in assembler.members)
+		record.bytes_out = fp.tell() - start
+		record.args["members"] = len(assembler.members)
+	return assembler.members
+
+
+class _DiscardWriter:
+	"""A seekable sink that only tracks its size, for compressing into the cache without an archive."""
+
+	def __init__(self):
+		self.position = 0
+		self.size = 0
+
+	def write(self, data: bytes) -> int:
+		self.position += len(data)
+		self.size = max(self.size, self.position)
+		return len(data)
+
+	def tell(self) -> int:
+		return self.position
+
+	def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+		self.position = offset if whence == os.SEEK_SET else self.size + offset if whence == os.SEEK_END else self.position + offset
+		return self.position
+
+	def flush(self):
+		pass
+
+
+def compress_into_cache(entries: Iterable[PackageEntry], cache: CompressionCache, workers: int | None = None,
+						compresslevel: int = DEFAULT_COMPRESS_LEVEL) -> Dict[str, ArchiveMember]:
+	"""Compresses entries into cache without writing an archive, so later write_zip() calls only copy.
+
+	Entries with the same content and compression method are compressed once. Returns
+	{cache key: member} for the unique entries; compress_seconds is 0 for entries that
+	were already cached.
+	"""
+	workers = resolve_workers(workers)
+	default_method = CompressionMethod("deflate", compresslevel)
+	unique: dict[str, PackageEntry] = {}
+	for entry in entries:
+		if not os.path.isdir(entry.src):
+			unique.setdefault(member_cache_key(cache, entry.src, entry.compression or default_method), entry)
+
+	with phase("compress into cache", workers=workers) as record:
+		assembler = ZipAssembler(_DiscardWriter())
+		with _CompressionPipeline(assembler, workers, default_method, cache) as pipeline:
+			for entry in unique.values():
+				pipeline.add(entry)
+		record.bytes_in = sum(member.file_size for member in assembler.members)
+		record.bytes_out = sum(member.compress_size for member in assembler.members)
+		record.args["members"] = len(assembler.members)
+	return dict(zip(unique, assembler.members))
+
+
+def check_reproducible(path: str, entries: List[PackageEntry], workers: int | None = None, compresslevel: int = DEFAULT_COMPRESS_LEVEL) -> bool:
+	"""Builds entries a second time, deterministically, without the cache and with a different
+	number of workers, and returns True if the result is byte-identical to the archive at path."""
+	workers = resolve_workers(workers)
+	with tempfile.TemporaryFile() as rebuilt:
+		write_zip(rebuilt, entries, workers=1 if workers > 1 else 2, compresslevel=compresslevel, deterministic=True)
+		rebuilt.seek(0)
+		rebuilt_digest = hashlib.file_digest(rebuilt, "sha256").hexdigest()
+	with open(path, "rb") as f:
+		digest = hashlib.file_digest(f, "sha256").hexdigest()
+
+	if digest == rebuilt_digest:
+		print(f"Reproducible: {path} (sha256 {digest[:16]}...)")
+		return True
+	print(f"NOT reproducible: {path} (sha256 {digest[:16]}... != rebuilt {rebuilt_digest[:16]}...)")
+	return False
+
+
+def add_determinism_arguments(parser: argparse.ArgumentParser, check: bool = True):
+	"""Adds the --deterministic switch shared by the archive builders and, if check is set, --check-reproducible."""
+	parser.add_argument("--deterministic", action="store_true", default=_deterministic,
+						help="Sort members and normalize timestamps and permissions, so identical inputs give identical bytes (default: on if $SOURCE_DATE_EPOCH is set)")
+	if check:
+		parser.add_argument("--check-reproducible", action="store_true",
+							help="Build every archive a second time and fail unless both builds are byte-identical (implies --deterministic)")
+
+
+def configure_determinism(args: argparse.Namespace):
+	"""Applies the --deterministic switch to every archive written from now on."""
+	global _deterministic
+	_deterministic = args.deterministic or getattr(args, "check_reproducible", False)
@@ -0,0 +1,97 @@
+"""
+Binary payload container shipped next to the installer executables.
+
+Layout (all integers little-endian):
+
+  header   8s magic "MFFIPAYL", u16 format version, u16 section count, u32 reserved
+  table    one record per section:
+             32s section name (UTF-8, NUL-padded), u64 offset, u64 length, 32s SHA-256 of the section
+  data     the sections, back to back
+
+Offsets are relative to the start of the container. Installers read the table,
+mmap only the section they need and verify it against its hash before use.
+The matching reader lives in templates/metaffi_installer_template.py.
+"""
+
+import hashlib
+import struct
+from dataclasses import dataclass
+from typing import BinaryIO, Iterable, List
+
+
+PAYLOAD_MAGIC = b"MFFIPAYL"
+PAYLOAD_FORMAT_VERSION = 1
+
+PAYLOAD_FILE_NAME = "metaffi_payload.bin"
+
+HEADER_STRUCT = "<8sHHI"
+SECTION_STRUCT = "<32sQQ32s"
+HEADER_SIZE = struct.calcsize(HEADER_STRUCT)
+SECTION_SIZE = struct.calcsize(SECTION_STRUCT)
+
+COPY_CHUNK_SIZE = 1024 * 1024
+
+
+@dataclass
+class PayloadSection:
+	"""A section of a payload container."""
+	name: str
+	offset: int
+	length: int
+	sha256: str
+
+
+def write_payload_container(out: BinaryIO, sections: Iterable[tuple[str, BinaryIO]]) -> List[PayloadSection]:
+	"""Writes (name, stream) sections into out as a payload container. out must be seekable.
+
+	Streams are copied in chunks and hashed on the fly, so memory use does not depend on their size.
+	"""
+	sections = list(sections)
+	names = [name.encode("utf-8") for name, _ in sections]
+	for name in names:
+		if len(name) > 32:
+			raise ValueError(f"Payload section name too long (max 32 bytes): {name!r}")
+	if len(set(names)) != len(names):
+		raise ValueError(f"Duplicate payload section names: {names}")
+
+	start = out.tell()
+	out.write(struct.pack(HEADER_STRUCT, PAYLOAD_MAGIC, PAYLOAD_FORMAT_VERSION, len(sections), 0))
+	table_offset = out.tell()
+	out.write(b"\0" * (SECTION_SIZE * len(sections)))
+
+	result: List[PayloadSection] = []
+	for name, stream in sections:
+		offset = out.tell() - start
+		digest = hashlib.sha256()
+		length = 0
+		while True:
+			chunk = stream.read(COPY_CHUNK_SIZE)
+			if not chunk:
+				break
+			digest.update(chunk)
+			out.write(chunk)
+			length += len(chunk)
+		result.append(PayloadSection(name=name, offset=offset, length=length, sha256=digest.hexdigest()))
+
+	end = out.tell()
+	out.seek(table_offset)
+	for section in result:
+		out.write(struct.pack(SECTION_STRUCT, section.name.encode("utf-8"), section.offset, section.length, bytes.fromhex(section.sha256)))
+	out.seek(end)
+	return result
+
+
+def read_payload_table(fp: BinaryIO) -> List[PayloadSection]:
+	"""Reads the section table of a payload container positioned at its start."""
+	magic, version, count, _ = struct.unpack(HEADER_STRUCT, fp.read(HEADER_SIZE))
+	if magic != PAYLOAD_MAGIC:
+		raise ValueError("Not a MetaFFI payload container (bad magic)")
+	if version != PAYLOAD_FORMAT_VERSION:
+		raise ValueError(f"Unsupported payload container version {version}")
+
+	table = fp.read(SECTION_SIZE * count)
+	result = []
+	for i in range(count):
+		name, offset, length, digest = struct.unpack_from(SECTION_STRUCT, table, i * SECTION_SIZE)
+		result.append(PayloadSection(name=name.rstrip(b"\0").decode("utf-8"), offset=offset, length=length, sha256=digest.hex()))
+	return result
@@ -0,0 +1,164 @@
+"""
+Cross-package deduplication of identical files in a release.
+
+Files that are byte-identical in several packages of one target (the core zip and the plugin
+zips; typically headers under include/ and runtime libraries) are stored once, in a companion
+archive metaffi-shared-<version>-<build_type>-<target>.zip with one member per content,
+blobs/<sha256>. A package that references shared files carries shared_files.json instead of them:
+
+  {
+    "format": 1,
+    "shared_archive": "metaffi-shared-<version>-<build_type>-<target>.zip",
+    "files": { "<arcname>": { "sha256": "...", "size": 1234, "mode": 493 } }
+  }
+
+Installers extract the blobs they need into the shared store, $METAFFI_HOME/.metaffi-shared/<sha256>,
+and materialize every listed file as a hardlink to its blob, or as a copy where a hardlink is
+not possible or the file needs other permissions than the blob. The core installer carries the
+companion archive as the "shared" section of its payload; the plugin installer uses the store
+left by the core installer, or a companion archive given with --shared-archive. The matching
+code lives in the installer templates (templates/metaffi_installer_template.py and
+templates/metaffi_plugin_installer_template.py).
+"""
+
+import hashlib
+import json
+import os
+import re
+import shutil
+import zipfile
+from typing import Dict, List
+
+from compression_cache import sha256_file
+from delta_format import install_path
+from packaging_engine import COPY_CHUNK_SIZE, PackageEntry, member_mode
+
+
+SHARED_FORMAT_VERSION = 1
+
+SHARED_FILES_NAME = "shared_files.json"
+SHARED_STORE_DIR = ".metaffi-shared"
+SHARED_BLOB_PREFIX = "blobs/"
+
+# Payload container section of the core installer holding the companion archive
+SHARED_PAYLOAD_SECTION = "shared"
+
+
+def shared_archive_name(version: str, build_type: str, target: str) -> str:
+	return f"metaffi-shared-{version}-{build_type}-{target}.zip"
+
+
+def companion_archive(zip_path: str, listing: dict) -> str:
+	"""Returns the path of the companion archive of a deduplicated zip, which must be next to it."""
+	path = os.path.join(os.path.dirname(os.path.abspath(zip_path)), listing["shared_archive"])
+	if not os.path.isfile(path):
+		raise FileNotFoundError(f"{zip_path} is deduplicated (see build_release --dedup) but its companion archive {path} was not found")
+	return path
+
+
+def find_shared_contents(packages: Dict[str, List[PackageEntry]]) -> Dict[str, PackageEntry]:
+	"""Returns {sha256: first entry} of the non-empty file contents found in more than one package."""
+	first: Dict[str, PackageEntry] = {}
+	owners: Dict[str, set] = {}
+	for package, entries in packages.items():
+		for entry in entries:
+			if os.path.isdir(entry.src) or os.path.getsize(entry.src) == 0:
+				continue
+			digest = sha256_file(entry.src)
+			first.setdefault(digest, entry)
+			owners.setdefault(digest, set()).add(package)
+	return {digest: entry for digest, entry in first.items() if len(owners[digest]) > 1}
+
+
+def shared_blob_entries(shared: Dict[str, PackageEntry]) -> List[PackageEntry]:
+	"""Returns the entries of the companion archive, one blob per shared content."""
+	return [PackageEntry(src=entry.src, arcname=SHARED_BLOB_PREFIX + digest, compression=entry.compression)
+			for digest, entry in sorted(shared.items())]
+
+
+def split_shared_entries(entries: List[PackageEntry], shared: Dict[str, PackageEntry]) -> tuple[List[PackageEntry], Dict[str, dict]]:
+	"""Splits a package's entries into the ones it keeps and the shared_files.json listing of the others."""
+	kept: List[PackageEntry] = []
+	files: Dict[str, dict] = {}
+	for entry in entries:
+		digest = None if os.path.isdir(entry.src) else sha256_file(entry.src)
+		if digest not in shared:
+			kept.append(entry)
+			continue
+		files[entry.arcname] = {"sha256": digest, "size": os.path.getsize(entry.src), "mode": member_mode(entry.src)}
+	return kept, files
+
+
+def write_shared_files_list(path: str, archive_name: str, files: Dict[str, dict]):
+	with open(path, "w") as f:
+		json.dump({"format": SHARED_FORMAT_VERSION, "shared_archive": archive_name, "files": files}, f, indent=2, sort_keys=True)
+
+
+def extract_shared_blobs(archive: zipfile.ZipFile, store_dir: str, digests: List[str] | None = None) -> int:
+	"""Extracts the blobs of a companion archive (default: all of them) into the shared store.
+
+	Blobs are streamed to disk and hashed on the fly. Blobs already in the store are kept.
+	Returns the number of blobs extracted.
+	"""
+	os.makedirs(store_dir, exist_ok=True)
+	extracted = 0
+	for info in archive.infolist():
+		digest = info.filename[len(SHARED_BLOB_PREFIX):]
+		if not info.filename.startswith(SHARED_BLOB_PREFIX) or (digests is not None and digest not in digests):
+			continue
+		blob_path = os.path.join(store_dir, digest)
+		if os.path.isfile(blob_path):
+			continue
+		temp_path = blob_path + ".tmp"
+		hasher = hashlib.sha256()
+		with archive.open(info) as src, open(temp_path, "wb") as f:
+			while chunk := src.read(COPY_CHUNK_SIZE):
+				hasher.update(chunk)
+				f.write(chunk)
+		if hasher.hexdigest() != digest:
+			os.remove(temp_path)
+			raise ValueError(f"Shared blob {info.filename} is corrupted")
+		mode = (info.external_attr >> 16) & 0o777
+		if mode:
+			os.chmod(temp_path, mode)
+		os.replace(temp_path, blob_path)
+		extracted += 1
+	return extracted
+
+
+def materialize_shared_files(install_dir: str, store_dir: str) -> int:
+	"""Creates the files listed in install_dir/shared_files.json from the shared store and returns their number.
+
+	Names that would leave install_dir and digests that are not SHA-256 hex strings raise ValueError.
+	"""
+	with open(os.path.join(install_dir, SHARED_FILES_NAME), "r") as f:
+		listing = json.load(f)
+	if listing.get("format") != SHARED_FORMAT_VERSION:
+		raise ValueError(f"Unsupported shared files format {listing.get('format')}")
+
+	destinations = {name: install_path(install_dir, name) for name in listing["files"]}
+	invalid = [name for name, entry in listing["files"].items() if not re.fullmatch("[0-9a-f]{64}", entry["sha256"])]
+	if invalid:
+		raise ValueError(f"Invalid shared blob digest for {invalid[0]} in {SHARED_FILES_NAME}")
+
+	missing = [name for name, entry in listing["files"].items() if not os.path.isfile(os.path.join(store_dir, entry["sha256"]))]
+	if missing:
+		raise FileNotFoundError(f"{len(missing)} shared file(s) of {install_dir} are not in {store_dir}, e.g. {missing[0]}; "
+								f"install from {listing['shared_archive']} first")
+
+	for name, entry in listing["files"].items():
+		blob_path = os.path.join(store_dir, entry["sha256"])
+		destination = destinations[name]
+		os.makedirs(os.path.dirname(destination), exist_ok=True)
+		if os.path.lexists(destination):
+			os.remove(destination)
+		if os.name == "nt" or not entry.get("mode") or os.stat(blob_path).st_mode & 0o777 == entry["mode"]:
+			try:
+				os.link(blob_path, destination)
+				continue
+			except OSError:
+				pass
+		shutil.copyfile(blob_path, destination)
+		if entry.get("mode"):
+			os.chmod(destination, entry["mode"])
+	return len(listing["files"])
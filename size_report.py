@@ -0,0 +1,198 @@
+"""
+Per-entry size reports of the built archives, checked against a size budget.
+
+Every archive a builder writes gets a report next to it, <artifact>.sizes.json, listing each
+entry's uncompressed size, compressed size, ratio and compression time, aggregated by top-level
+directory and by file type (extension). Before the report is replaced, the new sizes are
+compared with the previous build's report under the size budget (size_budget.json):
+
+  {
+    "total":       { "max_growth_percent": 10, "min_growth_bytes": 1048576 },
+    "directories": { "include": { "max_growth_percent": 50 }, "*": { "max_growth_percent": 25 } },
+    "types":       { ".so": { "max_growth_percent": 15 }, "*": { "max_growth_percent": 25 } }
+  }
+
+Group keys are globs over the directory name ("." for files at the archive root) or the
+extension ("" for files without one); the first matching key applies. A group fails the build
+if its compressed size grew by more than max_growth_percent of its previous size and by at
+least min_growth_bytes (default 0). Groups that did not exist before have grown by an infinite
+percentage. A failed check leaves the previous report in place; --accept-size-growth records
+the new sizes as the reference instead.
+"""
+
+import argparse
+import fnmatch
+import json
+import os
+import posixpath
+import time
+from dataclasses import asdict, dataclass, field
+from typing import Dict, Iterable, List
+
+from packaging_engine import ArchiveMember
+
+
+SIZE_REPORT_SUFFIX = ".sizes.json"
+
+DEFAULT_BUDGET_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "size_budget.json")
+
+# aggregations of a report (also the budget keys) and their labels
+GROUPINGS = {"directories": "dir", "types": "type"}
+
+
+class SizeBudgetExceeded(RuntimeError):
+	"""Raised when an archive grew beyond its size budget."""
+
+
+@dataclass
+class SizeGroup:
+	files: int = 0
+	size: int = 0
+	compressed_size: int = 0
+	compress_seconds: float = 0.0
+
+	def add(self, member: ArchiveMember):
+		self.files += 1
+		self.size += member.file_size
+		self.compressed_size += member.compress_size
+		self.compress_seconds += member.compress_seconds
+
+
+@dataclass
+class SizeReport:
+	artifact: str
+	total: SizeGroup = field(default_factory=SizeGroup)
+	directories: Dict[str, SizeGroup] = field(default_factory=dict)
+	types: Dict[str, SizeGroup] = field(default_factory=dict)
+	entries: List[dict] = field(default_factory=list)
+
+	def to_json(self) -> dict:
+		return {"created_at": time.time(), **asdict(self)}
+
+
+def entry_directory(arcname: str) -> str:
+	"""Returns the top-level directory of an archive name, '.' for files at the root."""
+	return arcname.split("/", 1)[0] if "/" in arcname else "."
+
+
+def entry_type(arcname: str) -> str:
+	"""Returns the lower-case extension of an archive name, '' if it has none."""
+	return posixpath.splitext(arcname)[1].lower()
+
+
+def build_size_report(artifact_path: str, members: Iterable[ArchiveMember]) -> SizeReport:
+	report = SizeReport(artifact=os.path.basename(artifact_path))
+	for member in members:
+		report.total.add(member)
+		report.directories.setdefault(entry_directory(member.arcname), SizeGroup()).add(member)
+		report.types.setdefault(entry_type(member.arcname), SizeGroup()).add(member)
+		report.entries.append({
+			"arcname": member.arcname,
+			"size": member.file_size,
+			"compressed_size": member.compress_size,
+			"ratio": round(member.compress_size / member.file_size, 4) if member.file_size else 1.0,
+			"compress_seconds": round(member.compress_seconds, 4),
+		})
+	return report
+
+
+def load_size_budget(path: str) -> dict:
+	with open(path, "r") as f:
+		return json.load(f)
+
+
+def _group_limit(limits: Dict[str, dict], name: str) -> dict | None:
+	return next((limit for pattern, limit in limits.items() if fnmatch.fnmatchcase(name, pattern)), None)
+
+
+def _exceeds(limit: dict | None, before: int, after: int) -> bool:
+	if limit is None or "max_growth_percent" not in limit:
+		return False
+	growth = after - before
+	if growth <= 0 or growth < limit.get("min_growth_bytes", 0):
+		return False
+	return before == 0 or 100.0 * growth / before > limit["max_growth_percent"]
+
+
+def check_size_budget(report: SizeReport, previous: dict, budget: dict) -> List[str]:
+	"""Returns a message for every group of report that grew beyond budget since the previous report."""
+	violations = []
+	groups = [("total", report.total.compressed_size, previous["total"]["compressed_size"], budget.get("total"))]
+	for key, label in GROUPINGS.items():
+		limits = budget.get(key, {})
+		previous_groups = previous.get(key, {})
+		for name, group in getattr(report, key).items():
+			before = previous_groups.get(name, {}).get("compressed_size", 0)
+			groups.append((f"{label} {name or '(none)'}", group.compressed_size, before, _group_limit(limits, name)))
+
+	for label, after, before, limit in groups:
+		if _exceeds(limit, before, after):
+			growth = f"+{100.0 * (after - before) / before:.1f}%" if before else "new"
+			violations.append(f"{label}: {before:,} -> {after:,} bytes compressed ({growth}, budget {limit['max_growth_percent']}%)")
+	return violations
+
+
+def print_size_report(report: SizeReport, previous: dict | None):
+	"""Prints the directory and file type groups of a report with their growth since the previous report."""
+	total = report.total
+	print(f"\nSize report ({report.artifact}): {total.files} files, {total.size:,} bytes -> {total.compressed_size:,} bytes compressed "
+		  f"({total.compressed_size / total.size if total.size else 1.0:.2f}), {total.compress_seconds:.1f}s compressing")
+	for key, label in GROUPINGS.items():
+		previous_groups = previous.get(key, {}) if previous else {}
+		for name, group in sorted(getattr(report, key).items(), key=lambda item: -item[1].compressed_size):
+			before = previous_groups.get(name, {}).get("compressed_size")
+			change = "" if previous is None else "  (new)" if before is None else f"  ({group.compressed_size - before:+,})"
+			print(f"  {label:<4} {name or '(none)':<24} {group.files:6} files {group.size:>14,} -> "
+				  f"{group.compressed_size:>14,} bytes ({group.compressed_size / group.size if group.size else 1.0:.2f}) {group.compress_seconds:7.1f}s{change}")
+
+
+_enabled = True
+_budget_path = DEFAULT_BUDGET_PATH
+_accept_growth = False
+
+
+def report_archive_sizes(artifact_path: str, members: Iterable[ArchiveMember]) -> SizeReport | None:
+	"""Writes <artifact>.sizes.json for the members of an archive after checking them against the size budget.
+
+	Raises SizeBudgetExceeded, leaving the previous report in place, if the archive grew beyond the budget.
+	"""
+	if not _enabled:
+		return None
+	report = build_size_report(artifact_path, members)
+	report_path = artifact_path + SIZE_REPORT_SUFFIX
+	previous = None
+	if os.path.isfile(report_path):
+		with open(report_path, "r") as f:
+			previous = json.load(f)
+	print_size_report(report, previous)
+
+	if previous is not None and os.path.isfile(_budget_path):
+		violations = check_size_budget(report, previous, load_size_budget(_budget_path))
+		if violations and not _accept_growth:
+			raise SizeBudgetExceeded(f"{report.artifact} exceeds the size budget in {_budget_path}:\n  " + "\n  ".join(violations) +
+									 "\nRaise the budget or rebuild with --accept-size-growth to accept the new sizes")
+		for violation in violations:
+			print(f"Accepted size growth: {violation}")
+
+	with open(report_path, "w") as f:
+		json.dump(report.to_json(), f, indent=2)
+		f.write("\n")
+	return report
+
+
+def add_size_report_arguments(parser: argparse.ArgumentParser):
+	"""Adds the size report switches shared by the archive builders."""
+	parser.add_argument("--size-budget", default=DEFAULT_BUDGET_PATH,
+						help=f"Size budget checked against the previous build's <artifact>{SIZE_REPORT_SUFFIX} (default: size_budget.json)")
+	parser.add_argument("--accept-size-growth", action="store_true", help="Record the new sizes as the reference even if they exceed the size budget")
+	parser.add_argument("--no-size-report", action="store_true", help=f"Do not write or check <artifact>{SIZE_REPORT_SUFFIX}")
+
+
+def configure_size_report(args: argparse.Namespace):
+	"""Applies the size report switches to every archive reported from now on."""
+	global _enabled, _budget_path, _accept_growth
+	if args.size_budget != DEFAULT_BUDGET_PATH and not os.path.isfile(args.size_budget):
+		raise FileNotFoundError(f"Size budget not found: {args.size_budget}")
+	_enabled = not args.no_size_report
+	_budget_path = args.size_budget
+	_accept_growth = args.accept_size_growth
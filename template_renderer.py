@@ -0,0 +1,83 @@
+"""
+Streaming renderer for the installer source templates.
+
+Templates mark substitution points with explicit tokens of the form @@NAME@@
+(upper-case letters, digits and underscores). The template text is scanned once
+for tokens; the output is written in a single pass, copying stream values in
+chunks, so rendered payloads are never held in memory and are never scanned
+for tokens themselves.
+
+Values may be:
+  str         written as-is
+  Base64Value a binary stream, base64-encoded in chunks while copying
+
+Every token in the template must have a value and every value must be used.
+"""
+
+import base64
+import os
+import re
+from typing import BinaryIO, Dict, TextIO, Union
+
+from build_metrics import phase
+
+
+TOKEN_PATTERN = re.compile(r"@@([A-Z][A-Z0-9_]*)@@")
+
+# multiple of 3 so chunk boundaries never introduce base64 padding
+BASE64_CHUNK_SIZE = 3 * 256 * 1024
+
+
+class Base64Value:
+	"""Substitutes a binary stream as a single-line base64 string."""
+
+	def __init__(self, stream: BinaryIO):
+		self.stream = stream
+
+	def write_to(self, out: TextIO):
+		while True:
+			chunk = self.stream.read(BASE64_CHUNK_SIZE)
+			if not chunk:
+				break
+			out.write(base64.b64encode(chunk).decode("ascii"))
+
+
+TemplateValue = Union[str, Base64Value]
+
+
+def template_tokens(template_text: str) -> set:
+	"""Returns the names of the tokens used in a template."""
+	return {m.group(1) for m in TOKEN_PATTERN.finditer(template_text)}
+
+
+def render_to_stream(template_text: str, values: Dict[str, TemplateValue], out: TextIO):
+	"""Writes template_text to out with every @@NAME@@ token replaced by values[NAME]."""
+	missing = template_tokens(template_text) - set(values)
+	if missing:
+		raise KeyError(f"No value for template token(s): {', '.join(sorted(missing))}")
+	unused = set(values) - template_tokens(template_text)
+	if unused:
+		raise KeyError(f"Template has no token(s): {', '.join(sorted(unused))}")
+
+	position = 0
+	for match in TOKEN_PATTERN.finditer(template_text):
+		out.write(template_text[position:match.start()])
+		value = values[match.group(1)]
+		if isinstance(value, str):
+			out.write(value)
+		else:
+			value.write_to(out)
+		position = match.end()
+	out.write(template_text[position:])
+
+
+def render_template(template_path: str, output_path: str, values: Dict[str, TemplateValue]):
+	"""Renders the template file at template_path into output_path."""
+	with phase("render template", template=os.path.basename(template_path)) as record:
+		with open(template_path, "r", encoding="utf-8", newline="") as f:
+			template_text = f.read()
+		record.bytes_in = len(template_text)
+
+		with open(output_path, "w", encoding="utf-8", newline="") as out:
+			render_to_stream(template_text, values, out)
+		record.bytes_out = os.path.getsize(output_path)
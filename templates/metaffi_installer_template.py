@@ -1,5 +1,10 @@
-import base64
+import hashlib
 import io
+import json
+import lzma
+import ntpath
+import posixpath
+import mmap
 import platform
 import re
 import shlex
@@ -7,10 +12,12 @@ import shutil
 import sys
 import ctypes
 import os
+import struct
 import traceback
 import typing
 import zipfile
 import subprocess
+import tempfile
 import importlib
 import sys
 
@@ -45,9 +52,13 @@ def ensure_package(package_name, pip_package_name=None):
 ensure_package("pycrosskit")
 from pycrosskit.envariables import SysEnv
 
-windows_x64_zip = 'windows_x64_zip_data'
-ubuntu_x64_zip = 'ubuntu_x64_zip_data'
-METAFFI_VERSION = '0.0.0'
+METAFFI_VERSION = '@@METAFFI_VERSION@@'
+
+# Binary payload container bundled next to the installer (see payload_format.py in metaffi-installer)
+PAYLOAD_FILE = 'metaffi_payload.bin'
+PAYLOAD_MAGIC = b'MFFIPAYL'
+PAYLOAD_HEADER_STRUCT = '<8sHHI'
+PAYLOAD_SECTION_STRUCT = '<32sQQ32s'
 
 is_silent = False
 
@@ -147,16 +158,91 @@ def get_install_dir(default_dir: str):
 	return install_dir
 
 
-# Define the function
-def unpack_into_directory(base64_zip_file, target_directory):
-	# Decode the base64 string to a byte array
-	zip_data = base64.b64decode(base64_zip_file)
+class PayloadRegion(io.RawIOBase):
+	"""Read-only, seekable file object over one section of the memory-mapped payload file."""
 	
-	zip_data = io.BytesIO(zip_data)  # to clear a pycharm warning
+	def __init__(self, mapped: mmap.mmap, start: int, length: int):
+		self.mapped = mapped
+		self.start = start
+		self.length = length
+		self.pos = 0
 	
-	# Create a zip file object from the byte array
-	# Specify the compression type and level
-	zf = zipfile.ZipFile(zip_data, "r", zipfile.ZIP_DEFLATED, compresslevel=9)
+	def readable(self):
+		return True
+	
+	def seekable(self):
+		return True
+	
+	def tell(self):
+		return self.pos
+	
+	def seek(self, pos, whence=io.SEEK_SET):
+		if whence == io.SEEK_CUR:
+			pos += self.pos
+		elif whence == io.SEEK_END:
+			pos += self.length
+		self.pos = max(0, min(pos, self.length))
+		return self.pos
+	
+	def readinto(self, buffer):
+		count = min(len(buffer), self.length - self.pos)
+		begin = self.start + self.pos
+		buffer[:count] = self.mapped[begin:begin + count]
+		self.pos += count
+		return count
+
+
+def find_payload_file() -> str:
+	# PyInstaller extracts bundled data files into sys._MEIPASS.
+	# When running the .py directly, the payload sits next to it.
+	base_dir = getattr(sys, '_MEIPASS', os.path.dirname(os.path.abspath(__file__)))
+	return os.path.join(base_dir, PAYLOAD_FILE)
+
+
+def open_payload_section(name: str) -> PayloadRegion:
+	"""Maps only the requested section of the payload file and verifies its hash."""
+	path = find_payload_file()
+	if not os.path.isfile(path):
+		raise Exception(f'Installer payload is missing: {path}')
+	
+	with open(path, 'rb') as f:
+		magic, version, count, _ = struct.unpack(PAYLOAD_HEADER_STRUCT, f.read(struct.calcsize(PAYLOAD_HEADER_STRUCT)))
+		if magic != PAYLOAD_MAGIC:
+			raise Exception(f'Installer payload is corrupted (bad magic): {path}')
+		
+		section_size = struct.calcsize(PAYLOAD_SECTION_STRUCT)
+		table = f.read(section_size * count)
+		for i in range(count):
+			raw_name, offset, length, digest = struct.unpack_from(PAYLOAD_SECTION_STRUCT, table, i * section_size)
+			if raw_name.rstrip(b'\0').decode('utf-8') == name:
+				break
+		else:
+			raise Exception(f'Installer payload has no "{name}" section. Is this the right installer for this OS?')
+		
+		# hash with plain reads, so verifying does not keep the whole section resident
+		sha = hashlib.sha256()
+		f.seek(offset)
+		remaining = length
+		while remaining > 0:
+			chunk = f.read(min(remaining, 1024 * 1024))
+			if not chunk:
+				break
+			sha.update(chunk)
+			remaining -= len(chunk)
+		if sha.digest() != digest:
+			raise Exception(f'Installer payload "{name}" failed the integrity check')
+		
+		# mmap offsets must be aligned to the allocation granularity
+		aligned = offset - (offset % mmap.ALLOCATIONGRANULARITY)
+		mapped = mmap.mmap(f.fileno(), length + (offset - aligned), access=mmap.ACCESS_READ, offset=aligned)
+	
+	start = offset - aligned
+	return PayloadRegion(mapped, start, length)
+
+
+def unpack_into_directory(zip_file: typing.BinaryIO, target_directory):
+	# Create a zip file object over the payload section
+	zf = zipfile.ZipFile(zip_file, "r")
 	
 	# Check if the target directory exists
 	if not os.path.exists(target_directory):
@@ -167,6 +253,245 @@ def unpack_into_directory(base64_zip_file, target_directory):
 	zf.extractall(target_directory)
 
 
+# Files shared between packages of a release (see shared_files.py in metaffi-installer)
+SHARED_FORMAT_VERSION = 1
+SHARED_FILES_NAME = 'shared_files.json'
+SHARED_STORE_DIR = '.metaffi-shared'
+SHARED_BLOB_PREFIX = 'blobs/'
+SHARED_COPY_CHUNK_SIZE = 1024 * 1024
+
+
+def install_path(install_dir: str, name: str) -> str:
+	"""Returns the path of a packaged file in install_dir, refusing names that would leave it (absolute, drive letters, '..')."""
+	normalized = posixpath.normpath(name.replace('\\', '/'))
+	if posixpath.isabs(normalized) or ntpath.splitdrive(normalized)[0] or normalized in ('.', '..') or normalized.startswith('../'):
+		raise Exception(f'Refusing to install {name!r}: it is not a path inside {install_dir}')
+	return os.path.join(install_dir, *normalized.split('/'))
+
+
+def extract_shared_blobs(archive: zipfile.ZipFile, store_dir: str):
+	"""Extracts the blobs of a companion archive that are not in the shared store yet."""
+	os.makedirs(store_dir, exist_ok=True)
+	for info in archive.infolist():
+		if not info.filename.startswith(SHARED_BLOB_PREFIX):
+			continue
+		digest = info.filename[len(SHARED_BLOB_PREFIX):]
+		blob_path = os.path.join(store_dir, digest)
+		if os.path.isfile(blob_path):
+			continue
+		temp_path = blob_path + '.tmp'
+		hasher = hashlib.sha256()
+		with archive.open(info) as src, open(temp_path, 'wb') as f:
+			while chunk := src.read(SHARED_COPY_CHUNK_SIZE):
+				hasher.update(chunk)
+				f.write(chunk)
+		if hasher.hexdigest() != digest:
+			os.remove(temp_path)
+			raise Exception(f'Shared blob {info.filename} is corrupted')
+		mode = (info.external_attr >> 16) & 0o777
+		if mode:
+			os.chmod(temp_path, mode)
+		os.replace(temp_path, blob_path)
+
+
+def materialize_shared_files(install_dir: str, store_dir: str):
+	"""Creates the files listed in shared_files.json as hardlinks to (or copies of) their blobs in the shared store."""
+	with open(os.path.join(install_dir, SHARED_FILES_NAME), 'r') as f:
+		listing = json.load(f)
+	if listing.get('format') != SHARED_FORMAT_VERSION:
+		raise Exception(f'Unsupported shared files format {listing.get("format")}')
+	
+	destinations = {name: install_path(install_dir, name) for name in listing['files']}
+	invalid = [name for name, entry in listing['files'].items() if not re.fullmatch('[0-9a-f]{64}', entry['sha256'])]
+	if invalid:
+		raise Exception(f'Invalid shared blob digest for {invalid[0]} in {SHARED_FILES_NAME}')
+	
+	missing = [name for name, entry in listing['files'].items() if not os.path.isfile(os.path.join(store_dir, entry['sha256']))]
+	if missing:
+		raise Exception(f'{len(missing)} shared file(s) are missing from {store_dir}, e.g. {missing[0]}. '
+						f'Install the MetaFFI core of the same release first, or pass its {listing["shared_archive"]}')
+	
+	for name, entry in listing['files'].items():
+		blob_path = os.path.join(store_dir, entry['sha256'])
+		destination = destinations[name]
+		os.makedirs(os.path.dirname(destination), exist_ok=True)
+		if os.path.lexists(destination):
+			os.remove(destination)
+		if os.name == 'nt' or not entry.get('mode') or os.stat(blob_path).st_mode & 0o777 == entry['mode']:
+			try:
+				os.link(blob_path, destination)
+				continue
+			except OSError:
+				pass
+		shutil.copyfile(blob_path, destination)
+		if entry.get('mode'):
+			os.chmod(destination, entry['mode'])
+	print(f'Linked {len(listing["files"])} shared file(s) into {install_dir}')
+
+
+def install_shared_files(install_dir: str):
+	"""Materializes the files the core package shares with plugin packages, from the "shared" payload section."""
+	if not os.path.isfile(os.path.join(install_dir, SHARED_FILES_NAME)):
+		return
+	
+	store_dir = os.path.join(install_dir, SHARED_STORE_DIR)
+	with zipfile.ZipFile(open_payload_section('shared'), 'r') as archive:
+		extract_shared_blobs(archive, store_dir)
+	materialize_shared_files(install_dir, store_dir)
+
+
+# Lock of the installed files (see manifest_lock.py in metaffi-installer)
+FILES_LOCK_FORMAT_VERSION = 1
+FILES_LOCK_NAME = 'files.lock.json'
+
+
+def verify_installed_files(install_dir: str, check_digests: bool = False):
+	"""Checks the installed files against the package's files.lock.json: their sizes, and with check_digests their SHA-256."""
+	lock_path = os.path.join(install_dir, FILES_LOCK_NAME)
+	if not os.path.isfile(lock_path):
+		print(f'{FILES_LOCK_NAME} not found in {install_dir}, skipping the integrity check')
+		return
+	with open(lock_path, 'r') as f:
+		lock = json.load(f)
+	if lock.get('format') != FILES_LOCK_FORMAT_VERSION:
+		raise Exception(f'Unsupported files lock format {lock.get("format")}')
+	
+	damaged = []
+	for name, entry in lock['files'].items():
+		path = os.path.join(install_dir, name)
+		if not os.path.isfile(path) or os.path.getsize(path) != entry['size'] or (check_digests and file_sha256(path) != entry['sha256']):
+			damaged.append(name)
+	if damaged:
+		raise Exception(f'{len(damaged)} installed file(s) of {install_dir} are missing or damaged, e.g. {damaged[0]}')
+	print(f'Verified {len(lock["files"])} installed file(s){" by SHA-256" if check_digests else ""}')
+
+
+# Delta packages (see delta_format.py in metaffi-installer)
+DELTA_MAGIC = b'MFFIDLTA'
+DELTA_FORMAT_VERSION = 1
+DELTA_MANIFEST_NAME = 'delta_manifest.json'
+DELTA_HEADER_STRUCT = '<8sHQQ32s32s'
+DELTA_OP_STRUCT = '<BQQ'
+DELTA_OP_COPY = 0
+DELTA_COPY_CHUNK_SIZE = 1024 * 1024
+
+
+class PatchBody:
+	"""Reads the xz body of a binary patch, decompressing at most the requested bytes at a time."""
+	
+	def __init__(self, patch: typing.BinaryIO):
+		self.patch = patch
+		self.decompressor = lzma.LZMADecompressor()
+	
+	def read(self, size: int) -> bytes:
+		parts = []
+		while size > 0:
+			data = self.patch.read(DELTA_COPY_CHUNK_SIZE) if self.decompressor.needs_input else b''
+			if self.decompressor.eof or (not data and self.decompressor.needs_input):
+				raise Exception('Binary patch is truncated')
+			chunk = self.decompressor.decompress(data, max_length=min(size, DELTA_COPY_CHUNK_SIZE))
+			parts.append(chunk)
+			size -= len(chunk)
+		return b''.join(parts)
+
+
+def copy_hashed(read, size: int, out: typing.BinaryIO, digest):
+	"""Writes size bytes returned by read(n) calls to out, adding them to digest."""
+	while size > 0:
+		chunk = read(min(size, DELTA_COPY_CHUNK_SIZE))
+		if not chunk:
+			raise Exception('Binary patch refers past the end of the installed file')
+		digest.update(chunk)
+		out.write(chunk)
+		size -= len(chunk)
+
+
+def apply_patch(base_path: str, patch: typing.BinaryIO, out: typing.BinaryIO):
+	"""Applies a binary patch to an installed file and writes the result to out, streaming, verifying the base and the result against the patch hashes."""
+	header = patch.read(struct.calcsize(DELTA_HEADER_STRUCT))
+	if len(header) != struct.calcsize(DELTA_HEADER_STRUCT):
+		raise Exception('Unsupported binary patch')
+	magic, version, base_size, target_size, base_sha256, target_sha256 = struct.unpack(DELTA_HEADER_STRUCT, header)
+	if magic != DELTA_MAGIC or version != DELTA_FORMAT_VERSION:
+		raise Exception('Unsupported binary patch')
+	
+	with open(base_path, 'rb') as base:
+		if os.fstat(base.fileno()).st_size != base_size or hashlib.file_digest(base, 'sha256').digest() != base_sha256:
+			raise Exception('Binary patch does not apply: the installed file does not match')
+		
+		body = PatchBody(patch)
+		ops = body.read(struct.unpack('<Q', body.read(8))[0])
+		digest = hashlib.sha256()
+		written = 0
+		for op, a, b in struct.iter_unpack(DELTA_OP_STRUCT, ops):
+			if op == DELTA_OP_COPY:
+				base.seek(a)
+				copy_hashed(base.read, b, out, digest)
+				written += b
+			else:
+				copy_hashed(body.read, a, out, digest)
+				written += a
+	
+	if written != target_size or digest.digest() != target_sha256:
+		raise Exception('Binary patch produced a corrupted file')
+
+
+def file_sha256(path: str) -> str | None:
+	try:
+		with open(path, 'rb') as f:
+			return hashlib.file_digest(f, 'sha256').hexdigest()
+	except FileNotFoundError:
+		return None
+
+
+def apply_delta_package(package_path: str, install_dir: str):
+	"""Upgrades an installation with a delta package, after verifying every installed file of the base release by hash."""
+	with zipfile.ZipFile(package_path) as package:
+		manifest = json.loads(package.read(DELTA_MANIFEST_NAME))
+		if manifest.get('format') != DELTA_FORMAT_VERSION:
+			raise Exception(f'Unsupported delta package format {manifest.get("format")}')
+		
+		paths = {name: install_path(install_dir, name) for name in [*manifest['base'], *manifest['files'], *manifest['removed']]}
+		print(f'Verifying {install_dir} is {manifest["base_name"]}...')
+		mismatched = [name for name, digest in manifest['base'].items() if file_sha256(paths[name]) != digest]
+		if mismatched:
+			raise Exception(f'{install_dir} is not {manifest["base_name"]}: {len(mismatched)} file(s) differ, e.g. {mismatched[0]}')
+		
+		# prepare every new file next to its destination before replacing anything
+		prepared = []
+		try:
+			for name, entry in manifest['files'].items():
+				print(f'{entry["action"]}: {name}')
+				destination = paths[name]
+				os.makedirs(os.path.dirname(destination), exist_ok=True)
+				fd, temp_path = tempfile.mkstemp(prefix='.delta_', dir=os.path.dirname(destination))
+				prepared.append((temp_path, destination))
+				with os.fdopen(fd, 'wb') as out, package.open(entry['member']) as member:
+					if entry['action'] == 'patch':
+						apply_patch(destination, member, out)
+					else:
+						digest = hashlib.sha256()
+						while chunk := member.read(DELTA_COPY_CHUNK_SIZE):
+							digest.update(chunk)
+							out.write(chunk)
+						if digest.hexdigest() != entry['sha256']:
+							raise Exception(f'Delta package member {entry["member"]} is corrupted')
+				if entry.get('mode'):
+					os.chmod(temp_path, entry['mode'])
+		except BaseException:
+			for temp_path, _ in prepared:
+				os.remove(temp_path)
+			raise
+	
+	for temp_path, destination in prepared:
+		os.replace(temp_path, destination)
+	for name in manifest['removed']:
+		print(f'remove: {name}')
+		os.remove(paths[name])
+	
+	print(f'Upgraded {install_dir} to {manifest["target_name"]}')
+
+
 refresh_env: typing.Callable
 
 
@@ -391,8 +716,6 @@ elif is_ubuntu():
 
 
 def install_windows() -> str:
-	global windows_x64_zip
-	
 	# verify running as admin
 	# is_admin = ctypes.windll.shell32.IsUserAnAdmin() != 0
 	# if not is_admin:
@@ -410,7 +733,9 @@ def install_windows() -> str:
 	install_dir = get_install_dir(os.path.expanduser('~/MetaFFI/'))
 	
 	# unpack zip into install dir
-	unpack_into_directory(windows_x64_zip, install_dir)
+	unpack_into_directory(open_payload_section('windows_x64'), install_dir)
+	install_shared_files(install_dir)
+	verify_installed_files(install_dir)
 	
 	# setting METAFFI_HOME environment variable
 	set_windows_user_environment_variable("METAFFI_HOME", install_dir)
@@ -550,8 +875,6 @@ def make_metaffi_available_globally(install_dir: str):
 
 
 def install_ubuntu() -> str:
-	global ubuntu_x64_zip
-	
 	# verify running as admin
 	is_admin = os.getuid() == 0 # pyright: ignore
 	if not is_admin:
@@ -565,7 +888,9 @@ def install_ubuntu() -> str:
 	install_dir = get_install_dir("/usr/local/metaffi/")
 	
 	# unpack zip into install dir
-	unpack_into_directory(ubuntu_x64_zip, install_dir)
+	unpack_into_directory(open_payload_section('ubuntu_x64'), install_dir)
+	install_shared_files(install_dir)
+	verify_installed_files(install_dir)
 	
 	make_metaffi_available_globally(install_dir)
 	
@@ -599,20 +924,37 @@ rm -rf "$TEMP_DIR"
 # -------------------------------
 
 
+delta_package: str | None = None
+verify_only = False
+
+
 def set_installer_flags():
 	global is_silent
+	global delta_package
+	global verify_only
 	
-	for arg in sys.argv:
+	for i, arg in enumerate(sys.argv):
 		arg = arg.lower()
 		
 		if arg == '-h' or arg == '--help' or arg == '/?' or arg == '/h':
 			print('MetaFFI Installer')
 			print('-s - silent mode (using defaults)')
+			print('--apply-delta <package> - upgrade the installation in METAFFI_HOME with a delta package (see build_delta.py)')
+			print('--verify - check the installation in METAFFI_HOME against its files.lock.json by SHA-256')
 			return False
 		
 		if arg == "/s" or arg == "-s":
 			is_silent = True
 		
+		if arg == '--apply-delta':
+			if i + 1 >= len(sys.argv):
+				print('--apply-delta expects a delta package path', file=sys.stderr)
+				exit(1)
+			delta_package = sys.argv[i + 1]
+		
+		if arg == '--verify':
+			verify_only = True
+		
 			
 	return True
 
@@ -623,6 +965,26 @@ def main():
 	if not set_installer_flags():  # returns is continue running installer
 		return
 	
+	if delta_package is not None:
+		try:
+			if 'METAFFI_HOME' not in os.environ:
+				raise Exception('METAFFI_HOME environment variable is not set. Make sure MetaFFI has been installed')
+			apply_delta_package(delta_package, os.environ['METAFFI_HOME'])
+		except Exception as exp:
+			traceback.print_exc()
+			exit(2)
+		return
+	
+	if verify_only:
+		try:
+			if 'METAFFI_HOME' not in os.environ:
+				raise Exception('METAFFI_HOME environment variable is not set. Make sure MetaFFI has been installed')
+			verify_installed_files(os.environ['METAFFI_HOME'], check_digests=True)
+		except Exception as exp:
+			traceback.print_exc()
+			exit(2)
+		return
+	
 	try:
 		install_dir = None
 		if platform.system() == 'Windows':
@@ -1,6 +1,11 @@
 import base64
+import hashlib
 import io
 import argparse
+import json
+import lzma
+import ntpath
+import posixpath
 import platform
 import re
 import shlex
@@ -8,6 +13,7 @@ import shutil
 import sys
 import ctypes
 import os
+import struct
 import tempfile
 import traceback
 import typing
@@ -15,10 +21,10 @@ import zipfile
 import subprocess
 import urllib.request
 
-windows_x64_zip = 'windows_x64_zip_data'
-ubuntu_x64_zip = 'ubuntu_x64_zip_data'
-PLUGIN_VERSION = '0.0.0'
-PLUGIN_NAME=""
+windows_x64_zip = '@@WINDOWS_X64_ZIP@@'
+ubuntu_x64_zip = '@@UBUNTU_X64_ZIP@@'
+PLUGIN_VERSION = '@@PLUGIN_VERSION@@'
+PLUGIN_NAME = '@@PLUGIN_NAME@@'
 is_silent = False
 
 def setup_environment():
@@ -124,6 +130,249 @@ def unpack_into_directory(base64_zip_file, target_directory):
 	zf.extractall(target_directory)
 
 
+# Files shared between packages of a release (see shared_files.py in metaffi-installer)
+SHARED_FORMAT_VERSION = 1
+SHARED_FILES_NAME = 'shared_files.json'
+SHARED_STORE_DIR = '.metaffi-shared'
+SHARED_BLOB_PREFIX = 'blobs/'
+SHARED_COPY_CHUNK_SIZE = 1024 * 1024
+
+
+def install_path(install_dir: str, name: str) -> str:
+	"""Returns the path of a packaged file in install_dir, refusing names that would leave it (absolute, drive letters, '..')."""
+	normalized = posixpath.normpath(name.replace('\\', '/'))
+	if posixpath.isabs(normalized) or ntpath.splitdrive(normalized)[0] or normalized in ('.', '..') or normalized.startswith('../'):
+		raise Exception(f'Refusing to install {name!r}: it is not a path inside {install_dir}')
+	return os.path.join(install_dir, *normalized.split('/'))
+
+
+def extract_shared_blobs(archive: zipfile.ZipFile, store_dir: str):
+	"""Extracts the blobs of a companion archive that are not in the shared store yet."""
+	os.makedirs(store_dir, exist_ok=True)
+	for info in archive.infolist():
+		if not info.filename.startswith(SHARED_BLOB_PREFIX):
+			continue
+		digest = info.filename[len(SHARED_BLOB_PREFIX):]
+		blob_path = os.path.join(store_dir, digest)
+		if os.path.isfile(blob_path):
+			continue
+		temp_path = blob_path + '.tmp'
+		hasher = hashlib.sha256()
+		with archive.open(info) as src, open(temp_path, 'wb') as f:
+			while chunk := src.read(SHARED_COPY_CHUNK_SIZE):
+				hasher.update(chunk)
+				f.write(chunk)
+		if hasher.hexdigest() != digest:
+			os.remove(temp_path)
+			raise Exception(f'Shared blob {info.filename} is corrupted')
+		mode = (info.external_attr >> 16) & 0o777
+		if mode:
+			os.chmod(temp_path, mode)
+		os.replace(temp_path, blob_path)
+
+
+def materialize_shared_files(install_dir: str, store_dir: str):
+	"""Creates the files listed in shared_files.json as hardlinks to (or copies of) their blobs in the shared store."""
+	with open(os.path.join(install_dir, SHARED_FILES_NAME), 'r') as f:
+		listing = json.load(f)
+	if listing.get('format') != SHARED_FORMAT_VERSION:
+		raise Exception(f'Unsupported shared files format {listing.get("format")}')
+	
+	destinations = {name: install_path(install_dir, name) for name in listing['files']}
+	invalid = [name for name, entry in listing['files'].items() if not re.fullmatch('[0-9a-f]{64}', entry['sha256'])]
+	if invalid:
+		raise Exception(f'Invalid shared blob digest for {invalid[0]} in {SHARED_FILES_NAME}')
+	
+	missing = [name for name, entry in listing['files'].items() if not os.path.isfile(os.path.join(store_dir, entry['sha256']))]
+	if missing:
+		raise Exception(f'{len(missing)} shared file(s) are missing from {store_dir}, e.g. {missing[0]}. '
+						f'Install the MetaFFI core of the same release first, or pass its {listing["shared_archive"]}')
+	
+	for name, entry in listing['files'].items():
+		blob_path = os.path.join(store_dir, entry['sha256'])
+		destination = destinations[name]
+		os.makedirs(os.path.dirname(destination), exist_ok=True)
+		if os.path.lexists(destination):
+			os.remove(destination)
+		if os.name == 'nt' or not entry.get('mode') or os.stat(blob_path).st_mode & 0o777 == entry['mode']:
+			try:
+				os.link(blob_path, destination)
+				continue
+			except OSError:
+				pass
+		shutil.copyfile(blob_path, destination)
+		if entry.get('mode'):
+			os.chmod(destination, entry['mode'])
+	print(f'Linked {len(listing["files"])} shared file(s) into {install_dir}')
+
+
+def install_shared_files(install_dir: str, metaffi_home: str, shared_archive: str | None):
+	"""Materializes the files the plugin package shares with the core and other plugins.
+	
+	Their blobs come from the shared store of the core installation, or from the release's companion archive.
+	"""
+	if not os.path.isfile(os.path.join(install_dir, SHARED_FILES_NAME)):
+		return
+	
+	store_dir = os.path.join(metaffi_home, SHARED_STORE_DIR)
+	if shared_archive is not None:
+		with zipfile.ZipFile(shared_archive, 'r') as archive:
+			extract_shared_blobs(archive, store_dir)
+	materialize_shared_files(install_dir, store_dir)
+
+
+# Lock of the installed files (see manifest_lock.py in metaffi-installer)
+FILES_LOCK_FORMAT_VERSION = 1
+FILES_LOCK_NAME = 'files.lock.json'
+
+
+def verify_installed_files(install_dir: str, check_digests: bool = False):
+	"""Checks the installed files against the package's files.lock.json: their sizes, and with check_digests their SHA-256."""
+	lock_path = os.path.join(install_dir, FILES_LOCK_NAME)
+	if not os.path.isfile(lock_path):
+		print(f'{FILES_LOCK_NAME} not found in {install_dir}, skipping the integrity check')
+		return
+	with open(lock_path, 'r') as f:
+		lock = json.load(f)
+	if lock.get('format') != FILES_LOCK_FORMAT_VERSION:
+		raise Exception(f'Unsupported files lock format {lock.get("format")}')
+	
+	damaged = []
+	for name, entry in lock['files'].items():
+		path = os.path.join(install_dir, name)
+		if not os.path.isfile(path) or os.path.getsize(path) != entry['size'] or (check_digests and file_sha256(path) != entry['sha256']):
+			damaged.append(name)
+	if damaged:
+		raise Exception(f'{len(damaged)} installed file(s) of {install_dir} are missing or damaged, e.g. {damaged[0]}')
+	print(f'Verified {len(lock["files"])} installed file(s){" by SHA-256" if check_digests else ""}')
+
+
+# Delta packages (see delta_format.py in metaffi-installer)
+DELTA_MAGIC = b'MFFIDLTA'
+DELTA_FORMAT_VERSION = 1
+DELTA_MANIFEST_NAME = 'delta_manifest.json'
+DELTA_HEADER_STRUCT = '<8sHQQ32s32s'
+DELTA_OP_STRUCT = '<BQQ'
+DELTA_OP_COPY = 0
+DELTA_COPY_CHUNK_SIZE = 1024 * 1024
+
+
+class PatchBody:
+	"""Reads the xz body of a binary patch, decompressing at most the requested bytes at a time."""
+	
+	def __init__(self, patch: typing.BinaryIO):
+		self.patch = patch
+		self.decompressor = lzma.LZMADecompressor()
+	
+	def read(self, size: int) -> bytes:
+		parts = []
+		while size > 0:
+			data = self.patch.read(DELTA_COPY_CHUNK_SIZE) if self.decompressor.needs_input else b''
+			if self.decompressor.eof or (not data and self.decompressor.needs_input):
+				raise Exception('Binary patch is truncated')
+			chunk = self.decompressor.decompress(data, max_length=min(size, DELTA_COPY_CHUNK_SIZE))
+			parts.append(chunk)
+			size -= len(chunk)
+		return b''.join(parts)
+
+
+def copy_hashed(read, size: int, out: typing.BinaryIO, digest):
+	"""Writes size bytes returned by read(n) calls to out, adding them to digest."""
+	while size > 0:
+		chunk = read(min(size, DELTA_COPY_CHUNK_SIZE))
+		if not chunk:
+			raise Exception('Binary patch refers past the end of the installed file')
+		digest.update(chunk)
+		out.write(chunk)
+		size -= len(chunk)
+
+
+def apply_patch(base_path: str, patch: typing.BinaryIO, out: typing.BinaryIO):
+	"""Applies a binary patch to an installed file and writes the result to out, streaming, verifying the base and the result against the patch hashes."""
+	header = patch.read(struct.calcsize(DELTA_HEADER_STRUCT))
+	if len(header) != struct.calcsize(DELTA_HEADER_STRUCT):
+		raise Exception('Unsupported binary patch')
+	magic, version, base_size, target_size, base_sha256, target_sha256 = struct.unpack(DELTA_HEADER_STRUCT, header)
+	if magic != DELTA_MAGIC or version != DELTA_FORMAT_VERSION:
+		raise Exception('Unsupported binary patch')
+	
+	with open(base_path, 'rb') as base:
+		if os.fstat(base.fileno()).st_size != base_size or hashlib.file_digest(base, 'sha256').digest() != base_sha256:
+			raise Exception('Binary patch does not apply: the installed file does not match')
+		
+		body = PatchBody(patch)
+		ops = body.read(struct.unpack('<Q', body.read(8))[0])
+		digest = hashlib.sha256()
+		written = 0
+		for op, a, b in struct.iter_unpack(DELTA_OP_STRUCT, ops):
+			if op == DELTA_OP_COPY:
+				base.seek(a)
+				copy_hashed(base.read, b, out, digest)
+				written += b
+			else:
+				copy_hashed(body.read, a, out, digest)
+				written += a
+	
+	if written != target_size or digest.digest() != target_sha256:
+		raise Exception('Binary patch produced a corrupted file')
+
+
+def file_sha256(path: str) -> str | None:
+	try:
+		with open(path, 'rb') as f:
+			return hashlib.file_digest(f, 'sha256').hexdigest()
+	except FileNotFoundError:
+		return None
+
+
+def apply_delta_package(package_path: str, install_dir: str):
+	"""Upgrades an installation with a delta package, after verifying every installed file of the base release by hash."""
+	with zipfile.ZipFile(package_path) as package:
+		manifest = json.loads(package.read(DELTA_MANIFEST_NAME))
+		if manifest.get('format') != DELTA_FORMAT_VERSION:
+			raise Exception(f'Unsupported delta package format {manifest.get("format")}')
+		
+		paths = {name: install_path(install_dir, name) for name in [*manifest['base'], *manifest['files'], *manifest['removed']]}
+		print(f'Verifying {install_dir} is {manifest["base_name"]}...')
+		mismatched = [name for name, digest in manifest['base'].items() if file_sha256(paths[name]) != digest]
+		if mismatched:
+			raise Exception(f'{install_dir} is not {manifest["base_name"]}: {len(mismatched)} file(s) differ, e.g. {mismatched[0]}')
+		
+		# prepare every new file next to its destination before replacing anything
+		prepared = []
+		try:
+			for name, entry in manifest['files'].items():
+				print(f'{entry["action"]}: {name}')
+				destination = paths[name]
+				os.makedirs(os.path.dirname(destination), exist_ok=True)
+				fd, temp_path = tempfile.mkstemp(prefix='.delta_', dir=os.path.dirname(destination))
+				prepared.append((temp_path, destination))
+				with os.fdopen(fd, 'wb') as out, package.open(entry['member']) as member:
+					if entry['action'] == 'patch':
+						apply_patch(destination, member, out)
+					else:
+						digest = hashlib.sha256()
+						while chunk := member.read(DELTA_COPY_CHUNK_SIZE):
+							digest.update(chunk)
+							out.write(chunk)
+						if digest.hexdigest() != entry['sha256']:
+							raise Exception(f'Delta package member {entry["member"]} is corrupted')
+				if entry.get('mode'):
+					os.chmod(temp_path, entry['mode'])
+		except BaseException:
+			for temp_path, _ in prepared:
+				os.remove(temp_path)
+			raise
+	
+	for temp_path, destination in prepared:
+		os.replace(temp_path, destination)
+	for name in manifest['removed']:
+		print(f'remove: {name}')
+		os.remove(paths[name])
+	
+	print(f'Upgraded {install_dir} to {manifest["target_name"]}')
+
+
 refresh_env: typing.Callable
 
 
@@ -356,7 +605,7 @@ elif is_ubuntu():
 	refresh_env = refresh_ubuntu_env
 
 
-def install():
+def install(shared_archive: str | None = None):
 	global windows_x64_zip
 	global ubuntu_x64_zip
 
@@ -404,6 +653,8 @@ def install():
 	# unpack zip into install dir
 	print('Unpacking zip into plugin directory...')
 	unpack_into_directory(x64_zip, install_dir)
+	install_shared_files(install_dir, metaffi_home, shared_archive)
+	verify_installed_files(install_dir)
 	
 	# setup environment
 	print('Setting up environment...')
@@ -638,7 +889,10 @@ def parse_action_and_flags():
 	parser.add_argument('-p', '--print-prerequisites', action='store_true', help='Print prerequisites only')
 	parser.add_argument('-i', '--install', action='store_true', help='Install plugin')
 	parser.add_argument('-u', '--uninstall', action='store_true', help='Uninstall plugin')
+	parser.add_argument('-d', '--apply-delta', metavar='PACKAGE', help='Upgrade the installed plugin with a delta package')
+	parser.add_argument('-v', '--verify', action='store_true', help='Check the installed plugin against its files.lock.json by SHA-256')
 	parser.add_argument('-s', '--silent', action='store_true', help='Silent mode')
+	parser.add_argument('--shared-archive', metavar='ARCHIVE', help='Companion archive of a deduplicated release (metaffi-shared-*.zip), if the MetaFFI core was not installed from the same release')
 	args = parser.parse_args()
 
 	flag_actions = []
@@ -650,6 +904,10 @@ def parse_action_and_flags():
 		flag_actions.append('install')
 	if args.uninstall:
 		flag_actions.append('uninstall')
+	if args.apply_delta:
+		flag_actions.append('apply-delta')
+	if args.verify:
+		flag_actions.append('verify')
 
 	if len(flag_actions) > 1:
 		raise Exception(f'Choose only one action flag. Got: {flag_actions}')
@@ -665,14 +923,14 @@ def parse_action_and_flags():
 		# Backward-compatible default behavior
 		action = 'install'
 
-	return action, args.silent
+	return action, args.silent, args.apply_delta, args.shared_archive
 
 
 def main():
 	global is_silent
 
 	try:
-		action, is_silent = parse_action_and_flags()
+		action, is_silent, delta_package, shared_archive = parse_action_and_flags()
 
 		if action == 'check-prerequisites':
 			if check_prerequisites():
@@ -687,11 +945,25 @@ def main():
 			exit(0)
 
 		if action == 'install':
-			install_dir = install()
+			install_dir = install(shared_archive)
 			print('\nInstallation Complete!\nNotice you might need to logout/login or reboot to apply environmental changes\n')
 			print(f'To uninstall the plugin, run the "uninstall_plugin" at the plugin installation directory: {install_dir}\n')
 			exit(0)
 
+		if action == 'apply-delta':
+			metaffi_home = os.environ.get('METAFFI_HOME')
+			if metaffi_home is None or metaffi_home == '':
+				raise Exception('METAFFI_HOME environment variable is not set. Cannot upgrade plugin.')
+			apply_delta_package(delta_package, os.path.join(metaffi_home, PLUGIN_NAME))
+			exit(0)
+
+		if action == 'verify':
+			metaffi_home = os.environ.get('METAFFI_HOME')
+			if metaffi_home is None or metaffi_home == '':
+				raise Exception('METAFFI_HOME environment variable is not set. Cannot verify plugin.')
+			verify_installed_files(os.path.join(metaffi_home, PLUGIN_NAME), check_digests=True)
+			exit(0)
+
 		if action == 'uninstall':
 			uninstalled_dir = uninstall()
 			print(f'Plugin uninstalled successfully from: {uninstalled_dir}')
@@ -89,7 +89,7 @@ metaffi_home = os.path.abspath(metaffi_home)
 plugin_failures = []
 
 for plugindir in os.listdir(metaffi_home):
-	if plugindir == 'include':
+	if plugindir in ('include', '.metaffi-shared'):
 		continue
 
 	plugin_dir = os.path.join(metaffi_home, plugindir)
@@ -0,0 +1,136 @@
+"""
+Binary patches reproduce their target, and delta packages upgrade an extracted base release.
+"""
+
+import hashlib
+import io
+import json
+import os
+import random
+import sys
+import zipfile
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from build_delta import build_delta
+from delta_format import DELTA_FORMAT_VERSION, DELTA_MANIFEST_NAME, apply_delta_package, apply_patch, create_patch
+
+
+rng = random.Random(1)
+BODY = bytes(rng.getrandbits(8) for _ in range(256 * 1024))
+INSERTED = bytes(rng.getrandbits(8) for _ in range(5000))
+
+PATCH_CASES = {
+	"empty": (b"", b""),
+	"empty base": (b"", BODY),
+	"empty target": (BODY, b""),
+	"identical": (BODY, BODY),
+	"insertion": (BODY, BODY[:100_000] + INSERTED + BODY[100_000:]),
+	"deletion": (BODY, BODY[:100_000] + BODY[150_000:]),
+	"prefix": (BODY, INSERTED + BODY[1000:]),
+	"suffix": (BODY, BODY[:-1000] + INSERTED),
+}
+
+
+@pytest.mark.parametrize("base, target", PATCH_CASES.values(), ids=PATCH_CASES.keys())
+def test_patch_round_trip(tmp_path, base, target):
+	(tmp_path / "base").write_bytes(base)
+	(tmp_path / "target").write_bytes(target)
+	create_patch(str(tmp_path / "base"), str(tmp_path / "target"), str(tmp_path / "patch"))
+
+	out = io.BytesIO()
+	with open(tmp_path / "patch", "rb") as patch:
+		apply_patch(str(tmp_path / "base"), patch, out)
+	assert out.getvalue() == target
+
+
+def test_patch_refuses_other_base(tmp_path):
+	(tmp_path / "base").write_bytes(BODY)
+	(tmp_path / "target").write_bytes(BODY + INSERTED)
+	(tmp_path / "other").write_bytes(INSERTED + BODY)
+	create_patch(str(tmp_path / "base"), str(tmp_path / "target"), str(tmp_path / "patch"))
+
+	with open(tmp_path / "patch", "rb") as patch, pytest.raises(ValueError):
+		apply_patch(str(tmp_path / "other"), patch, io.BytesIO())
+
+
+def write_release(path, files: dict[str, bytes]):
+	with zipfile.ZipFile(path, "w") as zf:
+		for name, data in files.items():
+			zf.writestr(name, data)
+
+
+def tree_contents(root) -> dict[str, bytes]:
+	return {os.path.relpath(os.path.join(dirpath, name), root).replace("\\", "/"): open(os.path.join(dirpath, name), "rb").read()
+			for dirpath, _, names in os.walk(root) for name in names}
+
+
+BASE_RELEASE = {
+	"lib/xllr.so": BODY,
+	"include/xllr.h": b"#pragma once\n" * 1000,
+	"bin/old-tool": b"#!/bin/sh\nexit 1\n",
+	"README.txt": b"MetaFFI 1\n",
+}
+TARGET_RELEASE = {
+	"lib/xllr.so": BODY[:100_000] + INSERTED + BODY[100_000:],
+	"include/xllr.h": b"#pragma once\n" * 1000,
+	"bin/new-tool": b"#!/bin/sh\nexit 0\n",
+	"README.txt": b"MetaFFI 2\n",
+}
+
+
+def test_delta_package_upgrades_extracted_base(tmp_path):
+	write_release(tmp_path / "base.zip", BASE_RELEASE)
+	write_release(tmp_path / "target.zip", TARGET_RELEASE)
+	manifest = build_delta(str(tmp_path / "base.zip"), str(tmp_path / "target.zip"), str(tmp_path / "delta.zip"), workers=1)
+	assert manifest["files"]["lib/xllr.so"]["action"] == "patch"
+	assert manifest["removed"] == ["bin/old-tool"]
+
+	install_dir = tmp_path / "installed"
+	with zipfile.ZipFile(tmp_path / "base.zip") as zf:
+		zf.extractall(install_dir)
+	apply_delta_package(str(tmp_path / "delta.zip"), str(install_dir))
+	assert tree_contents(install_dir) == TARGET_RELEASE
+
+
+def test_delta_package_refuses_mismatched_base(tmp_path):
+	write_release(tmp_path / "base.zip", BASE_RELEASE)
+	write_release(tmp_path / "target.zip", TARGET_RELEASE)
+	build_delta(str(tmp_path / "base.zip"), str(tmp_path / "target.zip"), str(tmp_path / "delta.zip"), workers=1)
+
+	install_dir = tmp_path / "installed"
+	with zipfile.ZipFile(tmp_path / "base.zip") as zf:
+		zf.extractall(install_dir)
+	(install_dir / "lib" / "xllr.so").write_bytes(INSERTED)
+	before = tree_contents(install_dir)
+
+	with pytest.raises(ValueError, match="is not base.zip"):
+		apply_delta_package(str(tmp_path / "delta.zip"), str(install_dir))
+	assert tree_contents(install_dir) == before
+
+
+@pytest.mark.parametrize("name", ["../escaped.txt", "lib/../../escaped.txt", "/tmp/escaped.txt", "C:/escaped.txt", "..\\escaped.txt"])
+def test_delta_package_refuses_names_outside_install_dir(tmp_path, name):
+	data = b"escaped\n"
+	manifest = {
+		"format": DELTA_FORMAT_VERSION,
+		"base_name": "base.zip",
+		"target_name": "target.zip",
+		"base": {},
+		"files": {name: {"action": "add", "member": "add/escaped.txt", "sha256": hashlib.sha256(data).hexdigest(), "size": len(data), "mode": None}},
+		"removed": [],
+		"unchanged": 0,
+	}
+	with zipfile.ZipFile(tmp_path / "delta.zip", "w") as zf:
+		zf.writestr(DELTA_MANIFEST_NAME, json.dumps(manifest))
+		zf.writestr("add/escaped.txt", data)
+
+	install_dir = tmp_path / "installed"
+	install_dir.mkdir()
+	with pytest.raises(ValueError, match="not a path inside"):
+		apply_delta_package(str(tmp_path / "delta.zip"), str(install_dir))
+	assert not (tmp_path / "escaped.txt").exists()
+	assert tree_contents(tmp_path / "installed") == {}
@@ -0,0 +1,50 @@
+"""
+Deterministic archives are byte-identical across worker counts, file times and entry order.
+"""
+
+import os
+import random
+import sys
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from compression_policy import CompressionMethod
+from packaging_engine import BLOCK_SIZE, PackageEntry, write_zip
+
+
+def make_tree(root) -> list[PackageEntry]:
+	rng = random.Random(1)
+	files = {
+		"xllr.so": bytes(rng.getrandbits(8) for _ in range(4096)) * (2 * BLOCK_SIZE // 4096 + 3),
+		"metaffi": b"#!/bin/sh\nexit 0\n",
+		"include/xllr.h": b"#pragma once\n" * 1000,
+		"lib/empty.txt": b"",
+	}
+	entries = []
+	for arcname, data in files.items():
+		path = root / arcname
+		path.parent.mkdir(parents=True, exist_ok=True)
+		path.write_bytes(data)
+		entries.append(PackageEntry(src=str(path), arcname=arcname))
+	os.chmod(root / "metaffi", 0o755)
+	entries.append(PackageEntry(src=str(root / "include"), arcname="include/"))
+	entries[2].compression = CompressionMethod("lzma", 6)
+	return entries
+
+
+def build(path, entries: list[PackageEntry], workers: int) -> bytes:
+	with open(path, "wb") as f:
+		write_zip(f, entries, workers=workers, deterministic=True)
+	return path.read_bytes()
+
+
+def test_deterministic_zip_is_byte_identical(tmp_path):
+	entries = make_tree(tmp_path / "tree")
+	first = build(tmp_path / "first.zip", entries, workers=1)
+
+	for i, entry in enumerate(entries):
+		os.utime(entry.src, ns=(0, (1_700_000_000 + i * 86_400) * 1_000_000_000))
+	second = build(tmp_path / "second.zip", list(reversed(entries)), workers=4)
+
+	assert first == second